@@ -4,16 +4,22 @@ from bs4 import BeautifulSoup
 import json
 import time
 import datetime
+import hashlib
 import pytz
 from urllib.parse import urljoin, urlsplit, urlunsplit
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import boto3, os
 
 BASE_URL = os.getenv("BASE_URL", "https://vill.higashinaruse.lg.jp/")
 OUT_FILE = "vill_reference.json"
 DEPTH = 4
-DELAY = 0.3
+DELAY = float(os.getenv("CRAWL_DELAY", "0.3"))                    # 同一ホストへのリクエスト開始間隔（秒）
+CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", "4"))             # 全体の同時取得数
+PER_HOST_CONCURRENCY = int(os.getenv("PER_HOST_CONCURRENCY", "2"))  # 同一ホストへの同時接続数
+CHECK_PDF_CHANGES = os.getenv("CHECK_PDF_CHANGES", "1") == "1"      # PDFの更新有無を条件付きHEADで確認
 
 def make_session():
     s = requests.Session()
@@ -35,134 +41,326 @@ def normalize(url: str) -> str:
     # クエリは空に、フラグメントも空に
     return urlunsplit((s.scheme, s.netloc, path, "", ""))
 
-# ① sitemap.xmlからURLをすべて取得
-def get_all_sitemap_urls(session):
+
+class PoliteFetcher:
+    """スレッドプールで並列取得しつつ、ホストごとに同時接続数とリクエスト間隔を守る取得器
+       フェーズ（sitemap / crawl など）ごとに件数・転送量・失敗数・所要時間を集計する"""
+
+    def __init__(self, concurrency=CONCURRENCY, per_host=PER_HOST_CONCURRENCY, delay=DELAY):
+        self.delay = delay
+        self.per_host = per_host
+        self.pool = ThreadPoolExecutor(max_workers=concurrency)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._host_sem = {}
+        self._host_next = {}
+        self.stats = {}
+        self.phase = "default"
+
+    def _session(self):
+        # requests.Session はスレッド間で共有しない
+        if not hasattr(self._local, "session"):
+            self._local.session = make_session()
+        return self._local.session
+
+    def _wait_turn(self, host):
+        """同一ホストへのリクエスト開始を delay 秒間隔に揃える"""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._host_next.get(host, now))
+            self._host_next[host] = start + self.delay
+        if start > now:
+            time.sleep(start - now)
+
+    def begin_phase(self, name):
+        self.phase = name
+        self.stats[name] = {
+            "requests": 0, "errors": 0, "bytes": 0, "not_modified": 0, "skipped": 0,
+            "started": time.monotonic(), "elapsed_sec": 0.0,
+        }
+
+    def end_phase(self):
+        st = self.stats[self.phase]
+        st["elapsed_sec"] = round(time.monotonic() - st.pop("started"), 1)
+        print(f"📊 [{self.phase}] requests={st['requests']} not_modified={st['not_modified']} "
+              f"skipped={st['skipped']} errors={st['errors']} bytes={st['bytes']:,} elapsed={st['elapsed_sec']}s")
+
+    def _record(self, key, n=1):
+        with self._lock:
+            self.stats[self.phase][key] += n
+
+    def fetch(self, url, method="GET", **kwargs):
+        """GET / HEAD（失敗時は None）"""
+        host = urlsplit(url).netloc
+        with self._lock:
+            sem = self._host_sem.setdefault(host, threading.Semaphore(self.per_host))
+        with sem:
+            self._wait_turn(host)
+            try:
+                res = self._session().request(method, url, timeout=15, **kwargs)
+            except Exception:
+                self._record("errors")
+                return None
+        self._record("requests")
+        self._record("bytes", len(res.content))
+        if res.status_code == 304:
+            self._record("not_modified")
+        return res
+
+    def skip(self):
+        """前回の結果を再利用して取得しなかった件数"""
+        self._record("skipped")
+
+    def map(self, fn, items):
+        return self.pool.map(fn, items)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+
+def parse_links(page_url, html):
+    """1回のパースでサイト内リンク（巡回用）とPDFリンクを両方取り出す"""
+    links, pdfs = set(), set()
+    soup = BeautifulSoup(html, "html.parser")
+    for a in soup.find_all("a", href=True):
+        abs_url = normalize(urljoin(page_url, a["href"].strip()))
+        if not abs_url.startswith(BASE_URL):
+            continue
+        links.add(abs_url)
+        if abs_url.lower().endswith(".pdf"):
+            pdfs.add(abs_url)
+    return links, pdfs
+
+# ====== クロール状態（前回の ETag / Last-Modified / lastmod / 内容ハッシュ） ======
+def load_crawl_state(s3, bucket, key):
+    try:
+        return json.loads(s3.get_object(Bucket=bucket, Key=key)["Body"].read().decode("utf-8"))
+    except s3.exceptions.NoSuchKey:
+        return {"links": [], "urls": {}}
+
+
+def conditional_headers(prev):
+    """前回の検証子から条件付きリクエスト用ヘッダを作る"""
+    headers = {}
+    if prev.get("etag"):
+        headers["If-None-Match"] = prev["etag"]
+    if prev.get("last_modified"):
+        headers["If-Modified-Since"] = prev["last_modified"]
+    return headers
+
+
+# ① sitemap.xmlからURLをすべて取得（URL → <lastmod>）
+def get_all_sitemap_urls(fetcher):
     print("📄 Collecting URLs from sitemap.xml ...")
-    urls = set()
+    urls = {}
     idx_url = BASE_URL + "sitemap.xml"
 
-    res = session.get(idx_url, timeout=15)
+    res = fetcher.fetch(idx_url)
+    if res is None:
+        raise RuntimeError(f"failed to fetch {idx_url}")
     res.encoding = "utf-8"
     soup = BeautifulSoup(res.text, "html.parser")
 
     # --- サブサイトマップ一覧を取得 ---
     submaps = [loc.text.strip() for loc in soup.find_all("loc") if loc.text]
+    submaps = [sm for sm in submaps if sm.startswith(BASE_URL)]
     print(f"🗺️ Found {len(submaps)} sub-sitemaps")
 
-    for sm in submaps:
-        if not sm.startswith(BASE_URL):
-            continue
-        try:
-            r = session.get(sm, timeout=15)
-            r.encoding = "utf-8"
-            subsoup = BeautifulSoup(r.text, "html.parser")
-
-            # 各サブマップの <loc> を抽出
-            for loc in subsoup.find_all("loc"):
-                u = loc.text.strip()
-                if u.startswith(BASE_URL):
-                    urls.add(normalize(u))
-        except Exception as e:
-            print(f"⚠️ Failed to fetch {sm}: {e}")
+    # --- サブサイトマップを並列取得 ---
+    for sm, r in zip(submaps, fetcher.map(fetcher.fetch, submaps)):
+        if r is None:
+            print(f"⚠️ Failed to fetch {sm}")
             continue
+        r.encoding = "utf-8"
+        subsoup = BeautifulSoup(r.text, "html.parser")
+
+        # 各サブマップの <url><loc>/<lastmod> を抽出
+        for entry in subsoup.find_all("url"):
+            loc = entry.find("loc")
+            if not loc or not loc.text.strip().startswith(BASE_URL):
+                continue
+            lastmod = entry.find("lastmod")
+            urls[normalize(loc.text.strip())] = lastmod.text.strip() if lastmod else None
 
     print(f"✅ Sitemap URLs collected: {len(urls)}")
     return urls
 
 
 # ② 実際に辿れるURLを取得 (x) ＝（サイトマップURL集合 ∩ 実到達集合）
-def crawl_reachable_urls_within_sitemap(session, start_url, allowed_set, max_depth=4, delay=0.3):
+#    同じパースで各ページのPDFリンクも控えておき、③で再取得しない
+#    前回から変わっていないページ（lastmod 一致 / 304）は前回のリンク情報を再利用
+def crawl_reachable_urls_within_sitemap(fetcher, start_url, sitemap, prev_urls, max_depth=4):
     visited, to_visit, reachable = set(), {normalize(start_url)}, set()
+    page_pdfs, statuses, entries = {}, {}, {}
+
+    def visit(url):
+        prev = prev_urls.get(url) or {}
+        lastmod = sitemap.get(url)
+        if prev.get("type") == "html" and lastmod and prev.get("lastmod") == lastmod:
+            fetcher.skip()
+            return url, "unchanged", prev
+
+        res = fetcher.fetch(url, allow_redirects=True, headers=conditional_headers(prev))
+        if res is None:
+            return url, None, None
+        if res.status_code == 304 and prev.get("type") == "html":
+            return url, "unchanged", dict(prev, lastmod=lastmod)
+
+        ctype = (res.headers.get("Content-Type") or "").lower()
+        if "text/html" not in ctype:
+            # HTML以外（直PDFなど）は (x) には入れない（yで拾う）
+            return url, None, None
+
+        links, pdfs = parse_links(url, res.text)
+        digest = hashlib.sha256(res.content).hexdigest()
+        if not prev:
+            status = "new"
+        else:
+            status = "unchanged" if prev.get("content_hash") == digest else "changed"
+        return url, status, {
+            "type": "html",
+            "etag": res.headers.get("ETag"),
+            "last_modified": res.headers.get("Last-Modified"),
+            "lastmod": lastmod,
+            "content_hash": digest,
+            "content_length": len(res.content),
+            "links": sorted(links),
+            "pdfs": sorted(pdfs),
+        }
 
     for depth in range(max_depth):
-        print(f"🌿 Depth {depth+1}/{max_depth} - {len(to_visit)} URLs to crawl")
+        batch = sorted(u for u in to_visit if u not in visited and u.startswith(BASE_URL))
+        print(f"🌿 Depth {depth+1}/{max_depth} - {len(batch)} URLs to crawl")
+        visited.update(batch)
         new_urls = set()
 
-        for url in to_visit:
-            if url in visited or not url.startswith(BASE_URL):
-                continue
-            visited.add(url)
-            try:
-                res = session.get(url, timeout=15, allow_redirects=True)
-                ctype = (res.headers.get("Content-Type") or "").lower()
-                if "text/html" not in ctype:
-                    # HTML以外（直PDFなど）は (x) には入れない（yで拾う）
-                    time.sleep(delay)
-                    continue
-
-                # ← サイトマップに載っているURLだけ (x) 候補に採用
-                nurl = normalize(url)
-                if nurl in allowed_set:
-                    reachable.add(nurl)
-
-                soup = BeautifulSoup(res.text, "html.parser")
-                for a in soup.find_all("a", href=True):
-                    abs_url = normalize(urljoin(url, a["href"].strip()))
-                    if abs_url.startswith(BASE_URL):
-                        new_urls.add(abs_url)
-
-                time.sleep(delay)
-            except Exception:
+        for url, status, entry in fetcher.map(visit, batch):
+            if entry is None:
                 continue
+            entries[url] = entry
+            # ← サイトマップに載っているURLだけ (x) 候補に採用
+            nurl = normalize(url)
+            if nurl in sitemap:
+                reachable.add(nurl)
+                page_pdfs[nurl] = set(entry["pdfs"])
+                statuses[nurl] = status
+            new_urls |= set(entry["links"])
 
         to_visit = new_urls - visited
 
     print(f"✅ Reachable URLs (within sitemap): {len(reachable)}")
-    return reachable
+    return reachable, page_pdfs, statuses, entries
 
-# ③ 実到達URL (x) の各ページからPDFリンクを抽出 (y)
-def extract_pdf_links_from_pages(session, pages):
-    pdfs = set()
+# ③ 実到達URL (x) の各ページからPDFリンクを抽出 (y)（②のパース結果を利用）
+def extract_pdf_links_from_pages(page_pdfs, pages):
     print("📑 Extracting PDF links from (x) pages...")
-    total = len(pages)
-    for i, url in enumerate(pages, 1):
-        try:
-            res = session.get(url, timeout=15)
-            ctype = (res.headers.get("Content-Type") or "").lower()
-            if "text/html" not in ctype:
-                continue
-            soup = BeautifulSoup(res.text, "html.parser")
-            for a in soup.find_all("a", href=True):
-                abs_url = normalize(urljoin(url, a["href"].strip()))
-                if abs_url.startswith(BASE_URL) and abs_url.lower().endswith(".pdf"):
-                    pdfs.add(abs_url)
-        except Exception:
-            pass
-        if i % 25 == 0:
-            print(f"  ... scanned {i}/{total} pages")
-        time.sleep(DELAY)
+    pdfs = set()
+    for url in pages:
+        pdfs |= page_pdfs.get(url, set())
     print(f"✅ PDF links found: {len(pdfs)}")
     return pdfs
 
+
+# ③' PDFの更新有無を条件付き HEAD で確認（本体はダウンロードしない）
+def check_pdf_changes(fetcher, pdfs, prev_urls):
+    def head(url):
+        prev = prev_urls.get(url) or {}
+        if not CHECK_PDF_CHANGES:
+            return url, ("unknown" if prev else "new"), prev or {"type": "pdf"}
+        res = fetcher.fetch(url, method="HEAD", allow_redirects=True, headers=conditional_headers(prev))
+        if res is None:
+            return url, ("unknown" if prev else "new"), prev or {"type": "pdf"}
+        if res.status_code == 304 and prev:
+            return url, "unchanged", prev
+
+        size = res.headers.get("Content-Length")
+        entry = {
+            "type": "pdf",
+            "etag": res.headers.get("ETag"),
+            "last_modified": res.headers.get("Last-Modified"),
+            "content_length": int(size) if size and size.isdigit() else None,
+        }
+        if not prev:
+            status = "new"
+        elif entry["etag"] or entry["last_modified"]:
+            same = (entry["etag"], entry["last_modified"], entry["content_length"]) == (
+                prev.get("etag"), prev.get("last_modified"), prev.get("content_length"))
+            status = "unchanged" if same else "changed"
+        else:
+            status = "unknown"
+        return url, status, entry
+
+    statuses, entries = {}, {}
+    for url, status, entry in fetcher.map(head, sorted(pdfs)):
+        statuses[url] = status
+        entries[url] = entry
+    return statuses, entries
+
 def lambda_handler(event=None, context=None):
     started = datetime.datetime.now(pytz.timezone("Asia/Tokyo"))
 
-    session = make_session()
+    s3 = boto3.client("s3")
+    bucket = os.getenv("BUCKET_NAME", "chat-for-vill-reference")
+    key = os.getenv("REFERENCE_PREFIX", "reference/") + "vill_reference.json"
+    state_key = os.getenv("REFERENCE_PREFIX", "reference/") + "crawl_state.json"
 
-    # Step①: サイトマップの正規URL全集合
-    sitemap_urls = get_all_sitemap_urls(session)
+    # 前回のクロール状態（無ければ全URLが new になる）
+    prev_state = load_crawl_state(s3, bucket, state_key)
+    prev_urls = prev_state.get("urls", {})
 
-    # Step②: トップを起点にクロールしつつ、(x) = サイトマップ内に限定して実到達URLだけ収集
-    x_pages = crawl_reachable_urls_within_sitemap(
-        session, BASE_URL, allowed_set=sitemap_urls, max_depth=DEPTH, delay=DELAY
-    )
+    fetcher = PoliteFetcher()
+    try:
+        # Step①: サイトマップの正規URL全集合
+        fetcher.begin_phase("sitemap")
+        sitemap_urls = get_all_sitemap_urls(fetcher)
+        fetcher.end_phase()
+
+        # Step②: トップを起点にクロールしつつ、(x) = サイトマップ内に限定して実到達URLだけ収集
+        fetcher.begin_phase("crawl")
+        x_pages, page_pdfs, statuses, entries = crawl_reachable_urls_within_sitemap(
+            fetcher, BASE_URL, sitemap=sitemap_urls, prev_urls=prev_urls, max_depth=DEPTH
+        )
+        fetcher.end_phase()
 
-    # Step③: (x) のページから見えるPDFを抽出（PDF自体はサイトマップ外でもOK）
-    y_pdfs = extract_pdf_links_from_pages(session, sorted(x_pages))
+        # Step③: (x) のページから見えるPDFを抽出（PDF自体はサイトマップ外でもOK）
+        y_pdfs = extract_pdf_links_from_pages(page_pdfs, sorted(x_pages))
+        fetcher.begin_phase("pdf_check")
+        pdf_statuses, pdf_entries = check_pdf_changes(fetcher, y_pdfs, prev_urls)
+        fetcher.end_phase()
+    finally:
+        fetcher.close()
+    statuses.update(pdf_statuses)
+    entries.update(pdf_entries)
 
-    # Step④: (x) ∪ (y) を出力
+    # Step④: (x) ∪ (y) を出力（URLごとの変更状態 new / changed / unchanged / unknown と削除URL付き）
     unified = sorted(x_pages.union(y_pdfs))
-    data = {"base_url": BASE_URL, "total": len(unified), "links": unified}
+    removed = sorted(set(prev_state.get("links", [])) - set(unified))
+    summary = {st: 0 for st in ("new", "changed", "unchanged", "unknown")}
+    for u in unified:
+        summary[statuses[u]] += 1
+    summary["removed"] = len(removed)
+    data = {
+        "base_url": BASE_URL,
+        "total": len(unified),
+        "links": unified,
+        "status": {u: statuses[u] for u in unified},
+        "removed": removed,
+        "summary": summary,
+    }
 
-    s3 = boto3.client("s3")
-    bucket = os.getenv("BUCKET_NAME", "chat-for-vill-reference")
-    key = os.getenv("REFERENCE_PREFIX", "reference/") + "vill_reference.json"
     s3.put_object(
         Bucket=bucket,
         Key=key,
         Body=json.dumps(data, ensure_ascii=False, indent=2),
         ContentType="application/json"
     )
+    s3.put_object(
+        Bucket=bucket,
+        Key=state_key,
+        Body=json.dumps({"updated_at": started.isoformat(), "links": unified, "urls": entries}, ensure_ascii=False),
+        ContentType="application/json"
+    )
+    print(f"🔁 Change summary: {summary}")
 
     finished = datetime.datetime.now(pytz.timezone("Asia/Tokyo"))
     elapsed = (finished - started).total_seconds()
@@ -192,6 +390,8 @@ def lambda_handler(event=None, context=None):
         "body": json.dumps({
             "message": "vill_reference.json generated successfully",
             "total": len(unified),
-            "elapsed_sec": elapsed
+            "summary": summary,
+            "elapsed_sec": elapsed,
+            "fetch_stats": fetcher.stats
         }, ensure_ascii=False)
     }
\ No newline at end of file
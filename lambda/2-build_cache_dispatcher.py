@@ -2,6 +2,7 @@
 import boto3
 import json
 import os
+import heapq
 import datetime
 import pytz
 
@@ -11,31 +12,107 @@ sqs = boto3.client("sqs")
 BUCKET_NAME = os.getenv("BUCKET_NAME", "chat-for-vill-reference")
 REFERENCE_KEY = os.getenv("REFERENCE_KEY", "reference/vill_reference.json")
 QUEUE_URL = os.getenv("QUEUE_URL")  # 例: https://sqs.ap-northeast-1.amazonaws.com/xxxx/vill-cache-tasks
-BATCH_SIZE = int(os.getenv("BATCH_SIZE", "10"))
+CRAWL_STATE_KEY = os.getenv("CRAWL_STATE_KEY", "reference/crawl_state.json")
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "10"))            # 1メッセージあたりの最大URL数
+BATCH_COST = float(os.getenv("BATCH_COST", "40"))          # 1メッセージあたりの目安コスト（≒ワーカー処理時間）
+HTML_COST = float(os.getenv("HTML_COST", "1"))             # HTML 1ページのコスト
+PDF_COST = float(os.getenv("PDF_COST", "3"))               # PDF 1件の基本コスト
+PDF_MB_COST = float(os.getenv("PDF_MB_COST", "4"))         # PDF 1MB あたりの追加コスト
+PDF_UNKNOWN_COST = float(os.getenv("PDF_UNKNOWN_COST", "10"))  # サイズ不明のPDFのコスト
+SEND_BATCH_MAX = 10                                        # send_message_batch の1回あたりの上限件数
+SEND_RETRIES = 3
+
+# 先に処理させる順（新規 → 変更 → 不明 → 未変更）
+PRIORITY = {"new": 0, "changed": 1, "unknown": 2, "unchanged": 3}
+
+
+def _load_json(key, default):
+    try:
+        return json.loads(s3.get_object(Bucket=BUCKET_NAME, Key=key)["Body"].read().decode("utf-8"))
+    except s3.exceptions.NoSuchKey:
+        print(f"⚠️ {key} not found")
+        return default
+
+
+def estimate_cost(url, entry):
+    """前回クロールのサイズからワーカーの処理コストを見積もる（PDFはサイズに比例）"""
+    if url.lower().endswith(".pdf"):
+        size = (entry or {}).get("content_length")
+        return PDF_COST + size / (1024 * 1024) * PDF_MB_COST if size else PDF_UNKNOWN_COST
+    return HTML_COST
+
+
+def make_batches(costs):
+    """コストがほぼ均等になるようにURLをメッセージへ振り分ける
+       コストの大きい順に、URL数に空きがある中で最も軽いメッセージへ入れる（LPT法）"""
+    if not costs:
+        return []
+    total = sum(costs.values())
+    n = max(-(-len(costs) // BATCH_SIZE), int(-(-total // BATCH_COST)))
+    heap = [(0.0, i, []) for i in range(n)]
+    full = []
+    for url in sorted(costs, key=lambda u: (-costs[u], u)):
+        load, i, urls = heapq.heappop(heap)
+        urls.append(url)
+        if len(urls) >= BATCH_SIZE:
+            full.append((load + costs[url], i, urls))
+        else:
+            heapq.heappush(heap, (load + costs[url], i, urls))
+    batches = sorted(full + heap, key=lambda b: b[1])
+    return [(load, urls) for load, _, urls in batches if urls]
+
+
+def send_batches(batches):
+    """send_message_batch で最大10メッセージずつ送信。失敗したエントリだけ再送する"""
+    calls = 0
+    for start in range(0, len(batches), SEND_BATCH_MAX):
+        entries = [
+            {"Id": str(start + i), "MessageBody": json.dumps({"urls": urls})}
+            for i, (_, urls) in enumerate(batches[start:start + SEND_BATCH_MAX])
+        ]
+        for attempt in range(SEND_RETRIES + 1):
+            res = sqs.send_message_batch(QueueUrl=QUEUE_URL, Entries=entries)
+            calls += 1
+            failed = {f["Id"] for f in res.get("Failed", [])}
+            if not failed:
+                break
+            if attempt == SEND_RETRIES:
+                raise RuntimeError(f"send_message_batch failed for {len(failed)} messages: {res['Failed']}")
+            print(f"⚠️ Retrying {len(failed)} failed messages")
+            entries = [e for e in entries if e["Id"] in failed]
+    return calls
 
 def lambda_handler(event, context):
     started = datetime.datetime.now(pytz.timezone("Asia/Tokyo"))
     print(f"🚀 dispatcher started at {started.strftime('%Y-%m-%d %H:%M:%S')}")
 
-    # --- 1️⃣ URLリストをS3から取得 ---
+    # --- 1️⃣ URLリストと前回クロール状態をS3から取得 ---
     print(f"📥 Fetching {REFERENCE_KEY} from s3://{BUCKET_NAME}/")
     obj = s3.get_object(Bucket=BUCKET_NAME, Key=REFERENCE_KEY)
     data = json.loads(obj["Body"].read().decode("utf-8"))
     urls = data.get("links", [])
+    status = data.get("status", {})
+    known = _load_json(CRAWL_STATE_KEY, {}).get("urls", {})
     print(f"🔗 Total URLs: {len(urls)}")
 
-    # --- 2️⃣ URLを分割してSQSに投入 ---
-    total_batches = 0
-    for i in range(0, len(urls), BATCH_SIZE):
-        batch = urls[i:i + BATCH_SIZE]
-        sqs.send_message(
-            QueueUrl=QUEUE_URL,
-            MessageBody=json.dumps({"urls": batch})
-        )
-        total_batches += 1
+    # --- 2️⃣ 変更状態ごとに、コストが均等なメッセージへ分割（新規・変更を先に送る） ---
+    batches, tiers = [], {}
+    for url in urls:
+        tiers.setdefault(status.get(url, "unknown"), {})[url] = estimate_cost(url, known.get(url))
+    for name in sorted(tiers, key=lambda t: PRIORITY.get(t, len(PRIORITY))):
+        tier = make_batches(tiers[name])
+        batches.extend(tier)
+        if tier:
+            loads = [load for load, _ in tier]
+            print(f"📦 {name}: {len(tiers[name])} URLs → {len(tier)} batches "
+                  f"(cost min/avg/max={min(loads):.1f}/{sum(loads) / len(loads):.1f}/{max(loads):.1f})")
+
+    # --- 3️⃣ SQS に送信 ---
+    api_calls = send_batches(batches)
+    total_batches = len(batches)
 
     elapsed = (datetime.datetime.now(pytz.timezone("Asia/Tokyo")) - started).total_seconds()
-    print(f"✅ Dispatched {total_batches} batches to SQS ({len(urls)} URLs)")
+    print(f"✅ Dispatched {total_batches} batches to SQS ({len(urls)} URLs, {api_calls} API calls)")
     print(f"⏱ Elapsed: {elapsed:.1f}s")
 
     return {
@@ -43,6 +120,7 @@ def lambda_handler(event, context):
         "body": json.dumps({
             "message": "Dispatch completed",
             "total_batches": total_batches,
+            "api_calls": api_calls,
             "total_urls": len(urls),
             "elapsed_sec": elapsed
         }, ensure_ascii=False)
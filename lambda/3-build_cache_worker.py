@@ -0,0 +1,278 @@
+# build_cache_worker.lambda_handler — SQS で受け取ったURL群を本文抽出・チャンク化して cache/ に保存
+import boto3
+import json
+import os
+import re
+import uuid
+import hashlib
+import resource
+import tempfile
+import datetime
+import pytz
+import requests
+import pdfplumber
+from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
+
+s3 = boto3.client("s3")
+
+BUCKET_NAME = os.getenv("BUCKET_NAME", "chat-for-vill-reference")
+CACHE_PREFIX = os.getenv("CACHE_PREFIX", "cache/")
+CACHE_STATE_PREFIX = os.getenv("CACHE_STATE_PREFIX", "cache_state/")  # URLごとの前回ハッシュ（未変更ならスキップ）
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "1000"))            # 1チャンクの目安文字数（見出し行を除く）
+URL_CONCURRENCY = int(os.getenv("URL_CONCURRENCY", "4"))     # 1バッチ内で同時に処理するURL数
+MAX_DOCUMENT_BYTES = int(os.getenv("MAX_DOCUMENT_BYTES", str(100 * 1024 * 1024)))  # これを超える文書は処理しない
+DOWNLOAD_BLOCK = 64 * 1024
+USER_AGENT = "Mozilla/5.0 (compatible; vill-crawler/1.0)"
+
+
+def peak_rss_mb():
+    """プロセスの最大常駐メモリ（MB）。Linux の ru_maxrss は KB 単位"""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _state_key(url):
+    return f"{CACHE_STATE_PREFIX}{hashlib.sha256(url.encode('utf-8')).hexdigest()}.json"
+
+
+def load_state(url):
+    try:
+        obj = s3.get_object(Bucket=BUCKET_NAME, Key=_state_key(url))
+        return json.loads(obj["Body"].read().decode("utf-8"))
+    except s3.exceptions.NoSuchKey:
+        return {}
+
+
+def save_state(url, state):
+    s3.put_object(
+        Bucket=BUCKET_NAME,
+        Key=_state_key(url),
+        Body=json.dumps(state, ensure_ascii=False).encode("utf-8"),
+        ContentType="application/json"
+    )
+
+
+# ====== 取得（本文はメモリに載せず一時ファイルへ。ハッシュは受信しながら計算） ======
+def download(url, prev):
+    """条件付きGETで取得。304 なら None、それ以外は (一時ファイルパス, sha256, ヘッダ) を返す"""
+    headers = {"User-Agent": USER_AGENT}
+    if prev.get("etag"):
+        headers["If-None-Match"] = prev["etag"]
+    if prev.get("last_modified"):
+        headers["If-Modified-Since"] = prev["last_modified"]
+
+    with requests.get(url, headers=headers, timeout=30, stream=True) as res:
+        if res.status_code == 304:
+            return None
+        res.raise_for_status()
+        digest = hashlib.sha256()
+        size = 0
+        fd, path = tempfile.mkstemp(suffix=".pdf" if url.lower().endswith(".pdf") else ".html")
+        with os.fdopen(fd, "wb") as f:
+            for block in res.iter_content(DOWNLOAD_BLOCK):
+                size += len(block)
+                if size > MAX_DOCUMENT_BYTES:
+                    f.close()
+                    os.remove(path)
+                    raise ValueError(f"document too large (> {MAX_DOCUMENT_BYTES:,} bytes)")
+                digest.update(block)
+                f.write(block)
+        return path, digest.hexdigest(), res.headers
+
+
+# ====== 抽出（ページ／段落単位のジェネレータ） ======
+def _clean_lines(text):
+    for line in (text or "").splitlines():
+        line = re.sub(r"[ \t　]+", " ", line).strip()
+        if line:
+            yield line
+
+
+def extract_html(path):
+    """HTML から (タイトル見出し, 本文行のジェネレータ) を返す"""
+    with open(path, "rb") as f:
+        soup = BeautifulSoup(f.read(), "html.parser")
+    for tag in soup(["script", "style", "noscript", "header", "footer", "nav"]):
+        tag.decompose()
+    title = soup.title.get_text(" ", strip=True) if soup.title else ""
+    h1 = soup.find("h1")
+    h1 = h1.get_text(" ", strip=True) if h1 else ""
+    heading = " ".join(t for t in dict.fromkeys([title, h1]) if t)
+    return heading, _clean_lines(soup.get_text("\n"))
+
+
+def extract_pdf(path, url):
+    """PDF を1ページずつ読み、行を順に返す。読み終えたページは close() でキャッシュ（textmap含む）を破棄する"""
+    def lines():
+        with pdfplumber.open(path) as pdf:
+            for page in pdf.pages:
+                try:
+                    yield from _clean_lines(page.extract_text())
+                finally:
+                    page.close()
+    return os.path.basename(url), lines()
+
+
+def chunk_lines(lines, size=CHUNK_SIZE):
+    """行を改行を保ったまま size 文字前後にまとめて逐次返す。1行が長すぎる場合は途中で切る"""
+    buf, length = [], 0
+    for line in lines:
+        while len(line) > size:
+            if buf:
+                yield "\n".join(buf)
+                buf, length = [], 0
+            yield line[:size]
+            line = line[size:]
+        if buf and length + len(line) + 1 > size:
+            yield "\n".join(buf)
+            buf, length = [], 0
+        buf.append(line)
+        length += len(line) + 1
+    if buf:
+        yield "\n".join(buf)
+
+
+# ====== 1URLの処理 ======
+def process_url(url, out_path):
+    """1URLを処理して JSONL を out_path に書き出す。戻り値は処理結果の要約"""
+    prev = load_state(url)
+    fetched = download(url, prev)
+    if fetched is None:
+        return {"url": url, "status": "not_modified", "chunks": 0}
+
+    path, doc_hash, headers = fetched
+    try:
+        if prev.get("doc_hash") == doc_hash:
+            # 本文は同じでも検証子が変わっていれば更新しておき、次回は 304 で済ませる
+            validators = {"etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified")}
+            if any(prev.get(k) != v for k, v in validators.items()):
+                save_state(url, dict(prev, **validators))
+            return {"url": url, "status": "unchanged", "chunks": 0}
+
+        ctype = (headers.get("Content-Type") or "").lower()
+        if "pdf" in ctype or url.lower().endswith(".pdf"):
+            doc_type = "pdf"
+            heading, lines = extract_pdf(path, url)
+        else:
+            doc_type = "html"
+            heading, lines = extract_html(path)
+
+        chunk_hashes = []
+        with open(out_path, "w", encoding="utf-8") as out:
+            for i, body in enumerate(chunk_lines(lines)):
+                content = f"{heading}\n{body}" if heading else body
+                content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+                chunk_hashes.append(content_hash)
+                out.write(json.dumps({
+                    "url": url,
+                    "chunk_index": i,
+                    "type": doc_type,
+                    "title": heading,
+                    "content": content,
+                    "content_hash": content_hash,
+                    "doc_hash": doc_hash,
+                }, ensure_ascii=False) + "\n")
+    finally:
+        os.remove(path)
+
+    return {
+        "url": url,
+        "status": "changed" if prev else "new",
+        "chunks": len(chunk_hashes),
+        "state": {
+            "url": url,
+            "type": doc_type,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "doc_hash": doc_hash,
+            "chunk_hashes": chunk_hashes,
+        },
+    }
+
+
+def _iter_urls(event):
+    """SQS イベント（Records[].body = {"urls": [...]}）と直接呼び出し（{"urls": [...]}）の両方に対応"""
+    if "Records" in event:
+        for record in event["Records"]:
+            for url in json.loads(record["body"]).get("urls", []):
+                yield record.get("messageId"), url
+    else:
+        for url in event.get("urls", []):
+            yield None, url
+
+
+def lambda_handler(event, context):
+    started = datetime.datetime.now(pytz.timezone("Asia/Tokyo"))
+    print(f"🚀 cache_worker started at {started.strftime('%Y-%m-%d %H:%M:%S')}")
+
+    items = list(_iter_urls(event))
+    print(f"🔗 URLs in batch: {len(items)}")
+    workdir = tempfile.mkdtemp(prefix="cache_")
+
+    def work(arg):
+        i, (message_id, url) = arg
+        out_path = os.path.join(workdir, f"{i}.jsonl")
+        try:
+            result = process_url(url, out_path)
+        except Exception as e:
+            print(f"⚠️ Failed {url}: {e}")
+            result = {"url": url, "status": "error", "chunks": 0}
+        result["message_id"] = message_id
+        result["path"] = out_path
+        return result
+
+    # URLごとに並列処理（各スレッドは自分の一時ファイルへ逐次書き出す）
+    with ThreadPoolExecutor(max_workers=URL_CONCURRENCY) as ex:
+        results = list(ex.map(work, enumerate(items)))
+
+    # 1バッチ分を1つの JSONL にまとめて保存（chunk_count はここで確定させる）
+    counts = {}
+    for r in results:
+        counts[r["status"]] = counts.get(r["status"], 0) + 1
+    written = [r for r in results if r.get("state")]
+    key = None
+    total_chunks = sum(r["chunks"] for r in written)
+    if written:
+        request_id = getattr(context, "aws_request_id", None) or uuid.uuid4().hex
+        key = f"{CACHE_PREFIX}{started.strftime('%Y-%m-%d_%H%M%S')}_{request_id[:8]}.jsonl"
+        merged_path = os.path.join(workdir, "batch.jsonl")
+        with open(merged_path, "w", encoding="utf-8") as out:
+            for r in written:
+                with open(r["path"], encoding="utf-8") as f:
+                    for line in f:
+                        rec = json.loads(line)
+                        rec["chunk_count"] = r["chunks"]
+                        out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        s3.upload_file(merged_path, BUCKET_NAME, key, ExtraArgs={"ContentType": "application/x-ndjson"})
+        print(f"💾 Saved {total_chunks} chunks to s3://{BUCKET_NAME}/{key}")
+
+        # 保存が済んでから状態を更新（途中で落ちたら次回は再処理される）
+        for r in written:
+            save_state(r["url"], dict(r["state"], cache_key=key, updated_at=started.isoformat()))
+
+    for name in os.listdir(workdir):
+        os.remove(os.path.join(workdir, name))
+    os.rmdir(workdir)
+
+    # URLが1件も処理できなかったメッセージは部分失敗として返す（ReportBatchItemFailures 用）
+    failed_ids = {r["message_id"] for r in results if r["status"] == "error" and r["message_id"]}
+    ok_ids = {r["message_id"] for r in results if r["status"] != "error" and r["message_id"]}
+    failures = [{"itemIdentifier": m} for m in sorted(failed_ids - ok_ids)]
+
+    elapsed = (datetime.datetime.now(pytz.timezone("Asia/Tokyo")) - started).total_seconds()
+    print(f"✅ Results: {counts}")
+    print(f"📈 Peak RSS: {peak_rss_mb()} MB")
+    print(f"⏱ Elapsed: {elapsed:.1f}s")
+
+    return {
+        "batchItemFailures": failures,
+        "statusCode": 200,
+        "body": json.dumps({
+            "message": "cache built",
+            "key": key,
+            "results": counts,
+            "total_chunks": total_chunks,
+            "peak_rss_mb": peak_rss_mb(),
+            "elapsed_sec": elapsed
+        }, ensure_ascii=False)
+    }
@@ -0,0 +1,287 @@
+# build_embeddings.lambda_handler — cache/ のチャンクのうち新規・変更分だけを embedding 化して embeddings/ に保存
+import boto3
+import json
+import os
+import time
+import random
+import hashlib
+import datetime
+import pytz
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from openai import OpenAI, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+
+s3 = boto3.client("s3")
+
+BUCKET = os.getenv("BUCKET_NAME", "chat-for-vill-reference")
+CACHE_PREFIX = os.getenv("CACHE_PREFIX", "cache/")
+EMBED_PREFIX = os.getenv("EMBED_PREFIX", "embeddings/")
+EMBED_STATE_KEY = os.getenv("EMBED_STATE_KEY", "embeddings/state.json")  # 埋め込み済みチャンクの content_hash 一覧
+EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-small")
+EMBED_FAKE = os.getenv("EMBED_FAKE", "0") == "1"               # 1: OpenAI を呼ばずに決定的な疑似ベクトルを使う（オフライン検証用）
+EMBED_DIMS = int(os.getenv("EMBED_DIMS", "1536"))              # 疑似ベクトルの次元数
+BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "100000"))  # 1リクエストあたりの推定トークン上限
+BATCH_MAX_INPUTS = int(os.getenv("EMBED_BATCH_MAX_INPUTS", "2048"))
+MAX_INPUT_TOKENS = 8000                                        # 1入力あたりの上限（モデル上限 8191 に余裕を持たせる）
+CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))         # 同時リクエスト数
+MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "6"))
+STATE_FLUSH_BATCHES = int(os.getenv("STATE_FLUSH_BATCHES", "5"))  # 何バッチごとに state.json を保存するか
+TIMEOUT_MARGIN_MS = int(os.getenv("TIMEOUT_MARGIN_MS", "90000"))  # 残り時間がこれを切ったら中断して再起動
+MAX_RESUMES = int(os.getenv("MAX_RESUMES", "10"))
+PREVIEW_CHARS = 200
+
+_oa = None
+
+
+def _openai():
+    global _oa
+    if _oa is None:
+        # リトライは自前で行う（429 の待ち時間を Retry-After に合わせるため）
+        _oa = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    return _oa
+
+
+def _list_keys(prefix, suffix):
+    keys = []
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=BUCKET, Prefix=prefix):
+        keys.extend(o["Key"] for o in page.get("Contents", []) if o["Key"].endswith(suffix))
+    return sorted(keys)
+
+
+def _chunk_id(url, chunk_index):
+    return f"{url}#{chunk_index}"
+
+
+def estimate_tokens(text):
+    """トークン数の推定。日本語は1文字≒1トークン、英数字は3〜4文字≒1トークンなので UTF-8 バイト数/3 で安全側に見積もる"""
+    return len(text.encode("utf-8")) // 3 + 1
+
+
+# ====== 入力の収集と差分 ======
+def load_live_chunks():
+    """cache/*.jsonl から現行のチャンクを集める
+       同じURLは最も新しいファイルの文書だけを採用（文書が短くなった場合の古い末尾チャンクを残さない）"""
+    keys = _list_keys(CACHE_PREFIX, ".jsonl")
+    owner, live = {}, {}
+    for key in reversed(keys):
+        body = s3.get_object(Bucket=BUCKET, Key=key)["Body"].read().decode("utf-8")
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            r = json.loads(line)
+            url, content = r.get("url"), r.get("content", "")
+            if not url or not content:
+                continue
+            if r.get("doc_hash"):
+                owner.setdefault(url, key)
+            if owner.get(url, key) != key:
+                continue
+            cid = _chunk_id(url, int(r.get("chunk_index", 0)))
+            if cid in live:
+                continue
+            live[cid] = {
+                "url": url,
+                "chunk_index": int(r.get("chunk_index", 0)),
+                "content": content,
+                "content_hash": r.get("content_hash") or hashlib.sha256(content.encode("utf-8")).hexdigest(),
+            }
+    print(f"📚 Live chunks: {len(live)} (from {len(keys)} cache files)")
+    return live
+
+
+def load_state():
+    try:
+        obj = s3.get_object(Bucket=BUCKET, Key=EMBED_STATE_KEY)
+        state = json.loads(obj["Body"].read().decode("utf-8"))
+    except s3.exceptions.NoSuchKey:
+        return {"model": EMBED_MODEL, "chunks": {}}
+    if state.get("model") != EMBED_MODEL:
+        # モデルが変わったら全チャンクを作り直す
+        print(f"🔄 Embedding model changed ({state.get('model')} → {EMBED_MODEL}); re-embedding everything")
+        return {"model": EMBED_MODEL, "chunks": {}}
+    return state
+
+
+def save_state(state, live):
+    # cache/ から消えたチャンクは落とす（5-build_vector はこの一覧を現行チャンクとして扱える）
+    chunks = {cid: h for cid, h in state["chunks"].items() if cid in live}
+    s3.put_object(
+        Bucket=BUCKET,
+        Key=EMBED_STATE_KEY,
+        Body=json.dumps({"model": EMBED_MODEL, "updated_at": state.get("updated_at"), "chunks": chunks},
+                        ensure_ascii=False).encode("utf-8"),
+        ContentType="application/json"
+    )
+    print(f"💾 Saved state ({len(chunks)} embedded chunks)")
+
+
+def make_batches(items):
+    """推定トークン数と件数の上限で詰めたバッチに分ける"""
+    batch, tokens = [], 0
+    for item in items:
+        text = item["content"]
+        n = estimate_tokens(text)
+        if n > MAX_INPUT_TOKENS:
+            text = text[: len(text) * MAX_INPUT_TOKENS // n]
+            n = estimate_tokens(text)
+        if batch and (tokens + n > BATCH_TOKENS or len(batch) >= BATCH_MAX_INPUTS):
+            yield batch
+            batch, tokens = [], 0
+        batch.append(dict(item, input=text))
+        tokens += n
+    if batch:
+        yield batch
+
+
+# ====== embedding ======
+def fake_embed(texts, dims=EMBED_DIMS):
+    """テキストのハッシュを種にした決定的な単位ベクトル（オフライン検証用）"""
+    out = []
+    for text in texts:
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        v = np.random.default_rng(seed).standard_normal(dims).astype(np.float32)
+        out.append((v / np.linalg.norm(v)).tolist())
+    return out
+
+
+def _retry_after(e, attempt):
+    """429 は Retry-After を優先し、無ければ指数バックオフ＋ジッター"""
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return min(60.0, 2 ** attempt) * (0.5 + random.random() / 2)
+
+
+def embed_texts(texts):
+    if EMBED_FAKE:
+        return fake_embed(texts)
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            res = _openai().embeddings.create(model=EMBED_MODEL, input=texts)
+            return [d.embedding for d in sorted(res.data, key=lambda d: d.index)]
+        except (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError) as e:
+            if attempt == MAX_RETRIES:
+                raise
+            wait_sec = _retry_after(e, attempt)
+            print(f"⏳ {type(e).__name__}; retry {attempt + 1}/{MAX_RETRIES} in {wait_sec:.1f}s")
+            time.sleep(wait_sec)
+
+
+def write_batch(batch, run_id, seq):
+    vectors = embed_texts([item["input"] for item in batch])
+    lines = []
+    for item, vec in zip(batch, vectors):
+        lines.append(json.dumps({
+            "url": item["url"],
+            "chunk_index": item["chunk_index"],
+            "preview": item["content"][:PREVIEW_CHARS],
+            "content_hash": item["content_hash"],
+            "model": EMBED_MODEL,
+            "embedding": vec,
+        }, ensure_ascii=False))
+    key = f"{EMBED_PREFIX}{run_id}_embed_{seq:04d}.jsonl"
+    s3.put_object(Bucket=BUCKET, Key=key, Body="\n".join(lines).encode("utf-8"), ContentType="application/x-ndjson")
+    return key
+
+
+def _remaining_ms(context):
+    return context.get_remaining_time_in_millis() if hasattr(context, "get_remaining_time_in_millis") else float("inf")
+
+
+def _trigger(function_arn, payload, label):
+    try:
+        if function_arn:
+            boto3.client("lambda").invoke(
+                FunctionName=function_arn,
+                InvocationType="Event",  # 非同期実行
+                Payload=json.dumps(payload)
+            )
+            print(f"🚀 Triggered {label} ({function_arn})")
+        else:
+            print(f"⚠️ ARN for {label} not set, skipping invoke")
+    except Exception as e:
+        print(f"⚠️ Failed to trigger {label}: {e}")
+
+
+def lambda_handler(event, context):
+    started = datetime.datetime.now(pytz.timezone("Asia/Tokyo"))
+    event = event or {}
+    resumes = int(event.get("resumes", 0))
+    print(f"🚀 build_embeddings started at {started.strftime('%Y-%m-%d %H:%M:%S')} (resume #{resumes})")
+
+    # 1️⃣ 現行チャンクと埋め込み済み一覧の差分
+    live = load_live_chunks()
+    state = load_state()
+    todo = [c for cid, c in live.items() if state["chunks"].get(cid) != c["content_hash"]]
+    # (url, chunk_index) 順に並べておくと各出力ファイルも整列済みになり、5-build_vector がそのままマージできる
+    todo.sort(key=lambda c: (c["url"], c["chunk_index"]))
+    print(f"🧮 To embed: {len(todo)} / {len(live)} chunks (model={EMBED_MODEL}{', fake' if EMBED_FAKE else ''})")
+
+    # 2️⃣ バッチ単位で並列に embedding → 1バッチ1ファイルで保存
+    run_id = started.strftime("%Y-%m-%d_%H%M%S")
+    files, failed = [], 0
+    done_chunks = 0
+    interrupted = False
+
+    def work(seq, batch):
+        return batch, write_batch(batch, run_id, seq)
+
+    def collect(future):
+        nonlocal done_chunks, failed
+        try:
+            batch, key = future.result()
+        except Exception as e:
+            # リトライを使い切ったバッチは state に載らないので次回また対象になる
+            print(f"⚠️ Batch failed: {e}")
+            failed += 1
+            return
+        state["chunks"].update({_chunk_id(c["url"], c["chunk_index"]): c["content_hash"] for c in batch})
+        done_chunks += len(batch)
+        files.append(key)
+        if len(files) % STATE_FLUSH_BATCHES == 0:
+            save_state(state, live)
+
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as ex:
+        pending = set()
+        for seq, batch in enumerate(make_batches(todo)):
+            if _remaining_ms(context) < TIMEOUT_MARGIN_MS:
+                interrupted = True
+                break
+            if len(pending) >= CONCURRENCY:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for f in finished:
+                    collect(f)
+            pending.add(ex.submit(work, seq, batch))
+        for f in pending:
+            collect(f)
+
+    # 3️⃣ 進捗を保存（中断時は続きから再開できる）
+    state["updated_at"] = started.isoformat()
+    save_state(state, live)
+
+    elapsed = (datetime.datetime.now(pytz.timezone("Asia/Tokyo")) - started).total_seconds()
+    print(f"✅ Embedded {done_chunks} chunks into {len(files)} files (failed batches={failed})")
+    print(f"⏱ Elapsed: {elapsed:.1f}s")
+
+    # 4️⃣ 時間切れなら自分自身を再起動、完了なら build_vector を呼び出し
+    if interrupted:
+        if resumes < MAX_RESUMES:
+            _trigger(getattr(context, "invoked_function_arn", None),
+                     {"trigger": "resume", "resumes": resumes + 1}, "build_embeddings (resume)")
+        else:
+            print(f"⚠️ Resume limit ({MAX_RESUMES}) reached; remaining chunks will be embedded next run")
+    else:
+        _trigger(os.getenv("VECTOR_LAMBDA_ARN"), {"trigger": "from_embeddings"}, "build_vector")
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "message": "embeddings interrupted, resuming" if interrupted else "embeddings built",
+            "embedded": done_chunks,
+            "remaining": len(todo) - done_chunks,
+            "failed_batches": failed,
+            "files": files,
+            "elapsed_sec": elapsed
+        }, ensure_ascii=False)
+    }
@@ -1,52 +1,695 @@
 # build_vector_index.lambda_handler — embeddings統合Lambda
 
+import io
+import re
+import heapq
+import shutil
 import boto3
 import json
 import os
+import hashlib
+import unicodedata
 import datetime
+import tempfile
+from collections import Counter
+from urllib.parse import urlparse
 import pytz
+import numpy as np
 
 s3 = boto3.client("s3")
 
 BUCKET = os.getenv("BUCKET_NAME", "chat-for-vill-reference")
 EMBED_PREFIX = os.getenv("EMBED_PREFIX", "embeddings")
 VECTOR_PREFIX = os.getenv("VECTOR_PREFIX", "vector")
-MAX_FILES = int(os.getenv("MAX_FILES", "1000"))
+CACHE_PREFIX = os.getenv("CACHE_PREFIX", "cache/")
+BM25_TOKENIZER = os.getenv("BM25_TOKENIZER", "bigram")
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+ANN_LISTS = int(os.getenv("ANN_LISTS", "0"))  # IVF のクラスタ数（0 = 近似索引を作らない）
+ANN_TRAIN_SAMPLE = int(os.getenv("ANN_TRAIN_SAMPLE", "50000"))
+ANN_ITERATIONS = int(os.getenv("ANN_ITERATIONS", "20"))
+MAX_FILES = int(os.getenv("MAX_FILES", "1000"))  # k-way マージで同時に開くファイル数の上限（超える分は古い方から段階的にまとめる）
+VECTOR_DTYPE = os.getenv("VECTOR_DTYPE", "float32")  # float32 / float16
+COARSE_DIMS = int(os.getenv("COARSE_DIMS", "0"))     # 一次走査用に先頭から残す次元数（Matryoshka 切り詰め。0 = 全次元）
+COARSE_DTYPE = os.getenv("COARSE_DTYPE", "")         # 一次走査用ベクトルの型 int8 / float16 / float32（空 = 作らない）
+SHARD_INDEX = os.getenv("SHARD_INDEX", "1") == "1"  # 行をサイト×推定年のシャード順に並べ、行範囲を manifest に記録
+KEEP_VERSIONS = int(os.getenv("KEEP_VERSIONS", "3"))  # vector/<version>/ を何世代残すか（稼働中の 6-chat が旧版を読み終えられるように）
+EXPORT_JSONL = os.getenv("EXPORT_JSONL", "0") == "1"  # 旧形式 index.jsonl も出力する場合
+REFERENCE_KEY = os.getenv("REFERENCE_KEY", "reference/vill_reference.json")  # 現行URL一覧（ここに無いURLは落とす）
+EMBED_STATE_KEY = os.getenv("EMBED_STATE_KEY", "embeddings/state.json")     # 現行チャンク一覧（4-build_embeddings が出力）
+COMPACT_EMBEDDINGS = os.getenv("COMPACT_EMBEDDINGS", "1") == "1"  # マージ結果を1ファイルにまとめ、取り込んだ古いファイルを削除
+PART_SIZE = 8 * 1024 * 1024  # マルチパートアップロードの1パートの大きさ
+WORK_DIR = os.getenv("WORK_DIR", "/tmp/build_vector")
+
+
+def _to_matrix(raw_path, count, dims, out_path, block=8192):
+    """生ベクトル（float32 を行順に連結したファイル）を L2正規化して .npy に書き出す（内積＝コサイン類似度）
+       ブロック単位で処理するので、メモリ使用量は件数によらない"""
+    out = np.lib.format.open_memmap(out_path, mode="w+", dtype=VECTOR_DTYPE, shape=(count, dims))
+    if count:
+        raw = np.memmap(raw_path, dtype=np.float32, mode="r", shape=(count, dims))
+        for start in range(0, count, block):
+            part = np.asarray(raw[start:start + block])
+            norms = np.linalg.norm(part, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            out[start:start + block] = (part / norms).astype(VECTOR_DTYPE)
+        del raw
+    out.flush()
+    del out
+    return np.load(out_path, mmap_mode="r")
+
+
+def _normalize_text(text):
+    """キーワード照合用の正規化（全角英数→半角、小文字化）"""
+    return unicodedata.normalize("NFKC", text or "").lower()
+
+
+def _detect_year_from_text(text, now_year):
+    """本文・URL・ファイル名から年度を推定（令和 or 西暦）。不明なら 0"""
+    if m := re.search(r"令和\s*(\d+)", text):
+        return 2018 + int(m.group(1))
+    if m := re.search(r"(20\d{2})", text):
+        year = int(m.group(1))
+        if 2000 <= year <= now_year + 1:
+            return year
+    return 0
+
+
+def _build_features(meta):
+    """クエリに依存しないランキング特徴量を列指向で事前計算
+       - page_year   : 推定年度（不明=0 → 検索時に当年扱い）
+       - is_pdf      : PDFかどうか
+       - post_number : URL中の post-XXXX 番号（無ければ0）
+       - match_text  : キーワード照合用の正規化テキスト（preview + URL + ファイル名）"""
+    now_year = datetime.datetime.now(pytz.timezone("Asia/Tokyo")).year
+    page_year, is_pdf, post_number, match_text = [], [], [], []
+    for url, preview in zip(meta["url"], meta["preview"]):
+        text = (preview or "") + " " + url + " " + os.path.basename(url)
+        page_year.append(_detect_year_from_text(text, now_year))
+        is_pdf.append(url.lower().endswith(".pdf"))
+        m = re.search(r"post-(\d+)", url)
+        post_number.append(int(m.group(1)) if m else 0)
+        match_text.append(_normalize_text(text))
+    arrays = {
+        "page_year": np.asarray(page_year, dtype=np.int16),
+        "is_pdf": np.asarray(is_pdf, dtype=bool),
+        "post_number": np.asarray(post_number, dtype=np.int32),
+    }
+    return arrays, match_text
+
+
+def _partition_rows(meta, features):
+    """行を (サイト, 推定年) ごとにまとめる並び順とシャード表を返す（シャード内は元の url / chunk_index 順）
+       戻り値: (order, [{"site", "year", "start", "end"}])。year=0 は年不明"""
+    sites = [urlparse(url).netloc.lower() for url in meta["url"]]
+    years = features["page_year"].tolist()
+    order = sorted(range(len(sites)), key=lambda i: (sites[i], years[i]))
+    shards = []
+    for pos, i in enumerate(order):
+        if shards and (shards[-1]["site"], shards[-1]["year"]) == (sites[i], years[i]):
+            shards[-1]["end"] = pos + 1
+        else:
+            shards.append({"site": sites[i], "year": int(years[i]), "start": pos, "end": pos + 1})
+    return np.asarray(order, dtype=np.int64), shards
+
+
+def _permute_matrix(matrix_path, order, block=8192):
+    """index.npy の行を order の順に並べ替えて書き直す（ブロック単位）"""
+    src = np.load(matrix_path, mmap_mode="r")
+    tmp_path = matrix_path + ".sorted.npy"
+    out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=src.dtype, shape=src.shape)
+    for start in range(0, len(order), block):
+        out[start:start + block] = src[order[start:start + block]]
+    out.flush()
+    del out, src
+    os.replace(tmp_path, matrix_path)
+    return np.load(matrix_path, mmap_mode="r")
+
+
+def _bigram_tokens(text):
+    """文字 bigram トークナイザ（日本語は分かち書きせず2文字ずつ、英数字は単語単位）"""
+    tokens = []
+    for run in re.findall(r"[一-龠々ぁ-んァ-ンー]+|[a-z0-9]+", _normalize_text(text)):
+        if run.isascii():
+            tokens.append(run)
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+# トークナイザの差し替え口（6-chat 側にも同名で同じ定義を置くこと）
+TOKENIZERS = {"bigram": _bigram_tokens}
+
+
+def _build_bm25(texts):
+    """BM25 用の転置インデックスを CSR 形式で作る
+       - terms    : 語彙（ソート済み）
+       - term_ptr : 各語のポスティング開始位置 (V+1,)
+       - doc_ids  : ポスティング（行番号）
+       - tf       : 各ポスティングの出現回数
+       - doc_len  : 各行のトークン数"""
+    tokenize = TOKENIZERS[BM25_TOKENIZER]
+    postings, doc_len = {}, []
+    for i, text in enumerate(texts):
+        counts = Counter(tokenize(text))
+        doc_len.append(sum(counts.values()))
+        for term, tf in counts.items():
+            postings.setdefault(term, []).append((i, tf))
+
+    terms = sorted(postings)
+    term_ptr = np.zeros(len(terms) + 1, dtype=np.int64)
+    term_ptr[1:] = np.cumsum([len(postings[t]) for t in terms])
+    doc_ids = np.empty(int(term_ptr[-1]), dtype=np.int32)
+    tf = np.empty(int(term_ptr[-1]), dtype=np.uint16)
+    for k, term in enumerate(terms):
+        plist = postings[term]
+        doc_ids[term_ptr[k]:term_ptr[k + 1]] = [d for d, _ in plist]
+        tf[term_ptr[k]:term_ptr[k + 1]] = [min(c, 65535) for _, c in plist]
+    print(f"🔤 BM25 index: vocab={len(terms):,} postings={len(doc_ids):,}")
+    return {
+        "terms": np.asarray(terms, dtype=str),
+        "term_ptr": term_ptr,
+        "doc_ids": doc_ids,
+        "tf": tf,
+        "doc_len": np.asarray(doc_len, dtype=np.int32),
+    }
+
+
+def _row_texts(blob_path, chunk_index, match_text):
+    """BM25 の対象テキスト：本文チャンク（無い行は preview + URL）"""
+    with open(blob_path, "rb") as f:
+        for i, (off, length) in enumerate(zip(chunk_index["offset"], chunk_index["length"])):
+            if off < 0:
+                yield match_text[i]
+                continue
+            f.seek(int(off))
+            yield f.read(int(length)).decode("utf-8")
+
+
+def _assign_clusters(matrix, centroids, block=8192):
+    """各行を内積最大（＝コサイン最大）のセントロイドに割り当て（ブロック単位で省メモリ）"""
+    assign = np.empty(matrix.shape[0], dtype=np.int32)
+    for start in range(0, matrix.shape[0], block):
+        part = np.asarray(matrix[start:start + block], dtype=np.float32)
+        assign[start:start + block] = np.argmax(part @ centroids.T, axis=1)
+    return assign
+
+
+def _train_ivf(matrix, nlist):
+    """球面 k-means で IVF（転置ファイル）索引を作る
+       - centroids : (nlist, d) 正規化済みセントロイド
+       - offsets   : (nlist+1,) 各リストの rows 内の開始位置
+       - rows      : リスト順に並べた行番号"""
+    rng = np.random.default_rng(0)
+    n = matrix.shape[0]
+    nlist = min(nlist, n)
+    sample = rng.choice(n, size=min(n, max(ANN_TRAIN_SAMPLE, nlist)), replace=False)
+    train = np.asarray(matrix[np.sort(sample)], dtype=np.float32)
+    centroids = train[rng.choice(train.shape[0], size=nlist, replace=False)].copy()
+
+    for _ in range(ANN_ITERATIONS):
+        assign = _assign_clusters(train, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, train)
+        counts = np.bincount(assign, minlength=nlist)
+        empty = counts == 0
+        if empty.any():
+            # 空クラスタは学習データからランダムに再初期化
+            sums[empty] = train[rng.choice(train.shape[0], size=int(empty.sum()), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = (sums / norms).astype(np.float32)
+
+    assign = _assign_clusters(matrix, centroids)
+    rows = np.argsort(assign, kind="stable").astype(np.int32)
+    offsets = np.zeros(nlist + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assign, minlength=nlist))
+    sizes = np.diff(offsets)
+    print(f"🧭 IVF trained: nlist={nlist} list_size(min/avg/max)={sizes.min()}/{sizes.mean():.1f}/{sizes.max()}")
+    return {"centroids": centroids, "offsets": offsets, "rows": rows}
+
+
+def _quantize_coarse(matrix, dims, dtype, block=8192):
+    """一次走査用の軽量ベクトルを作る
+       - 先頭 dims 次元に切り詰めて再正規化（text-embedding-3 系は先頭次元ほど情報を持つ）
+       - int8 は行ごとのスケールで対称量子化（内積 ≒ scale × (int8 ベクトル・クエリ)）
+       戻り値: {"vectors": (N, dims), "scale": (N,)（int8 の場合のみ）}"""
+    n = matrix.shape[0]
+    dims = min(dims or matrix.shape[1], matrix.shape[1])
+    vectors = np.empty((n, dims), dtype=np.int8 if dtype == "int8" else dtype)
+    scale = np.ones(n, dtype=np.float32)
+    for start in range(0, n, block):
+        part = np.array(matrix[start:start + block, :dims], dtype=np.float32)
+        norms = np.linalg.norm(part, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        part /= norms
+        if dtype == "int8":
+            peak = np.abs(part).max(axis=1)
+            peak[peak == 0] = 1.0
+            scale[start:start + block] = peak / 127.0
+            vectors[start:start + block] = np.round(part / scale[start:start + block, None]).astype(np.int8)
+        else:
+            vectors[start:start + block] = part.astype(dtype)
+    coarse = {"vectors": vectors}
+    if dtype == "int8":
+        coarse["scale"] = scale
+    return coarse
+
+
+def _list_keys(prefix, suffix):
+    """prefix 配下のキーを全ページ分列挙（list_objects_v2 の1000件上限対策）"""
+    keys = []
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=BUCKET, Prefix=prefix):
+        keys.extend(o["Key"] for o in page.get("Contents", []) if o["Key"].endswith(suffix))
+    return sorted(keys)
+
+
+def _write_chunk_store(meta):
+    """cache/*.jsonl の本文を1つのバイナリ（chunks.bin）に詰め、行ごとのオフセット表を作る
+       6-chat はヒットした行だけをバイト範囲指定で取得する。同じ (url, chunk_index) は新しいファイルを優先"""
+    count = len(meta["url"])
+    rows_of = {}
+    for i, (url, chunk_index) in enumerate(zip(meta["url"], meta["chunk_index"])):
+        rows_of.setdefault((url, chunk_index), []).append(i)
+
+    offsets = np.full(count, -1, dtype=np.int64)
+    lengths = np.zeros(count, dtype=np.int32)
+    blob = tempfile.NamedTemporaryFile(suffix=".bin", delete=False)
+    pos = 0
+    with blob:
+        for key in reversed(_list_keys(CACHE_PREFIX, ".jsonl")):
+            body = s3.get_object(Bucket=BUCKET, Key=key)["Body"].read().decode("utf-8")
+            for line in body.splitlines():
+                if not line.strip():
+                    continue
+                r = json.loads(line)
+                rows = rows_of.get((r.get("url"), int(r.get("chunk_index", 0))))
+                content = r.get("content", "")
+                if not rows or not content or offsets[rows[0]] >= 0:
+                    continue
+                data = content.encode("utf-8")
+                blob.write(data)
+                offsets[rows] = pos
+                lengths[rows] = len(data)
+                pos += len(data)
+
+    print(f"📚 Packed {int((offsets >= 0).sum())}/{count} chunks ({pos:,} bytes)")
+    return blob.name, {"offset": offsets, "length": lengths}
+
+
+def _sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class MultipartWriter:
+    """S3 のマルチパートアップロードへ逐次書き込む（出力全体をメモリにも /tmp にも溜めない）"""
+
+    def __init__(self, key, content_type):
+        self.key = key
+        self.upload_id = s3.create_multipart_upload(Bucket=BUCKET, Key=key, ContentType=content_type)["UploadId"]
+        self.parts, self.buf, self.size = [], bytearray(), 0
+
+    def _upload_part(self):
+        number = len(self.parts) + 1
+        res = s3.upload_part(Bucket=BUCKET, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=bytes(self.buf))
+        self.parts.append({"PartNumber": number, "ETag": res["ETag"]})
+        self.size += len(self.buf)
+        self.buf = bytearray()
+
+    def write(self, data):
+        self.buf += data
+        if len(self.buf) >= PART_SIZE:
+            self._upload_part()
+
+    def close(self):
+        if self.buf or not self.parts:
+            self._upload_part()  # 最後のパートは 5MB 未満でもよい
+        s3.complete_multipart_upload(Bucket=BUCKET, Key=self.key, UploadId=self.upload_id,
+                                     MultipartUpload={"Parts": self.parts})
+        print(f"💾 Saved s3://{BUCKET}/{self.key} ({self.size:,} bytes, {len(self.parts)} parts)")
+
+    def abort(self):
+        s3.abort_multipart_upload(Bucket=BUCKET, Key=self.key, UploadId=self.upload_id)
+
+
+def _put_bytes(key, body, content_type):
+    res = s3.put_object(Bucket=BUCKET, Key=key, Body=body, ContentType=content_type)
+    print(f"💾 Saved s3://{BUCKET}/{key} ({len(body):,} bytes)")
+    return res.get("ETag")
+
+
+def _write_binary_index(meta, matrix_path, version):
+    """バイナリ形式のインデックスを出力
+       - index.npy     : 正規化済みベクトル行列 (N, d)
+       - meta.json     : 行ごとのメタ情報（列指向: url / chunk_index / preview / match_text）
+       - features.npz  : ランキング特徴量（page_year / is_pdf / post_number）
+       - chunks.bin / chunks.npz : 本文チャンクの連結バイナリと行ごとの (offset, length)
+       - bm25.npz      : 文字 bigram の転置インデックス（BM25 統計付き）
+       - ivf.npz       : 近似最近傍（IVF）索引（ANN_LISTS > 0 の場合のみ）
+       - coarse.npz    : 一次走査用の切り詰め・量子化ベクトル（COARSE_DTYPE 指定時のみ）
+       - manifest.json : 版・次元数・件数・dtype・チェックサム・ファイル一覧・index.npy のデータ開始位置・シャード表
+       SHARD_INDEX=1 の場合、全ファイルの行はサイト×推定年のシャード順に並ぶ（manifest["shards"] に各シャードの行範囲）
+       各ファイルは vector/<version>/ に置き（既存の版は上書きしない）、最後に vector/manifest.json を差し替えて公開する"""
+    matrix = np.load(matrix_path, mmap_mode="r")
+
+    features, match_text = _build_features(meta)
+    shards = None
+    if SHARD_INDEX and matrix.shape[0] > 0:
+        order, shards = _partition_rows(meta, features)
+        meta = {name: [column[i] for i in order] for name, column in meta.items()}
+        features = {name: column[order] for name, column in features.items()}
+        match_text = [match_text[i] for i in order]
+        del matrix
+        matrix = _permute_matrix(matrix_path, order)
+        print(f"🗂 Partitioned into {len(shards)} shards (site x year)")
+    buf = io.BytesIO()
+    np.savez(buf, **features)
+    features_bytes = buf.getvalue()
+
+    meta_bytes = json.dumps(dict(meta, match_text=match_text), ensure_ascii=False).encode("utf-8")
+
+    base = f"{VECTOR_PREFIX}/{version}"
+    matrix_key = f"{base}/index.npy"
+    meta_key = f"{base}/meta.json"
+    features_key = f"{base}/features.npz"
+    s3.upload_file(matrix_path, BUCKET, matrix_key)  # 大きい場合はマルチパート転送
+    print(f"💾 Saved s3://{BUCKET}/{matrix_key} ({os.path.getsize(matrix_path):,} bytes)")
+    _put_bytes(meta_key, meta_bytes, "application/json")
+    _put_bytes(features_key, features_bytes, "application/octet-stream")
+
+    blob_path, chunk_index = _write_chunk_store(meta)
+    buf = io.BytesIO()
+    np.savez(buf, **chunk_index)
+    chunk_index_bytes = buf.getvalue()
+    chunks_key = f"{base}/chunks.bin"
+    chunks_index_key = f"{base}/chunks.npz"
+    s3.upload_file(blob_path, BUCKET, chunks_key)  # 大きい場合はマルチパート転送
+    print(f"💾 Saved s3://{BUCKET}/{chunks_key}")
+    _put_bytes(chunks_index_key, chunk_index_bytes, "application/octet-stream")
+
+    bm25 = _build_bm25(_row_texts(blob_path, chunk_index, match_text))
+    chunks_sha256, chunks_size = _sha256_file(blob_path), os.path.getsize(blob_path)
+    os.remove(blob_path)
+    buf = io.BytesIO()
+    np.savez(buf, **bm25)
+    bm25_bytes = buf.getvalue()
+    bm25_key = f"{base}/bm25.npz"
+    _put_bytes(bm25_key, bm25_bytes, "application/octet-stream")
+
+    files = {
+        "matrix": matrix_key,
+        "meta": meta_key,
+        "features": features_key,
+        "chunks": chunks_key,
+        "chunks_index": chunks_index_key,
+        "bm25": bm25_key,
+    }
+    checksum = {
+        "matrix": _sha256_file(matrix_path),
+        "meta": hashlib.sha256(meta_bytes).hexdigest(),
+        "features": hashlib.sha256(features_bytes).hexdigest(),
+        "chunks": chunks_sha256,
+        "chunks_index": hashlib.sha256(chunk_index_bytes).hexdigest(),
+        "bm25": hashlib.sha256(bm25_bytes).hexdigest(),
+    }
+    # chunks.bin は 6-chat が範囲取得するだけで全体を読まないので、読み込み時に照合できるよう大きさも残す
+    size = {"chunks": chunks_size, "chunks_index": len(chunk_index_bytes)}
+    ann = None
+    if ANN_LISTS > 0 and matrix.shape[0] > 0:
+        ivf = _train_ivf(matrix, ANN_LISTS)
+        buf = io.BytesIO()
+        np.savez(buf, **ivf)
+        ivf_bytes = buf.getvalue()
+        files["ivf"] = f"{base}/ivf.npz"
+        checksum["ivf"] = hashlib.sha256(ivf_bytes).hexdigest()
+        _put_bytes(files["ivf"], ivf_bytes, "application/octet-stream")
+        ann = {"type": "ivf", "nlist": int(ivf["centroids"].shape[0])}
+
+    coarse = None
+    if COARSE_DTYPE and matrix.shape[0] > 0:
+        vectors = _quantize_coarse(matrix, COARSE_DIMS, COARSE_DTYPE)
+        buf = io.BytesIO()
+        np.savez(buf, **vectors)
+        coarse_bytes = buf.getvalue()
+        files["coarse"] = f"{base}/coarse.npz"
+        checksum["coarse"] = hashlib.sha256(coarse_bytes).hexdigest()
+        _put_bytes(files["coarse"], coarse_bytes, "application/octet-stream")
+        coarse = {"dims": int(vectors["vectors"].shape[1]), "dtype": COARSE_DTYPE}
+
+    # 6-chat が index.npy の行をバイト範囲指定で読めるよう、ヘッダ長（データ開始位置）を記録
+    data_offset = os.path.getsize(matrix_path) - matrix.size * matrix.dtype.itemsize
+
+    manifest = {
+        "format": "npy",
+        "version": version,
+        "count": int(matrix.shape[0]),
+        "dims": int(matrix.shape[1]) if matrix.ndim == 2 else 0,
+        "dtype": VECTOR_DTYPE,
+        "normalized": True,
+        "ann": ann,
+        "coarse": coarse,
+        "matrix_offset": data_offset,
+        "shards": shards,
+        "bm25": {"tokenizer": BM25_TOKENIZER, "k1": BM25_K1, "b": BM25_B},
+        "files": files,
+        "checksum": checksum,
+        "size": size,
+    }
+    manifest_bytes = json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8")
+    # 版ごとの控え（切り戻しはこれを vector/manifest.json にコピーする）→ 公開用 manifest の順に書く
+    _put_bytes(f"{base}/manifest.json", manifest_bytes, "application/json")
+    etag = _put_bytes(f"{VECTOR_PREFIX}/manifest.json", manifest_bytes, "application/json")
+    print(f"📣 Published vector index v{version} (rows={manifest['count']}, manifest ETag={etag})")
+    return dict(manifest, etag=etag)
+
+
+def _prune_versions(current, keep=KEEP_VERSIONS):
+    """vector/<version>/ のうち新しい keep 世代（current を含む）だけ残して削除"""
+    prefix = f"{VECTOR_PREFIX}/"
+    by_version = {}
+    for key in _list_keys(prefix, ""):
+        parts = key[len(prefix):].split("/", 1)
+        if len(parts) == 2 and parts[0].isdigit():
+            by_version.setdefault(parts[0], []).append(key)
+    versions = sorted(by_version, reverse=True)
+    if current not in versions[:keep]:
+        return []
+    removed = versions[max(keep, 1):]
+    for version in removed:
+        for key in by_version[version]:
+            s3.delete_object(Bucket=BUCKET, Key=key)
+    if removed:
+        print(f"🗑 Pruned old vector versions: {', '.join(removed)}")
+    return removed
+
+
+def _sort_key(rec):
+    return rec.get("url", ""), int(rec.get("chunk_index", 0))
+
+
+def _download_sorted(key, path):
+    """embeddings ファイルを /tmp に落とす。(url, chunk_index) 順でない旧形式ファイルはこの1ファイルだけ並べ替える"""
+    s3.download_file(BUCKET, key, path)
+    prev = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            k = _sort_key(json.loads(line))
+            if prev is not None and k < prev:
+                break
+            prev = k
+        else:
+            return path
+
+    print(f"⚠️ {key} is not sorted by (url, chunk_index); sorting it in memory")
+    with open(path, encoding="utf-8") as f:
+        keyed = [(_sort_key(json.loads(line)), line.rstrip("\n")) for line in f if line.strip()]
+    keyed.sort(key=lambda t: t[0])
+    with open(path, "w", encoding="utf-8") as f:
+        for _, line in keyed:
+            f.write(line + "\n")
+    return path
+
+
+def _iter_rows(path, rank):
+    """(url, chunk_index, rank) をキーに1行ずつ返す。rank は新しいファイルほど小さい"""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                rec = json.loads(line)
+                yield _sort_key(rec) + (rank,), rec
+
+
+def _merge_group(paths, out_path):
+    """新しい順に並んだファイル群を1つの整列済みファイルにまとめる（同じキーは新しい方の行だけ。絞り込みはしない）"""
+    streams = [_iter_rows(path, rank) for rank, path in enumerate(paths)]
+    last = None
+    with open(out_path, "w", encoding="utf-8") as out:
+        for (url, chunk_index, _), rec in heapq.merge(*streams, key=lambda t: t[0]):
+            if (url, chunk_index) == last:
+                continue
+            last = (url, chunk_index)
+            out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    for path in paths:
+        os.remove(path)
+    return out_path
+
+
+def _reduce_files(paths, limit):
+    """同時に開くファイルが limit 件以下になるまで、古い方から limit 件ずつ1ファイルにまとめる（paths は新しい順）
+       まとめたファイルは元のファイル群と同じ位置に置くので、新しいファイルの行が勝つ順序は変わらない"""
+    limit = max(limit, 2)
+    passes = 0
+    while len(paths) > limit:
+        passes += 1
+        merged = _merge_group(paths[-limit:], os.path.join(WORK_DIR, f"premerge_{passes:04d}.jsonl"))
+        paths = paths[:-limit] + [merged]
+    if passes:
+        print(f"🔗 Pre-merged oldest embedding files in {passes} passes (MAX_FILES={limit})")
+    return paths
+
+
+def _load_live_sets():
+    """現行URL（vill_reference.json）と現行チャンク（embeddings/state.json）。無ければ絞り込まない"""
+    try:
+        ref = json.loads(s3.get_object(Bucket=BUCKET, Key=REFERENCE_KEY)["Body"].read().decode("utf-8"))
+        live_urls = set(ref.get("links", []))
+    except s3.exceptions.NoSuchKey:
+        print(f"⚠️ {REFERENCE_KEY} not found; URL filtering disabled")
+        live_urls = None
+    try:
+        state = json.loads(s3.get_object(Bucket=BUCKET, Key=EMBED_STATE_KEY)["Body"].read().decode("utf-8"))
+        live_chunks = set(state.get("chunks", {}))
+    except s3.exceptions.NoSuchKey:
+        live_chunks = None
+    return live_urls, live_chunks
+
+
+def merge_embeddings(paths, raw_path, compact=None, export=None):
+    """整列済みの embeddings ファイル群を k-way マージし、(url, chunk_index) ごとに最新の1行だけを残す
+       - 現行チャンク（state.json）に無い行は落とし、残りは compact（統合 embeddings ファイル）へ
+       - さらに現行URL（vill_reference.json）に無い行を落としたものがインデックスになる。
+         ベクトルは raw_path に float32 で追記し、行は export（index.jsonl）へ
+       compact / export は MultipartWriter（逐次アップロード）。メモリに載るのは各ファイルの先頭1行と行メタ情報だけ"""
+    live_urls, live_chunks = _load_live_sets()
+    streams = [_iter_rows(path, rank) for rank, path in enumerate(paths)]  # paths は新しい順
+    meta = {"url": [], "chunk_index": [], "preview": []}
+    stats = Counter()
+    dims, last = None, None
+
+    with open(raw_path, "wb") as raw:
+        for (url, chunk_index, _), rec in heapq.merge(*streams, key=lambda t: t[0]):
+            if (url, chunk_index) == last:
+                stats["superseded"] += 1
+                continue
+            last = (url, chunk_index)
+            if live_chunks is not None and f"{url}#{chunk_index}" not in live_chunks:
+                stats["stale_chunk"] += 1
+                continue
+            line = (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+            if compact:
+                # サイトから一時的に消えただけのURLを失わないよう、統合ファイルにはURLで絞る前の行を残す
+                compact.write(line)
+            if live_urls is not None and url not in live_urls:
+                stats["removed_url"] += 1
+                continue
+            vec = np.asarray(rec["embedding"], dtype=np.float32)
+            if dims is None:
+                dims = vec.shape[0]
+            elif vec.shape[0] != dims:
+                stats["bad_dims"] += 1
+                continue
+
+            raw.write(vec.tobytes())
+            meta["url"].append(url)
+            meta["chunk_index"].append(chunk_index)
+            meta["preview"].append(rec.get("preview") or "")
+            if export:
+                export.write(line)
+            stats["kept"] += 1
+
+    print(f"🧹 Merge stats: {dict(stats)}")
+    return meta, dims or 0, stats
+
 
 def lambda_handler(event, context):
     started = datetime.datetime.now(pytz.timezone("Asia/Tokyo"))
     print(f"🚀 build_vector_index started at {started.strftime('%Y-%m-%d %H:%M:%S')}")
+    version = started.strftime("%Y%m%d%H%M%S")
 
-    # 1️⃣ 対象ファイル一覧を取得
-    objs = s3.list_objects_v2(Bucket=BUCKET, Prefix=EMBED_PREFIX).get("Contents", [])
-    objs = [o for o in objs if o["Key"].endswith(".jsonl")]
-    print(f"📦 Found {len(objs)} embedding files")
+    # 1️⃣ 対象ファイル一覧を取得（キー＝日付順。未変更チャンクの最新行は古いファイルにもあるので全件使う）
+    keys = _list_keys(EMBED_PREFIX, ".jsonl")
+    print(f"📦 Found {len(keys)} embedding files")
 
-    if not objs:
+    if not keys:
         print("⚠️ No embedding files found.")
         return {"statusCode": 404, "body": "No embedding files"}
 
-    # 2️⃣ 各ファイルを読み取って統合
-    merged = []
-    for obj in objs[:MAX_FILES]:
-        key = obj["Key"]
-        body = s3.get_object(Bucket=BUCKET, Key=key)["Body"].read().decode("utf-8")
-        lines = [json.loads(line) for line in body.splitlines() if line.strip()]
-        merged.extend(lines)
-        print(f"✅ Loaded {len(lines)} vectors from {key}")
-
-    # 3️⃣ 統合データをS3に保存
-    out_key = f"{VECTOR_PREFIX}/index.jsonl"
-    s3.put_object(
-        Bucket=BUCKET,
-        Key=out_key,
-        Body="\n".join(json.dumps(item, ensure_ascii=False) for item in merged).encode("utf-8"),
-        ContentType="application/json"
-    )
+    # 2️⃣ 各ファイルを /tmp に落とし、k-way マージで重複・削除済みを除いて統合
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+    os.makedirs(WORK_DIR)
+    paths = [_download_sorted(key, os.path.join(WORK_DIR, f"{i:05d}.jsonl")) for i, key in enumerate(keys)]
+    paths.reverse()  # 新しいファイルを先頭（同じキーならこちらが勝つ）
+    paths = _reduce_files(paths, MAX_FILES)
+    raw_path = os.path.join(WORK_DIR, "vectors.f32")
+
+    embed_prefix = EMBED_PREFIX.rstrip("/") + "/"
+    compact_key = f"{embed_prefix}{started.strftime('%Y-%m-%d_%H%M%S')}_merged.jsonl"
+    compact = MultipartWriter(compact_key, "application/x-ndjson") if COMPACT_EMBEDDINGS else None
+    export = MultipartWriter(f"{VECTOR_PREFIX}/index.jsonl", "application/json") if EXPORT_JSONL else None  # 旧形式（任意）
+    writers = [w for w in (compact, export) if w]
+    try:
+        meta, dims, stats = merge_embeddings(paths, raw_path, compact, export)
+    except Exception:
+        for w in writers:
+            w.abort()
+        raise
+    for w in writers:
+        w.close()
+    for path in paths:
+        os.remove(path)
+
+    # 3️⃣ バイナリインデックス（npy + meta + manifest）をS3に保存
+    count = len(meta["url"])
+    matrix_path = os.path.join(WORK_DIR, "index.npy")
+    _to_matrix(raw_path, count, dims, matrix_path)
+    os.remove(raw_path)
+    manifest = _write_binary_index(meta, matrix_path, version=version)
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+    _prune_versions(version)
+
+    # 4️⃣ 取り込んだ古い embeddings を削除（現行チャンクはすべて統合ファイルに入っている）
+    if COMPACT_EMBEDDINGS:
+        for key in keys:
+            if key != compact_key:
+                s3.delete_object(Bucket=BUCKET, Key=key)
+        print(f"🗑 Compacted {len(keys)} embedding files into {compact_key}")
+
+    # 5️⃣ シナリオ定型質問の回答事前生成（build_answers）を非同期で呼び出し
+    try:
+        answers_arn = os.getenv("ANSWERS_LAMBDA_ARN")
+        if answers_arn:
+            boto3.client("lambda").invoke(
+                FunctionName=answers_arn,
+                InvocationType="Event",  # 非同期実行
+                Payload=json.dumps({"trigger": "from_vector", "version": manifest["version"]})
+            )
+            print(f"🚀 Triggered build_answers ({answers_arn})")
+        else:
+            print("⚠️ ANSWERS_LAMBDA_ARN not set, skipping build_answers invoke")
+    except Exception as e:
+        print(f"⚠️ Failed to trigger build_answers: {e}")
 
     elapsed = (datetime.datetime.now(pytz.timezone("Asia/Tokyo")) - started).total_seconds()
-    print(f"💾 Saved merged index to s3://{BUCKET}/{out_key}")
-    print(f"🧩 Total vectors: {len(merged)}")
+    print(f"🧩 Total vectors: {count} (dims={manifest['dims']}, dtype={manifest['dtype']})")
     print(f"⏱ Elapsed: {elapsed:.1f}s")
 
-    return {"statusCode": 200, "body": f"OK ({len(merged)} vectors merged)"}
+    return {"statusCode": 200, "body": f"OK v{version} ({count} vectors merged, {stats['superseded']} superseded, "
+                                       f"{stats['removed_url'] + stats['stale_chunk']} removed, manifest ETag={manifest['etag']})"}
@@ -1,307 +1,2094 @@
-import os
-import re
-import json
-import math
-import boto3
-import traceback
-from datetime import datetime, timezone, timedelta
-from typing import Optional
-from openai import OpenAI
-
-# ====== 設定 ======
-S3_BUCKET = os.getenv("S3_BUCKET", "chat-for-vill-reference")
-VECTOR_KEY = os.getenv("VECTOR_KEY", "vector/index.jsonl")
-CACHE_PREFIX = os.getenv("CACHE_PREFIX", "cache/")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-
-oa = OpenAI(api_key=OPENAI_API_KEY)
-s3 = boto3.client("s3")
-
-_VECTOR_INDEX = None
-_CACHE_MAP = None
-
-
-# ====== Cosine類似度 ======
-def _cosine(a, b):
-    dot = sum(x * y for x, y in zip(a, b))
-    na = math.sqrt(sum(x * x for x in a))
-    nb = math.sqrt(sum(y * y for y in b))
-    return dot / (na * nb) if na and nb else 0.0
-
-
-# ====== ベクトル・キャッシュ読込 ======
-def _load_vector_index():
-    global _VECTOR_INDEX
-    if _VECTOR_INDEX is not None:
-        return _VECTOR_INDEX
-
-    prefix = os.getenv("VECTOR_PREFIX", "vector/")
-    print(f"[DEBUG] loading all vector files from s3://{S3_BUCKET}/{prefix}")
-
-    _VECTOR_INDEX = []
-    resp = s3.list_objects_v2(Bucket=S3_BUCKET, Prefix=prefix)
-    if "Contents" not in resp:
-        print(f"[WARN] no vector objects found under {prefix}")
-        return _VECTOR_INDEX
-
-    for obj in resp["Contents"]:
-        key = obj["Key"]
-        if not key.endswith(".jsonl"):
-            continue
-        try:
-            body = s3.get_object(Bucket=S3_BUCKET, Key=key)["Body"].read().decode("utf-8")
-            for line in body.splitlines():
-                if not line.strip():
-                    continue
-                rec = json.loads(line)
-                _VECTOR_INDEX.append(rec)
-            print(f"[LOAD] vector file loaded: {key}")
-        except Exception as e:
-            print(f"[WARN] failed to load {key}: {e}")
-
-    print(f"[LOAD] total vector_index entries={len(_VECTOR_INDEX)}")
-    return _VECTOR_INDEX
-
-
-def _load_cache_map():
-    global _CACHE_MAP
-    if _CACHE_MAP is not None:
-        return _CACHE_MAP
-
-    print(f"[DEBUG] loading all cache files from s3://{S3_BUCKET}/{CACHE_PREFIX}")
-    _CACHE_MAP = {}
-
-    resp = s3.list_objects_v2(Bucket=S3_BUCKET, Prefix=CACHE_PREFIX)
-    if "Contents" not in resp:
-        print(f"[WARN] no cache objects found under {CACHE_PREFIX}")
-        return _CACHE_MAP
-
-    for obj in resp["Contents"]:
-        key = obj["Key"]
-        if not key.endswith(".jsonl"):
-            continue
-
-        try:
-            body = s3.get_object(Bucket=S3_BUCKET, Key=key)["Body"].read().decode("utf-8")
-            for line in body.splitlines():
-                if not line.strip():
-                    continue
-                r = json.loads(line)
-                url = r.get("url")
-                ci = int(r.get("chunk_index", 0))
-                content = r.get("content", "")
-                if url and content:
-                    _CACHE_MAP[(url, ci)] = content
-            print(f"[LOAD] cache file loaded: {key}")
-        except Exception as e:
-            print(f"[WARN] failed to load {key}: {e}")
-
-    print(f"[LOAD] total cache_map entries={len(_CACHE_MAP)}")
-    return _CACHE_MAP
-
-def _detect_year_from_query(query: str):
-    """質問文から対象年（西暦）を推定"""
-    jst = timezone(timedelta(hours=9))
-    now = datetime.now(jst)
-    current_year = now.year
-
-    if m := re.search(r"令和\s*(\d+)", query):
-        return 2018 + int(m.group(1))
-    if m := re.search(r"20\d{2}", query):
-        return int(m.group(0))
-    if "今年" in query:
-        return current_year
-    if "昨年" in query or "去年" in query:
-        return current_year - 1
-    if "来年" in query:
-        return current_year + 1
-    return current_year
-
-
-def _detect_year_from_text(text: str):
-    """本文・URL・ファイル名から年度を推定（令和 or 西暦）
-       URL末尾やファイル名（例: /2025/09/file.pdf）も確実に対象に含める"""
-    if not text:
-        return None
-
-    # 令和 → 西暦換算
-    if m := re.search(r"令和\s*(\d+)", text):
-        return 2018 + int(m.group(1))
-
-    # 西暦 → URLやファイル名にも対応（/2025/, _2024, 2023.pdfなど）
-    if m := re.search(r"(20\d{2})", text):
-        year = int(m.group(1))
-        now_year = datetime.now(timezone(timedelta(hours=9))).year
-        if 2000 <= year <= now_year + 1:
-            return year
-
-    return None
-
-
-
-def _search_from_vector(query, top_k=20):
-    """ベクトル類似検索：最新情報を優先しつつ、HTMLとPDFをバランスよく扱う"""
-    emb_q = oa.embeddings.create(
-        model="text-embedding-3-small",
-        input=query
-    ).data[0].embedding
-
-    index = _load_vector_index()
-    query_year = _detect_year_from_query(query)
-
-    jst = timezone(timedelta(hours=9))
-    now = datetime.now(jst)
-    current_year = now.year
-
-    print(f"[SEARCH] query='{query}' (target_year={query_year})")
-
-    # === 1️⃣ 全スコアをまず算出して表示 ===
-    raw_scored = []
-    for r in index:
-        url = r.get("url", "")
-        score = _cosine(emb_q, r["embedding"])
-        raw_scored.append((score, url))
-    raw_scored.sort(key=lambda x: x[0], reverse=True)
-
-    print("───[ RAW COSINE SCORES (TOP 20) ]───")
-    for i, (s, u) in enumerate(raw_scored[:20], start=1):
-        print(f"  {i:02d}. {u[:80]}  score={s:.3f}")
-    print("───────────────────────────────────")
-
-    # === 2️⃣ 類似度0.8未満をカット ===
-    scored = []
-    for r in index:
-        url = r.get("url", "")
-        file_name = os.path.basename(url)
-        preview = (r.get("preview") or "") + " " + url + " " + file_name
-        score = _cosine(emb_q, r["embedding"])
-        if score < 0.80:
-            continue
-
-        # 年を本文・URL・ファイル名から推定
-        page_year = _detect_year_from_text(preview)
-        if page_year is None:
-            page_year = current_year
-
-        # 📆 年度補正
-        diff = page_year - current_year
-        if diff == 0:
-            score += 0.20
-        elif diff == -1:
-            score += 0.05
-        elif diff <= -2:
-            score -= 0.10
-
-        # 🆕 post番号による微加点
-        if m := re.search(r"post-(\d+)", url):
-            score += int(m.group(1)) / 2_000_000.0
-
-        # 📰 HTML / 📄 PDF 優先順位
-        if url.lower().endswith(".pdf"):
-            score -= 0.05
-            if page_year == current_year:
-                score += 0.20
-            elif page_year > current_year:
-                score += 0.30
-        else:
-            score += 0.10
-
-        # 🔍 キーワード一致補正
-        for kw in re.findall(r"[一-龠ぁ-んァ-ンa-zA-Z0-9]+", query):
-            if kw in preview:
-                score += 0.03
-
-        scored.append((score, r))
-
-    # === 3️⃣ 並べ替えて上位Nを返す ===
-    scored.sort(key=lambda x: x[0], reverse=True)
-    hits = [r for _, r in scored[:top_k]]
-
-    print(f"[SEARCH] top={len(hits)} results (最新優先＋0.8cut＋再スコア)")
-    for i, (s, r) in enumerate(scored[:5], start=1):
-        y = _detect_year_from_text(r.get("url", "") or "")
-        print(f"  {i}. {r.get('url')}  year={y}  score={s:.3f}")
-
-    return hits
-
-
-# ====== 現在日時をプロンプトに反映 ======
-def _with_current_date(base_prompt: str) -> str:
-    jst = timezone(timedelta(hours=9))
-    now = datetime.now(jst)
-    reiwa = now.year - 2018
-    date_str = f"{now.year}年{now.month}月{now.day}日（令和{reiwa}年）"
-    return (
-        base_prompt.strip()
-        + f"\n\n# 現在日時: {date_str}\n"
-        "「今年」「来年」「昨年」などの表現は、必ずこの日付を基準に判断すること。\n"
-        "古い資料を参照する場合は、その旨を明示して補足すること。"
-    )
-
-
-# ====== 回答生成 ======
-def generate_reply(user_message, config, prompt):
-    hits = _search_from_vector(user_message)
-    cache = _load_cache_map()
-
-    ctx_blocks, sources = [], []
-    for h in hits:
-        url = h["url"]
-        ci = int(h["chunk_index"])
-        content = cache.get((url, ci), "")
-        if content:
-            ctx_blocks.append(f"URL: {url}\n{content[:1000]}")
-            sources.append({"url": url, "chunk_index": ci})
-    ctx = "\n\n".join(ctx_blocks) if ctx_blocks else "(関連本文なし)"
-
-    system_prompt = _with_current_date(
-        prompt or "あなたは東成瀬村の情報に基づいて答えるアシスタントです。"
-    ) + "\nWebページを最優先に使い、PDFは最終手段としてのみ利用すること。"
-
-    user_prompt = f"質問: {user_message}\n\n以下は東成瀬村の公式サイト等からの資料じゃ。これ以外を根拠にしてはならぬ。\n\n{ctx}"
-
-    resp = oa.chat.completions.create(
-        model="gpt-4o-mini",
-        temperature=0.2,
-        max_tokens=800,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-    )
-    reply = resp.choices[0].message.content.strip()
-    print(f"[GEN] reply_len={len(reply)} sources={len(sources)}")
-    return reply, sources
-
-
-# ====== Lambda handler ======
-def lambda_handler(event, context):
-    try:
-        payload = json.loads(event.get("body") or "{}")
-        message = payload.get("message", "").strip()
-        if not message:
-            return {"statusCode": 400, "body": json.dumps({"error": "message required"})}
-
-        config = payload.get("config", {})
-        prompt = payload.get("prompt", "")
-        options = [{"label": "トップに戻る", "next": "restart"}]
-
-        reply, sources = generate_reply(message, config, prompt)
-        return {
-            "statusCode": 200,
-            "body": json.dumps(
-                {
-                    "reply": reply, 
-                    "sources": sources,
-                    "options": options
-                    }, 
-                    ensure_ascii=False)
-        }
-
-    except Exception as e:
-        print("❌ ERROR:", repr(e))
-        traceback.print_exc()
-        return {
-            "statusCode": 500,
-            "body": json.dumps({"error": "internal_error", "detail": str(e)}, ensure_ascii=False)
-        }
+import io
+import os
+import asyncio
+import re
+import json
+import random
+import hashlib
+import time
+import shutil
+import threading
+import contextvars
+import unicodedata
+import boto3
+import numpy as np
+import traceback
+from datetime import datetime, timezone, timedelta
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Optional
+from botocore.config import Config
+from openai import OpenAI, APITimeoutError
+
+# ====== 設定 ======
+S3_BUCKET = os.getenv("S3_BUCKET", "chat-for-vill-reference")
+VECTOR_KEY = os.getenv("VECTOR_KEY", "vector/index.jsonl")
+VECTOR_MANIFEST_KEY = os.getenv("VECTOR_MANIFEST_KEY", "vector/manifest.json")
+LOCAL_VECTOR_DIR = os.getenv("LOCAL_VECTOR_DIR", "/tmp/vector")
+VERIFY_VECTOR_CHECKSUM = os.getenv("VERIFY_VECTOR_CHECKSUM", "1") == "1"
+INDEX_POLL_SEC = float(os.getenv("INDEX_POLL_SEC", "60"))  # manifest の更新確認（HEAD）の最短間隔（0 = 確認しない）
+CHUNK_CACHE_SIZE = int(os.getenv("CHUNK_CACHE_SIZE", "256"))
+CHUNK_RANGE_GAP = int(os.getenv("CHUNK_RANGE_GAP", str(64 * 1024)))  # これ以下の隙間は1回のRange取得にまとめる
+CACHE_PREFIX = os.getenv("CACHE_PREFIX", "cache/")
+ANSWERS_PREFIX = os.getenv("ANSWERS_PREFIX", "answers/")
+ANSWERS_RETRY_SEC = float(os.getenv("ANSWERS_RETRY_SEC", "60"))  # 事前生成回答がまだ無い版を再確認するまでの秒数
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "8"))  # IVF で走査するクラスタ数（0 = 常に全件走査）
+USE_COARSE = os.getenv("USE_COARSE", "1") == "1"  # coarse.npz があれば一次走査に使い、index.npy はダウンロードしない
+RERANK_K = int(os.getenv("RERANK_K", "200"))      # 一次走査の上位何件を全精度ベクトルで再計算するか
+VECTOR_ROW_CACHE_SIZE = int(os.getenv("VECTOR_ROW_CACHE_SIZE", "4096"))  # 取得済み全精度ベクトル行の LRU 件数
+SHARD_LAZY_LOAD = os.getenv("SHARD_LAZY_LOAD", "1") == "1"  # シャード化された index.npy は必要なシャードだけ取得
+SHARD_RECALL_TARGET = int(os.getenv("SHARD_RECALL_TARGET", "5"))  # 絞り込んだシャードで類似度0.8以上の資料URLがこれ未満なら全年に広げる（config.json の max_sources があればそちら）
+BM25_TOP_K = int(os.getenv("BM25_TOP_K", "50"))  # 語彙検索側で融合に回す上位件数
+HYBRID_MIN_COSINE = float(os.getenv("HYBRID_MIN_COSINE", "0.75"))  # 語彙一致のみで採用する行の最低類似度
+RRF_K = int(os.getenv("RRF_K", "60"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "4000"))  # プロンプトの資料部分に使うトークン数の上限（概算）
+CONTEXT_CHUNK_CHARS = int(os.getenv("CONTEXT_CHUNK_CHARS", "1000"))    # 1チャンクあたりの最大文字数
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))     # MMR：1 に近いほど検索順位、0 に近いほど多様性を重視
+CONTEXT_DEDUP_SIM = float(os.getenv("CONTEXT_DEDUP_SIM", "0.95"))      # 採用済みの資料とのコサインがこれ以上なら重複として除外
+CONTEXT_MIN_TAIL_TOKENS = 200  # 予算の残りがこれ未満なら、入りきらない資料を切り詰めてまで入れない
+LOAD_CONCURRENCY = int(os.getenv("LOAD_CONCURRENCY", "8"))
+PRELOAD_ON_INIT = os.getenv("PRELOAD_ON_INIT", "1") == "1"  # Lambda 初期化フェーズでインデックスを先読み
+STAGE_CONCURRENCY = int(os.getenv("STAGE_CONCURRENCY", "16"))  # 1リクエスト内で並行に進める処理（embedding・範囲取得）のスレッド数
+EMBED_TIMEOUT = float(os.getenv("EMBED_TIMEOUT", "3"))   # 質問の embedding をこの秒数待っても得られなければ語彙検索のみで回答
+CHUNK_TIMEOUT = float(os.getenv("CHUNK_TIMEOUT", "5"))   # 本文チャンク取得の待ち上限（間に合わなかった資料は使わない）
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))      # 回答生成（chat.completions）のタイムアウト
+S3_MAX_POOL = int(os.getenv("S3_MAX_POOL", "64"))         # S3 の keep-alive 接続数（同時に使うスレッド数より少ないと接続を張り直す）
+S3_READ_TIMEOUT = float(os.getenv("S3_READ_TIMEOUT", "10"))
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-small")
+
+# クエリ embedding キャッシュ（1段目: プロセス内LRU / 2段目: 共有ストア s3 / file / none）
+QUERY_EMBED_CACHE_SIZE = int(os.getenv("QUERY_EMBED_CACHE_SIZE", "512"))
+QUERY_EMBED_STORE = os.getenv("QUERY_EMBED_STORE", "s3")
+QUERY_EMBED_PREFIX = os.getenv("QUERY_EMBED_PREFIX", "query_embeddings/")
+QUERY_EMBED_DIR = os.getenv("QUERY_EMBED_DIR", "/tmp/query_embeddings")
+
+# 計測（CloudWatch EMF）とデバッグ出力
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "VillChat")
+DEBUG_SAMPLE_RATE = float(os.getenv("DEBUG_SAMPLE_RATE", "0"))  # スコア一覧などの詳細ログを出すリクエストの割合（1 = 全件）
+
+# サーバーモード（python 6-chat.py で常駐の HTTP サーバーとして起動する場合のみ使用）
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8080"))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "64"))           # S3・OpenAI 呼び出しなど同期処理を回すスレッド数
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "10"))       # 同時に届いた質問をまとめるための待ち時間
+BATCH_MAX_QUERIES = int(os.getenv("BATCH_MAX_QUERIES", "64"))     # 1回の embeddings.create・スコア計算にまとめる最大件数
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "32"))         # 同時に実行する LLM 呼び出しの上限
+LLM_MAX_WAITING = int(os.getenv("LLM_MAX_WAITING", "128"))        # LLM の空き待ちがこれ以上いれば即 503
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "10"))   # LLM の空き待ちがこの秒数を超えたら 503
+MAX_BODY_BYTES = int(os.getenv("MAX_BODY_BYTES", str(64 * 1024)))
+MAX_HEADERS = 100
+
+# どちらもプロセス内で使い回し、接続（keep-alive）をリクエスト間で再利用する
+oa = OpenAI(api_key=OPENAI_API_KEY)
+s3 = boto3.client("s3", config=Config(
+    max_pool_connections=S3_MAX_POOL,
+    tcp_keepalive=True,
+    connect_timeout=3,
+    read_timeout=S3_READ_TIMEOUT,
+    retries={"max_attempts": 3, "mode": "standard"},
+))
+
+_LOADER = ThreadPoolExecutor(max_workers=LOAD_CONCURRENCY)
+_STAGES = ThreadPoolExecutor(max_workers=STAGE_CONCURRENCY, thread_name_prefix="stage")  # リクエスト内の並行処理用
+_LOAD_LOCK = threading.Lock()
+_LOAD_TIMINGS = {}
+_INDEX_LOCK = threading.RLock()
+_MANIFEST = None
+_MANIFEST_ETAG = None
+_VECTOR_INDEX = None
+_RELOAD_LOCK = threading.Lock()
+_RELOAD = {"next_poll": 0.0, "running": False}
+_RELOAD_NOW_LOCK = threading.Lock()  # 版指定リクエストによるその場の読み直しは1つずつ
+_CACHE_MAP = None
+_ANSWERS = None
+_CHUNK_LRU = OrderedDict()
+_CHUNK_LOCK = threading.Lock()
+_EMBED_LRU = OrderedDict()
+_EMBED_LOCK = threading.Lock()
+_EMBED_STATS = {"lru_hit": 0, "store_hit": 0, "miss": 0}
+_REQUEST = contextvars.ContextVar("request_trace", default=None)
+_PREFETCHED = contextvars.ContextVar("prefetched_search", default=None)  # サーバーモードでまとめて計算済みの embedding・スコア
+_COLD_START = True
+
+
+# ====== 計測（スパン・カウンタ → CloudWatch EMF） ======
+class _Trace:
+    """1リクエスト分の計測値。スパン（ms）とカウンタを名前ごとに積算する"""
+
+    def __init__(self, mode, cold, sampled):
+        self.mode = mode
+        self.cold = cold
+        self.sampled = sampled
+        self.spans = {}
+        self.counts = {}
+        self.started = time.perf_counter()
+        self.index = None  # このリクエストで使うインデックス（途中で差し替わっても同じ版を使い続ける）
+
+
+@contextmanager
+def _span(name):
+    """with _span("embed"): ... の区間の所要時間を現在のリクエストに記録（リクエスト外では何もしない）"""
+    trace = _REQUEST.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if trace is not None:
+            trace.spans[name] = trace.spans.get(name, 0.0) + (time.perf_counter() - started) * 1000
+
+
+def _count(name, n=1):
+    trace = _REQUEST.get()
+    if trace is not None:
+        trace.counts[name] = trace.counts.get(name, 0) + n
+
+
+def _debug_enabled():
+    """詳細ログを出すか（サンプリングされたリクエストのみ。リクエスト外は DEBUG_SAMPLE_RATE >= 1 の時だけ）"""
+    trace = _REQUEST.get()
+    return trace.sampled if trace is not None else DEBUG_SAMPLE_RATE >= 1
+
+
+def _debug(message):
+    if _debug_enabled():
+        print(message)
+
+
+def _ratio(hit, miss):
+    return round(hit / (hit + miss), 3) if hit + miss else None
+
+
+def _emit_metrics(trace):
+    """CloudWatch Embedded Metric Format の1行を出力（ログからメトリクスが自動生成される）"""
+    values = {f"{name}_ms": round(ms, 2) for name, ms in trace.spans.items()}
+    values["total_ms"] = round((time.perf_counter() - trace.started) * 1000, 2)
+    values.update(trace.counts)
+    c = trace.counts
+    hit_rates = {
+        "embed_cache_hit_rate": _ratio(c.get("embed_lru_hit", 0) + c.get("embed_store_hit", 0), c.get("embed_miss", 0)),
+        "chunk_cache_hit_rate": _ratio(c.get("chunk_cached", 0), c.get("chunk_fetched", 0)),
+    }
+    values.update({k: v for k, v in hit_rates.items() if v is not None})
+
+    metrics = [{"Name": k, "Unit": "Milliseconds" if k.endswith("_ms") else "None"} for k in values]
+    print(json.dumps({
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{"Namespace": METRICS_NAMESPACE, "Dimensions": [["Mode", "Start"]], "Metrics": metrics}],
+        },
+        "Mode": trace.mode,
+        "Start": "cold" if trace.cold else "warm",
+        "sampled": trace.sampled,
+        **values,
+    }, ensure_ascii=False))
+
+
+@contextmanager
+def _request_trace(mode):
+    """1リクエストの計測範囲。終了時に EMF を1行出力する"""
+    global _COLD_START
+    cold, _COLD_START = _COLD_START, False
+    trace = _Trace(mode, cold, random.random() < DEBUG_SAMPLE_RATE)
+    token = _REQUEST.set(trace)
+    try:
+        yield trace
+    finally:
+        _REQUEST.reset(token)
+        if METRICS_ENABLED:
+            _emit_metrics(trace)
+
+
+# ====== ベクトル正規化 ======
+def _normalize_rows(mat):
+    """各行をL2正規化（ゼロ行はそのまま）→ 内積＝コサイン類似度"""
+    norms = np.linalg.norm(mat, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return mat / norms
+
+
+# ====== S3ローダー（ページング・並列取得・計測） ======
+def _list_keys(prefix, suffix):
+    """prefix 配下のキーを全ページ分列挙（list_objects_v2 の1000件上限対策）"""
+    keys = []
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=S3_BUCKET, Prefix=prefix):
+        keys.extend(o["Key"] for o in page.get("Contents", []) if o["Key"].endswith(suffix))
+    return sorted(keys)
+
+
+def _timed(key, fn, *args):
+    """fn(*args) を実行し、所要時間を _LOAD_TIMINGS[key] に記録"""
+    started = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - started
+    with _LOAD_LOCK:
+        _LOAD_TIMINGS[key] = round(elapsed * 1000, 1)
+    print(f"[LOAD] {key} {elapsed * 1000:.0f}ms")
+    return result
+
+
+def _get_bytes(key):
+    return s3.get_object(Bucket=S3_BUCKET, Key=key)["Body"].read()
+
+
+def _fetch_parallel(keys, parse):
+    """複数オブジェクトを並列に取得・parse(key, bytes) する。失敗したファイルは警告して除外
+       戻り値はキー順の [(key, 結果)]"""
+    def work(key):
+        try:
+            return key, _timed(key, lambda: parse(key, _get_bytes(key)))
+        except Exception as e:
+            print(f"[WARN] failed to load {key}: {e}")
+            return key, None
+
+    return [(k, r) for k, r in _LOADER.map(work, keys) if r is not None]
+
+
+def _submit(fn, *args):
+    """リクエスト内の独立した処理を _STAGES で先に走らせる（計測コンテキストを引き継ぐ）"""
+    return _STAGES.submit(contextvars.copy_context().run, fn, *args)
+
+
+def _map_stages(fn, items):
+    """items それぞれの fn を _STAGES で並行に実行して結果を順に返す（1件ならその場で実行）"""
+    if len(items) <= 1:
+        return [fn(x) for x in items]
+    return [f.result() for f in [_submit(fn, x) for x in items]]
+
+
+def _await(future, deadline, stage):
+    """deadline（time.monotonic）までに future の結果を返す。間に合わなければ None（<stage>_timeout を記録）
+       処理自体は打ち切らないので、遅れて届いた embedding などはキャッシュに残る"""
+    try:
+        return future.result(timeout=max(deadline - time.monotonic(), 0))
+    except (FutureTimeoutError, APITimeoutError):
+        _count(f"{stage}_timeout")
+        return None
+
+
+def load_timings():
+    """ファイル単位の読込時間（ms）"""
+    with _LOAD_LOCK:
+        return dict(_LOAD_TIMINGS)
+
+
+# ====== ベクトル・キャッシュ読込 ======
+def _sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _fetch_manifest():
+    """vector/manifest.json とその ETag を取得（無ければ ({}, None) → 旧 JSONL 形式で読込）"""
+    try:
+        obj = _timed(VECTOR_MANIFEST_KEY, lambda: s3.get_object(Bucket=S3_BUCKET, Key=VECTOR_MANIFEST_KEY))
+    except s3.exceptions.NoSuchKey:
+        return {}, None
+    return json.loads(obj["Body"].read().decode("utf-8")), obj.get("ETag")
+
+
+def _load_manifest():
+    global _MANIFEST, _MANIFEST_ETAG
+    with _INDEX_LOCK:
+        if _MANIFEST is None:
+            _MANIFEST, _MANIFEST_ETAG = _fetch_manifest()
+    return _MANIFEST
+
+
+def _head_manifest_etag():
+    """manifest.json の ETag だけを HEAD で確認（無ければ None）"""
+    try:
+        return s3.head_object(Bucket=S3_BUCKET, Key=VECTOR_MANIFEST_KEY).get("ETag")
+    except Exception as e:
+        code = getattr(e, "response", {}).get("Error", {}).get("Code")
+        if isinstance(e, s3.exceptions.NoSuchKey) or code in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+
+
+def _download_matrix(manifest):
+    """npy 行列を /tmp に落として mmap で開く（ウォームコンテナでは再ダウンロードしない）"""
+    key = manifest["files"]["matrix"]
+    local_dir = os.path.join(LOCAL_VECTOR_DIR, str(manifest["version"]))
+    os.makedirs(local_dir, exist_ok=True)
+    path = os.path.join(local_dir, os.path.basename(key))
+
+    expected = manifest.get("checksum", {}).get("matrix")
+    if not os.path.exists(path):
+        s3.download_file(S3_BUCKET, key, path + ".part")
+        if VERIFY_VECTOR_CHECKSUM and expected and _sha256_file(path + ".part") != expected:
+            os.remove(path + ".part")
+            raise ValueError(f"checksum mismatch: {key}")
+        os.replace(path + ".part", path)
+
+    matrix = np.load(path, mmap_mode="r")
+    if matrix.dtype != np.float32:
+        # float16 保存時は転送・保存量のみ半減、演算は float32 で行う
+        matrix = matrix.astype(np.float32)
+    if not manifest.get("normalized"):
+        matrix = _normalize_rows(np.asarray(matrix, dtype=np.float32))
+    return matrix
+
+
+class _RemoteMatrix:
+    """S3 上の index.npy を必要な行だけバイト範囲指定で読む行列（一次走査を coarse.npz で行う場合の再スコア用）
+       matrix[rows] で (len(rows), d) の float32 を返す。近接する行は1回の GetObject にまとめ、取得済みの行は LRU に保持"""
+
+    def __init__(self, manifest):
+        self.key = manifest["files"]["matrix"]
+        self.version = manifest["version"]
+        self.offset = int(manifest["matrix_offset"])
+        self.dtype = np.dtype(manifest.get("dtype", "float32")).newbyteorder("<")
+        self.shape = (int(manifest["count"]), int(manifest["dims"]))
+        self.ndim = 2
+        self.row_bytes = self.shape[1] * self.dtype.itemsize
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, rows):
+        rows = np.atleast_1d(np.asarray(rows, dtype=np.int64))
+        out = np.empty((len(rows), self.shape[1]), dtype=np.float32)
+        missing = set()
+        with self._lock:
+            for i, r in enumerate(rows.tolist()):
+                vec = self._lru.get(r)
+                if vec is None:
+                    missing.add(r)
+                else:
+                    self._lru.move_to_end(r)
+                    out[i] = vec
+
+        # 行番号順に並べ、隙間が CHUNK_RANGE_GAP 以下なら同じ範囲にまとめる
+        gap_rows = max(1, CHUNK_RANGE_GAP // self.row_bytes)
+        groups = []
+        for r in sorted(missing):
+            if groups and r - groups[-1][1] <= gap_rows:
+                groups[-1][1] = r
+            else:
+                groups.append([r, r])
+
+        def fetch(group):
+            first, last = group
+            start = self.offset + first * self.row_bytes
+            body = s3.get_object(
+                Bucket=S3_BUCKET, Key=self.key, Range=f"bytes={start}-{start + (last - first + 1) * self.row_bytes - 1}"
+            )["Body"].read()
+            block = np.frombuffer(body, dtype=self.dtype).reshape(-1, self.shape[1]).astype(np.float32)
+            return {r: block[r - first] for r in range(first, last + 1) if r in missing}
+
+        # 範囲ごとの GetObject は並行に
+        fetched = {}
+        for part in _map_stages(fetch, groups):
+            fetched.update(part)
+
+        with self._lock:
+            for r, vec in fetched.items():
+                self._lru[r] = vec
+            while len(self._lru) > VECTOR_ROW_CACHE_SIZE:
+                self._lru.popitem(last=False)
+        for i, r in enumerate(rows.tolist()):
+            if r in fetched:
+                out[i] = fetched[r]
+        _count("rerank_rows_fetched", len(fetched))
+        _count("rerank_rows_cached", len(rows) - len(fetched))
+        _count("rerank_ranges", len(groups))
+        return out
+
+    def cached(self, rows):
+        """取得済み（LRU にある）行だけを返す。S3 は読まない。戻り値: {row: vec}"""
+        with self._lock:
+            return {r: self._lru[r] for r in rows if r in self._lru}
+
+
+class _ShardedMatrix:
+    """シャード（サイト×推定年）単位で index.npy の行範囲を必要になった時に取得する行列
+       取得したシャードはインデックスの版が変わるまで保持する。matrix.shard(i) でシャード i の (行数, d)、
+       matrix[rows] / matrix[start:end] で任意の行を float32 で返す（未取得のシャードの行はシャードごと取得せず、
+       _RemoteMatrix と同じく行のバイト範囲だけを読む）"""
+
+    def __init__(self, manifest):
+        self.key = manifest["files"]["matrix"]
+        self.offset = int(manifest["matrix_offset"])
+        self.dtype = np.dtype(manifest.get("dtype", "float32")).newbyteorder("<")
+        self.shape = (int(manifest["count"]), int(manifest["dims"]))
+        self.ndim = 2
+        self.row_bytes = self.shape[1] * self.dtype.itemsize
+        self.bounds = [(sh["start"], sh["end"]) for sh in manifest["shards"]]
+        self.ends = np.asarray([end for _, end in self.bounds], dtype=np.int64)
+        self._loaded = {}
+        self._locks = [threading.Lock() for _ in self.bounds]  # 別々のシャードは並行に取得できるようシャードごと
+        self._rows = _RemoteMatrix(manifest)  # 未取得のシャードの行を読む（資料の重複判定・IVF 候補など少数の行用）
+
+    def load(self, ids):
+        """未取得のシャードをまとめて並行に取得しておく"""
+        _map_stages(self.shard, [int(i) for i in ids if int(i) not in self._loaded])
+
+    def shard(self, i):
+        block = self._loaded.get(i)
+        if block is not None:
+            return block
+        with self._locks[i]:
+            block = self._loaded.get(i)
+            if block is None:
+                start, end = self.bounds[i]
+                first = self.offset + start * self.row_bytes
+                body = s3.get_object(
+                    Bucket=S3_BUCKET, Key=self.key, Range=f"bytes={first}-{first + (end - start) * self.row_bytes - 1}"
+                )["Body"].read()
+                block = np.frombuffer(body, dtype=self.dtype).reshape(-1, self.shape[1]).astype(np.float32, copy=False)
+                self._loaded[i] = block
+                _count("shards_loaded")
+        return block
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            rows = np.arange(*key.indices(self.shape[0]))
+        else:
+            rows = np.atleast_1d(np.asarray(key, dtype=np.int64))
+        out = np.empty((len(rows), self.shape[1]), dtype=np.float32)
+        ids = np.searchsorted(self.ends, rows, side="right")
+        remote = np.ones(len(rows), dtype=bool)
+        for i in np.unique(ids):
+            block = self._loaded.get(int(i))
+            if block is not None:
+                sel = ids == i
+                out[sel] = block[rows[sel] - self.bounds[i][0]]
+                remote &= ~sel
+        if remote.any():
+            out[remote] = self._rows[rows[remote]]
+        return out
+
+    def cached(self, rows):
+        """取得済みのシャードと行 LRU にある行だけを返す。S3 は読まない。戻り値: {row: vec}"""
+        found = self._rows.cached(rows)
+        for r in rows:
+            i = int(np.searchsorted(self.ends, r, side="right"))
+            block = self._loaded.get(i)
+            if block is not None:
+                found[r] = block[r - self.bounds[i][0]]
+        return found
+
+
+def _parse_npz(key, body):
+    with np.load(io.BytesIO(body)) as npz:
+        return {name: npz[name] for name in npz.files}
+
+
+def _load_binary_index(manifest):
+    """manifest が指す各ファイル（行列・メタ・特徴量・チャンク表）を並列に取得"""
+    files = manifest["files"]
+    use_coarse = USE_COARSE and "coarse" in files and "matrix_offset" in manifest
+    use_shards = not use_coarse and SHARD_LAZY_LOAD and bool(manifest.get("shards")) and "matrix_offset" in manifest
+    if use_coarse or use_shards:
+        matrix_future = None
+    else:
+        matrix_future = _LOADER.submit(_timed, files["matrix"], _download_matrix, manifest)
+    meta_future = _LOADER.submit(_timed, files["meta"], lambda: json.loads(_get_bytes(files["meta"]).decode("utf-8")))
+    npz_futures = {
+        name: _LOADER.submit(_timed, files[name], lambda k=files[name], n=name: _parse_npz(k, _get_checked(manifest, n)))
+        for name in ("features", "chunks_index", "ivf", "bm25") + (("coarse",) if use_coarse else ())
+        if name in files
+    }
+    if "chunks_index" in files:
+        # chunks.bin は範囲取得だけなので中身は照合せず、大きさを HEAD で確かめる
+        size_future = _LOADER.submit(lambda: s3.head_object(Bucket=S3_BUCKET, Key=files["chunks"])["ContentLength"])
+
+    meta = meta_future.result()
+    if "features" in npz_futures and "match_text" in meta:
+        features = npz_futures["features"].result()
+    else:
+        features = _compute_features(meta)
+
+    chunks = None
+    if "chunks_index" in npz_futures:
+        table = npz_futures["chunks_index"].result()
+        _check_chunk_store(manifest, table, size_future.result())
+        chunks = {"key": files["chunks"], "offset": table["offset"], "length": table["length"]}
+    return {
+        "version": manifest["version"],
+        "meta": meta,
+        "matrix": _RemoteMatrix(manifest) if use_coarse else _ShardedMatrix(manifest) if use_shards else matrix_future.result(),
+        "coarse": dict(npz_futures["coarse"].result(), dims=manifest["coarse"]["dims"]) if use_coarse else None,
+        "features": features,
+        "chunks": chunks,
+        "ivf": npz_futures["ivf"].result() if "ivf" in npz_futures else None,
+        "bm25": _prepare_bm25(npz_futures["bm25"].result(), manifest.get("bm25", {})) if "bm25" in npz_futures else None,
+        "shards": _prepare_shards(manifest.get("shards")),
+    }
+
+
+def _get_checked(manifest, name):
+    """manifest の files[name] を取得し、チャンク表（chunks_index）は sha256 を照合する"""
+    key = manifest["files"][name]
+    body = _get_bytes(key)
+    expected = manifest.get("checksum", {}).get(name)
+    if name == "chunks_index" and VERIFY_VECTOR_CHECKSUM and expected and hashlib.sha256(body).hexdigest() != expected:
+        raise ValueError(f"checksum mismatch: {key}")
+    return body
+
+
+def _check_chunk_store(manifest, table, size):
+    """chunks.bin の大きさを manifest と照合し、チャンク表の範囲がその中に収まるか確かめる"""
+    key = manifest["files"]["chunks"]
+    expected = manifest.get("size", {}).get("chunks")
+    if expected is not None and int(size) != int(expected):
+        raise ValueError(f"size mismatch: {key} ({size} != {expected} bytes)")
+    if len(table["offset"]) and int((table["offset"] + table["length"]).max()) > int(size):
+        raise ValueError(f"chunk table exceeds {key} ({size} bytes)")
+
+
+def _prepare_shards(catalog):
+    """manifest のシャード表を配列にする（無ければ None）"""
+    if not catalog:
+        return None
+    return {
+        "site": [sh["site"] for sh in catalog],
+        "year": np.asarray([sh["year"] for sh in catalog], dtype=np.int32),
+        "start": np.asarray([sh["start"] for sh in catalog], dtype=np.int64),
+        "end": np.asarray([sh["end"] for sh in catalog], dtype=np.int64),
+    }
+
+
+def _parse_vector_jsonl(key, body):
+    rows = []
+    for line in body.decode("utf-8").splitlines():
+        if line.strip():
+            rows.append(json.loads(line))
+    return rows
+
+
+def _load_jsonl_index(prefix):
+    """旧形式：vector/*.jsonl を並列に読み込む"""
+    meta = {"url": [], "chunk_index": [], "preview": []}
+    vectors = []
+    keys = _list_keys(prefix, ".jsonl")
+    if not keys:
+        print(f"[WARN] no vector objects found under {prefix}")
+
+    for key, rows in _fetch_parallel(keys, _parse_vector_jsonl):
+        for rec in rows:
+            vectors.append(rec["embedding"])
+            meta["url"].append(rec.get("url", ""))
+            meta["chunk_index"].append(int(rec.get("chunk_index", 0)))
+            meta["preview"].append(rec.get("preview") or "")
+
+    if vectors:
+        matrix = _normalize_rows(np.asarray(vectors, dtype=np.float32))
+    else:
+        matrix = np.zeros((0, 0), dtype=np.float32)
+    return {
+        "version": None,
+        "meta": meta,
+        "matrix": matrix,
+        "features": _compute_features(meta),
+        "chunks": None,
+        "ivf": None,
+        "bm25": None,
+        "coarse": None,
+        "shards": None,
+    }
+
+
+def _load_vector_index():
+    """ベクトルインデックスを読み込む（初期化フェーズの先読みと同時に呼ばれても1回だけ読む）
+       戻り値: {"version", "meta": 列指向メタ情報, "matrix": 正規化済み float32 行列 (N, d),
+                "features": ランキング特徴量の列 (page_year / is_pdf / post_number),
+                "chunks": 本文チャンクストア {"key", "offset", "length"}（旧形式では None）,
+                "ivf": 近似最近傍索引 {"centroids", "offsets", "rows"}（無ければ None）,
+                "bm25": 文字 bigram 転置インデックス（無ければ None）,
+                "coarse": 一次走査用の切り詰め・量子化ベクトル {"vectors", "scale", "dims"}（無ければ None）,
+                "shards": サイト×推定年のシャード表 {"site", "year", "start", "end"}（無ければ None）}
+       coarse を使う場合 "matrix" は S3 から必要な行だけ読む _RemoteMatrix、シャード化されていれば
+       必要なシャードだけ読む _ShardedMatrix になる"""
+    global _VECTOR_INDEX
+    trace = _REQUEST.get()
+    if trace is not None and trace.index is not None:
+        return trace.index
+    if _VECTOR_INDEX is not None:
+        if trace is not None:
+            trace.index = _VECTOR_INDEX
+        return _VECTOR_INDEX
+
+    with _INDEX_LOCK:
+        if _VECTOR_INDEX is not None:
+            if trace is not None:
+                trace.index = _VECTOR_INDEX
+            return _VECTOR_INDEX
+
+        prefix = os.getenv("VECTOR_PREFIX", "vector/")
+        started = time.perf_counter()
+        manifest = _load_manifest()
+        if manifest:
+            print(f"[DEBUG] loading binary vector index v{manifest['version']} from s3://{S3_BUCKET}/{prefix}")
+            index = _load_binary_index(manifest)
+        else:
+            print(f"[DEBUG] loading all vector files from s3://{S3_BUCKET}/{prefix}")
+            index = _load_jsonl_index(prefix)
+
+        matrix = index["matrix"]
+        print(
+            f"[LOAD] total vector_index entries={matrix.shape[0]} dims={matrix.shape[1] if matrix.ndim == 2 else 0} "
+            f"elapsed={(time.perf_counter() - started) * 1000:.0f}ms"
+        )
+        _VECTOR_INDEX = index
+    if trace is not None:
+        trace.index = index
+    return index
+
+
+# ====== インデックスのホットリロード ======
+def _check_index_update():
+    """INDEX_POLL_SEC ごとに manifest の ETag を確認し、変わっていれば新しい版をバックグラウンドで読み込む
+       読み込み中・読み込み前のリクエストは今の版で処理を続ける"""
+    if INDEX_POLL_SEC <= 0 or _VECTOR_INDEX is None:
+        return
+    now = time.monotonic()
+    with _RELOAD_LOCK:
+        if _RELOAD["running"] or now < _RELOAD["next_poll"]:
+            return
+        _RELOAD["next_poll"] = now + INDEX_POLL_SEC
+    try:
+        etag = _head_manifest_etag()
+    except Exception as e:
+        print(f"[WARN] manifest check failed: {e}")
+        return
+    if etag == _MANIFEST_ETAG:
+        return
+    with _RELOAD_LOCK:
+        if _RELOAD["running"]:
+            return
+        _RELOAD["running"] = True
+    threading.Thread(target=_reload_index, name="index-reload", daemon=True).start()
+
+
+def _reload_index():
+    """新しい版を読み込み終えてから manifest とインデックスをまとめて差し替える（失敗時は今の版のまま）"""
+    global _MANIFEST, _MANIFEST_ETAG, _VECTOR_INDEX, _CACHE_MAP
+    try:
+        started = time.perf_counter()
+        manifest, etag = _fetch_manifest()
+        current = _VECTOR_INDEX
+        if not manifest or manifest.get("version") == current["version"]:
+            # 版が同じ（manifest の書き直しのみ）なら ETag だけ更新
+            with _INDEX_LOCK:
+                _MANIFEST_ETAG = etag
+            return
+        print(f"[RELOAD] loading vector index v{manifest['version']} (current v{current['version']})")
+        index = _load_binary_index(manifest)
+        with _INDEX_LOCK:
+            _MANIFEST, _MANIFEST_ETAG, _VECTOR_INDEX = manifest, etag, index
+            if index.get("chunks") is not None:
+                _CACHE_MAP = None  # 旧形式の本文辞書はもう使わない
+        print(
+            f"[RELOAD] swapped vector index v{current['version']} -> v{manifest['version']} "
+            f"entries={index['matrix'].shape[0]} elapsed={(time.perf_counter() - started) * 1000:.0f}ms"
+        )
+        # 古い版の /tmp 上の行列を削除（mmap 中の旧インデックスは参照が無くなるまで読める）
+        if os.path.isdir(LOCAL_VECTOR_DIR):
+            for name in os.listdir(LOCAL_VECTOR_DIR):
+                if name != str(manifest["version"]):
+                    shutil.rmtree(os.path.join(LOCAL_VECTOR_DIR, name), ignore_errors=True)
+    except Exception as e:
+        print(f"[WARN] index reload failed, keeping current version: {e}")
+        traceback.print_exc()
+    finally:
+        with _RELOAD_LOCK:
+            _RELOAD["running"] = False
+
+
+def _require_index_version(version):
+    """このリクエストで指定の版（7-build_answers が回答を保存する版）のインデックスを使う
+       読み込み済みの版と違えば公開中の manifest をその場で読み直す（それでも違えば今の版のまま。版は呼び出し側で確認する）"""
+    index = _load_vector_index()
+    if str(index["version"]) == str(version):
+        return index
+    with _span("index_reload"), _RELOAD_NOW_LOCK:
+        # バックグラウンドの読み込み中なら終わるのを待ってから確認（同じ版を2重に取得しない）
+        while True:
+            with _RELOAD_LOCK:
+                if not _RELOAD["running"]:
+                    _RELOAD["running"] = True
+                    break
+            time.sleep(0.05)
+        if str(_VECTOR_INDEX["version"]) != str(version):
+            print(f"[RELOAD] request expects v{version} but v{index['version']} is loaded; reloading now")
+            _reload_index()  # 終了時に running を戻す
+        else:
+            with _RELOAD_LOCK:
+                _RELOAD["running"] = False
+    index = _VECTOR_INDEX
+    trace = _REQUEST.get()
+    if trace is not None:
+        trace.index = index
+    return index
+
+
+def _index_row(index, j):
+    """列指向メタ情報から1行分のレコードを組み立てる"""
+    meta = index["meta"]
+    return {
+        "row": int(j),
+        "url": meta["url"][j],
+        "chunk_index": meta["chunk_index"][j],
+        "preview": meta["preview"][j],
+    }
+
+
+def _fetch_chunks(index, rows):
+    """ヒット行の本文だけをチャンクストアからバイト範囲指定で取得（LRU付き）
+       近接する範囲は1回の GetObject にまとめ、範囲ごとに並行して取得する。
+       CHUNK_TIMEOUT までに届かなかった範囲の行は含めない。戻り値: {row: content}"""
+    chunks = index["chunks"]
+    found, missing = {}, []
+    with _CHUNK_LOCK:
+        for j in rows:
+            content = _CHUNK_LRU.get((index["version"], j))
+            if content is not None:
+                _CHUNK_LRU.move_to_end((index["version"], j))
+                found[j] = content
+            elif chunks["offset"][j] >= 0:
+                missing.append(j)
+
+    # オフセット順に並べ、隙間が CHUNK_RANGE_GAP 以下なら同じ範囲にまとめる
+    missing.sort(key=lambda j: chunks["offset"][j])
+    groups = []
+    for j in missing:
+        start = int(chunks["offset"][j])
+        end = start + int(chunks["length"][j])
+        if groups and start - groups[-1][1] <= CHUNK_RANGE_GAP:
+            groups[-1][1] = max(groups[-1][1], end)
+            groups[-1][2].append(j)
+        else:
+            groups.append([start, end, [j]])
+
+    def fetch(group):
+        start, end, members = group
+        body = s3.get_object(
+            Bucket=S3_BUCKET, Key=chunks["key"], Range=f"bytes={start}-{end - 1}"
+        )["Body"].read()
+        part = {}
+        for j in members:
+            off = int(chunks["offset"][j]) - start
+            part[j] = body[off:off + int(chunks["length"][j])].decode("utf-8")
+        return part
+
+    deadline = time.monotonic() + CHUNK_TIMEOUT
+    fetched = {}
+    for future in [_submit(fetch, g) for g in groups]:
+        part = _await(future, deadline, "chunk")
+        if part is not None:
+            fetched.update(part)
+    if len(fetched) < len(missing):
+        print(f"[WARN] chunk fetch timed out: {len(missing) - len(fetched)} of {len(missing)} rows skipped")
+    found.update(fetched)
+
+    with _CHUNK_LOCK:
+        for j, content in fetched.items():
+            _CHUNK_LRU[(index["version"], j)] = content
+        while len(_CHUNK_LRU) > CHUNK_CACHE_SIZE:
+            _CHUNK_LRU.popitem(last=False)
+
+    _count("chunk_fetched", len(fetched))
+    _count("chunk_cached", len(rows) - len(missing))
+    _count("chunk_ranges", len(groups))
+    _debug(f"[CHUNK] rows={len(rows)} fetched={len(fetched)} ranges={len(groups)} cached={len(rows) - len(missing)}")
+    return found
+
+
+def _hit_contents(hits):
+    """ヒットした各行の本文を返す（チャンクストアが無い旧形式は cache/*.jsonl 全件読込）"""
+    index = _load_vector_index()
+    if index.get("chunks") is not None:
+        found = _fetch_chunks(index, [h["row"] for h in hits])
+        return [found.get(h["row"], "") for h in hits]
+    cache = _load_cache_map()
+    return [cache.get((h["url"], int(h["chunk_index"])), "") for h in hits]
+
+
+def _parse_cache_jsonl(key, body):
+    entries = {}
+    for line in body.decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        r = json.loads(line)
+        url = r.get("url")
+        content = r.get("content", "")
+        if url and content:
+            entries[(url, int(r.get("chunk_index", 0)))] = content
+    return entries
+
+
+def _load_cache_map():
+    """旧形式：cache/*.jsonl を並列に読み込み (url, chunk_index) → 本文 の辞書にする"""
+    global _CACHE_MAP
+    if _CACHE_MAP is not None:
+        return _CACHE_MAP
+
+    with _INDEX_LOCK:
+        if _CACHE_MAP is not None:
+            return _CACHE_MAP
+
+        print(f"[DEBUG] loading all cache files from s3://{S3_BUCKET}/{CACHE_PREFIX}")
+        keys = _list_keys(CACHE_PREFIX, ".jsonl")
+        if not keys:
+            print(f"[WARN] no cache objects found under {CACHE_PREFIX}")
+
+        cache_map = {}
+        for key, entries in _fetch_parallel(keys, _parse_cache_jsonl):
+            cache_map.update(entries)  # キー順（日付順）に上書き → 新しいファイルを優先
+
+        print(f"[LOAD] total cache_map entries={len(cache_map)}")
+        _CACHE_MAP = cache_map
+    return _CACHE_MAP
+
+
+def _detect_year_from_query(query: str):
+    """質問文から対象年（西暦）を推定"""
+    jst = timezone(timedelta(hours=9))
+    now = datetime.now(jst)
+    current_year = now.year
+
+    if m := re.search(r"令和\s*(\d+)", query):
+        return 2018 + int(m.group(1))
+    if m := re.search(r"20\d{2}", query):
+        return int(m.group(0))
+    if "今年" in query:
+        return current_year
+    if "昨年" in query or "去年" in query:
+        return current_year - 1
+    if "来年" in query:
+        return current_year + 1
+    return current_year
+
+
+def _detect_year_from_text(text: str):
+    """本文・URL・ファイル名から年度を推定（令和 or 西暦）
+       URL末尾やファイル名（例: /2025/09/file.pdf）も確実に対象に含める"""
+    if not text:
+        return None
+
+    # 令和 → 西暦換算
+    if m := re.search(r"令和\s*(\d+)", text):
+        return 2018 + int(m.group(1))
+
+    # 西暦 → URLやファイル名にも対応（/2025/, _2024, 2023.pdfなど）
+    if m := re.search(r"(20\d{2})", text):
+        year = int(m.group(1))
+        now_year = datetime.now(timezone(timedelta(hours=9))).year
+        if 2000 <= year <= now_year + 1:
+            return year
+
+    return None
+
+
+
+def _normalize_text(text: str):
+    """キーワード照合用の正規化（全角英数→半角、小文字化）"""
+    return unicodedata.normalize("NFKC", text or "").lower()
+
+
+def _compute_features(meta):
+    """features.npz が無い旧形式インデックス用：ランキング特徴量をその場で計算
+       （5-build_vector の _build_features と同じ定義。meta に match_text も追加する）"""
+    page_year, is_pdf, post_number, match_text = [], [], [], []
+    for url, preview in zip(meta["url"], meta["preview"]):
+        text = (preview or "") + " " + url + " " + os.path.basename(url)
+        page_year.append(_detect_year_from_text(text) or 0)
+        is_pdf.append(url.lower().endswith(".pdf"))
+        m = re.search(r"post-(\d+)", url)
+        post_number.append(int(m.group(1)) if m else 0)
+        match_text.append(_normalize_text(text))
+    meta["match_text"] = match_text
+    return {
+        "page_year": np.asarray(page_year, dtype=np.int16),
+        "is_pdf": np.asarray(is_pdf, dtype=bool),
+        "post_number": np.asarray(post_number, dtype=np.int32),
+    }
+
+
+# ====== 語彙検索（BM25） ======
+def _bigram_tokens(text: str):
+    """文字 bigram トークナイザ（日本語は分かち書きせず2文字ずつ、英数字は単語単位）"""
+    tokens = []
+    for run in re.findall(r"[一-龠々ぁ-んァ-ンー]+|[a-z0-9]+", _normalize_text(text)):
+        if run.isascii():
+            tokens.append(run)
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+# トークナイザの差し替え口（5-build_vector 側と同名・同定義にすること）
+_TOKENIZERS = {"bigram": _bigram_tokens}
+
+
+def _prepare_bm25(arrays, params):
+    """bm25.npz を検索用に整える（語彙 → 語ID の辞書、平均文書長など）"""
+    doc_len = arrays["doc_len"].astype(np.float32)
+    return {
+        "vocab": {t: i for i, t in enumerate(arrays["terms"].tolist())},
+        "term_ptr": arrays["term_ptr"],
+        "doc_ids": arrays["doc_ids"],
+        "tf": arrays["tf"].astype(np.float32),
+        "doc_len": doc_len,
+        "avgdl": float(doc_len.mean()) if doc_len.size else 1.0,
+        "tokenize": _TOKENIZERS[params.get("tokenizer", "bigram")],
+        "k1": float(params.get("k1", 1.2)),
+        "b": float(params.get("b", 0.75)),
+    }
+
+
+def _bm25_search(bm25, query, limit):
+    """クエリ語のポスティングだけを辿って BM25 スコアを計算し、上位 limit 行を返す"""
+    n_docs = bm25["doc_len"].shape[0]
+    ids, contrib = [], []
+    for term in set(bm25["tokenize"](query)):
+        t = bm25["vocab"].get(term)
+        if t is None:
+            continue
+        start, end = bm25["term_ptr"][t], bm25["term_ptr"][t + 1]
+        docs, tf = bm25["doc_ids"][start:end], bm25["tf"][start:end]
+        df = end - start
+        idf = np.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+        norm = bm25["k1"] * (1.0 - bm25["b"] + bm25["b"] * bm25["doc_len"][docs] / bm25["avgdl"])
+        ids.append(docs)
+        contrib.append(idf * tf * (bm25["k1"] + 1.0) / (tf + norm))
+    if not ids:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+    rows, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+    scores = np.bincount(inverse, weights=np.concatenate(contrib))
+    top = _top_indices(scores, limit)
+    return rows[top], scores[top]
+
+
+def _rrf_fuse(rankings, k):
+    """Reciprocal Rank Fusion：各ランキングでの順位から 1/(k+rank) を合算して並べ替える"""
+    fused = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking.tolist(), start=1):
+            fused[row] = fused.get(row, 0.0) + 1.0 / (k + rank)
+    ordered = sorted(fused.items(), key=lambda x: x[1], reverse=True)
+    return np.asarray([r for r, _ in ordered], dtype=np.int64), np.asarray([v for _, v in ordered])
+
+
+def _rescore(index, cand, base_scores, keywords, current_year):
+    """候補行に年度・PDF/HTML・post番号・キーワードの補正をまとめて配列演算で加える"""
+    features = index["features"]
+    page_year = features["page_year"][cand].astype(np.int32)
+    page_year = np.where(page_year > 0, page_year, current_year)
+    is_pdf = features["is_pdf"][cand]
+    score = base_scores.astype(np.float64)
+
+    # 📆 年度補正
+    diff = page_year - current_year
+    score += np.select([diff == 0, diff == -1, diff <= -2], [0.20, 0.05, -0.10], 0.0)
+
+    # 🆕 post番号による微加点
+    score += features["post_number"][cand] / 2_000_000.0
+
+    # 📰 HTML / 📄 PDF 優先順位
+    pdf_bonus = -0.05 + np.select([page_year == current_year, page_year > current_year], [0.20, 0.30], 0.0)
+    score += np.where(is_pdf, pdf_bonus, 0.10)
+
+    # 🔍 キーワード一致補正
+    if keywords:
+        match_text = index["meta"]["match_text"]
+        hits = [sum(kw in match_text[j] for kw in keywords) for j in cand]
+        score += 0.03 * np.asarray(hits, dtype=np.float64)
+    return score
+
+
+# ====== クエリ embedding キャッシュ ======
+def _normalize_query(text: str):
+    """キャッシュキー用の正規化（NFKC・前後空白除去・連続空白を1つに）"""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text or "")).strip()
+
+
+def _embed_cache_key(text: str, model: str):
+    return hashlib.sha256(f"{model}\n{_normalize_query(text)}".encode("utf-8")).hexdigest()
+
+
+def _s3_store_get(key):
+    try:
+        body = s3.get_object(Bucket=S3_BUCKET, Key=f"{QUERY_EMBED_PREFIX}{key}.f32")["Body"].read()
+    except s3.exceptions.NoSuchKey:
+        return None
+    return np.frombuffer(body, dtype="<f4")
+
+
+def _s3_store_put(key, vec):
+    s3.put_object(
+        Bucket=S3_BUCKET,
+        Key=f"{QUERY_EMBED_PREFIX}{key}.f32",
+        Body=vec.astype("<f4").tobytes(),
+        ContentType="application/octet-stream",
+    )
+
+
+def _file_store_get(key):
+    path = os.path.join(QUERY_EMBED_DIR, f"{key}.f32")
+    if not os.path.exists(path):
+        return None
+    return np.fromfile(path, dtype="<f4")
+
+
+def _file_store_put(key, vec):
+    os.makedirs(QUERY_EMBED_DIR, exist_ok=True)
+    path = os.path.join(QUERY_EMBED_DIR, f"{key}.f32")
+    vec.astype("<f4").tofile(path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+# 2段目ストアの差し替え口（KV等を追加する場合はここに get/put を登録）
+_EMBED_STORES = {
+    "s3": (_s3_store_get, _s3_store_put),
+    "file": (_file_store_get, _file_store_put),
+}
+
+
+def _embed_cache_get(key):
+    with _EMBED_LOCK:
+        vec = _EMBED_LRU.get(key)
+        if vec is not None:
+            _EMBED_LRU.move_to_end(key)
+            _EMBED_STATS["lru_hit"] += 1
+            _count("embed_lru_hit")
+            return vec
+
+    store = _EMBED_STORES.get(QUERY_EMBED_STORE)
+    if store:
+        try:
+            vec = store[0](key)
+        except Exception as e:
+            print(f"[WARN] query embedding store get failed: {e}")
+            vec = None
+        if vec is not None:
+            _embed_cache_put(key, vec, persist=False)
+            with _EMBED_LOCK:
+                _EMBED_STATS["store_hit"] += 1
+            _count("embed_store_hit")
+            return vec
+    return None
+
+
+def _embed_cache_put(key, vec, persist=True):
+    with _EMBED_LOCK:
+        _EMBED_LRU[key] = vec
+        _EMBED_LRU.move_to_end(key)
+        while len(_EMBED_LRU) > QUERY_EMBED_CACHE_SIZE:
+            _EMBED_LRU.popitem(last=False)
+
+    store = _EMBED_STORES.get(QUERY_EMBED_STORE)
+    if persist and store:
+        # 共有ストアへの書き込みは待たずに返す（S3 の往復を応答時間に含めない）
+        _LOADER.submit(_embed_store_put, store[1], key, vec)
+
+
+def _embed_store_put(put, key, vec):
+    try:
+        put(key, vec)
+    except Exception as e:
+        print(f"[WARN] query embedding store put failed: {e}")
+
+
+def _embed_query(query: str):
+    """クエリを embedding 化（LRU → 共有ストア → OpenAI の順に参照）"""
+    key = _embed_cache_key(query, EMBED_MODEL)
+    vec = _embed_cache_get(key)
+    if vec is None:
+        with _EMBED_LOCK:
+            _EMBED_STATS["miss"] += 1
+        _count("embed_miss")
+        emb = oa.embeddings.create(model=EMBED_MODEL, input=_normalize_query(query)).data[0].embedding
+        vec = np.asarray(emb, dtype=np.float32)
+        _embed_cache_put(key, vec)
+
+    total = sum(_EMBED_STATS.values())
+    hits = _EMBED_STATS["lru_hit"] + _EMBED_STATS["store_hit"]
+    _debug(
+        f"[EMBED] cache lru_hit={_EMBED_STATS['lru_hit']} store_hit={_EMBED_STATS['store_hit']} "
+        f"miss={_EMBED_STATS['miss']} hit_rate={hits / total:.2f}"
+    )
+    return vec
+
+
+def _embed_queries(queries):
+    """複数クエリを embedding 化。キャッシュに無いもの（同じ文は1つにまとめる）だけを1回の API 呼び出しで取得"""
+    keys = [_embed_cache_key(q, EMBED_MODEL) for q in queries]
+    vecs = list(_LOADER.map(_embed_cache_get, keys))
+    missing = {}
+    for i, (q, vec) in enumerate(zip(queries, vecs)):
+        if vec is None:
+            missing.setdefault(_normalize_query(q), []).append(i)
+    if missing:
+        with _EMBED_LOCK:
+            _EMBED_STATS["miss"] += len(missing)
+        texts = list(missing)
+        data = sorted(oa.embeddings.create(model=EMBED_MODEL, input=texts).data, key=lambda d: d.index)
+        for text, item in zip(texts, data):
+            vec = np.asarray(item.embedding, dtype=np.float32)
+            for i in missing[text]:
+                vecs[i] = vec
+            _embed_cache_put(keys[missing[text][0]], vec)
+    return vecs
+
+
+def _top_indices(scores, k):
+    """argpartition で上位k件のインデックスをスコア降順で返す（全件ソートしない）"""
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx])]
+
+
+def _ivf_candidates(ivf, q, nprobe):
+    """クエリに近い nprobe 個のクラスタに属する行番号（昇順）を返す"""
+    probe = _top_indices(ivf["centroids"] @ q, nprobe)
+    offsets, rows = ivf["offsets"], ivf["rows"]
+    return np.sort(np.concatenate([rows[offsets[c]:offsets[c + 1]] for c in probe]))
+
+
+def _coarse_scores(coarse, q, rows=None, block=65536):
+    """切り詰め・量子化ベクトルでの近似コサイン（クエリも同じ次元に切り詰めて再正規化）
+       int8 → float32 の変換はブロック単位で行い、一時メモリを抑える"""
+    qc = q[: coarse["dims"]]
+    qc = qc / (np.linalg.norm(qc) or 1.0)
+    vectors, scale = coarse["vectors"], coarse.get("scale")
+    n = vectors.shape[0] if rows is None else len(rows)
+    out = np.empty(n, dtype=np.float32)
+    for start in range(0, n, block):
+        part = vectors[start:start + block] if rows is None else vectors[rows[start:start + block]]
+        out[start:start + block] = part.astype(np.float32) @ qc
+    if scale is not None:
+        out *= scale if rows is None else scale[rows]
+    return out
+
+
+def _site_matches(site, sites):
+    return any(site == s or site.endswith("." + s) for s in sites)
+
+
+def _select_shards(index, query_year, sites=None, widen=False):
+    """検索するシャード番号（シャード化されていなければ None）
+       既定は対象年の前年以降＋年不明。widen=True なら全年。sites を指定した場合はそのサイトのみ"""
+    shards = index.get("shards")
+    if shards is None:
+        return None
+    keep = np.ones(len(shards["site"]), dtype=bool)
+    if sites:
+        by_site = np.asarray([_site_matches(site, sites) for site in shards["site"]])
+        if by_site.any():
+            keep &= by_site
+    if not widen:
+        keep &= (shards["year"] == 0) | (shards["year"] >= query_year - 1)
+    return np.flatnonzero(keep)
+
+
+def _shard_rows(index, picked):
+    shards = index["shards"]
+    if len(picked) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate([np.arange(shards["start"][i], shards["end"][i]) for i in picked])
+
+
+def _in_shards(index, rows, picked):
+    """rows のうち picked のシャードに属する行のマスク"""
+    ids = np.searchsorted(index["shards"]["end"], rows, side="right")
+    return np.isin(ids, picked)
+
+
+def _shard_scores(index, picked, q):
+    """選んだシャードだけを行列×ベクトルで走査（シャードは行が連続しているので行のコピーは不要）"""
+    matrix, shards = index["matrix"], index["shards"]
+    if isinstance(matrix, _ShardedMatrix):
+        matrix.load(picked)
+    rows, scores = [], []
+    for i in picked:
+        start, end = int(shards["start"][i]), int(shards["end"][i])
+        block = matrix.shard(i) if isinstance(matrix, _ShardedMatrix) else matrix[start:end]
+        rows.append(np.arange(start, end))
+        scores.append(block @ q)
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    return np.concatenate(rows), np.concatenate(scores)
+
+
+def _vector_scores(index, q, nprobe=None, rerank_k=None, shards=None):
+    """(行番号, コサイン類似度) を返す。IVF があれば nprobe クラスタ分だけ、無ければ全件を走査
+       shards（シャード番号）を指定した場合はそのシャードの行だけを対象にする
+       coarse（切り詰め・量子化ベクトル）があれば一次走査に使い、上位 rerank_k 件だけ全精度ベクトルで再計算して返す"""
+    nprobe = ANN_NPROBE if nprobe is None else nprobe
+    ivf = index.get("ivf")
+    matrix = index["matrix"]
+    coarse = index.get("coarse")
+    if shards is None and isinstance(matrix, _ShardedMatrix):
+        shards = np.arange(len(index["shards"]["site"]))
+    if ivf is None or nprobe <= 0 or nprobe >= ivf["centroids"].shape[0]:
+        if coarse is None and shards is not None:
+            return _shard_scores(index, shards, q)
+        rows = None if shards is None else _shard_rows(index, shards)
+    else:
+        rows = _ivf_candidates(ivf, q, nprobe)
+        if shards is not None:
+            rows = rows[_in_shards(index, rows, shards)]
+
+    if coarse is None:
+        if rows is None:
+            return np.arange(matrix.shape[0]), matrix @ q
+        return rows, matrix[rows] @ q
+
+    if rows is not None and len(rows) == 0:
+        return rows, np.empty(0, dtype=np.float32)
+    approx = _coarse_scores(coarse, q, rows)
+    top = _top_indices(approx, RERANK_K if rerank_k is None else rerank_k)
+    top = top if rows is None else rows[top]
+    top = np.sort(top)
+    with _span("rerank"):
+        exact = matrix[top] @ q
+    _count("reranked", len(top))
+    return top, exact
+
+
+def _vector_scores_batch(index, queries, shards=None, block=65536):
+    """複数クエリ (B, d) のスコアを、行列（shards 指定時はそのシャード）を1回なめる行列積で計算（行方向はブロック単位）
+       IVF・一次走査（coarse）を使う場合はクエリごとに候補が違うので1件ずつ _vector_scores に回す"""
+    matrix = index["matrix"]
+    ivf = index.get("ivf")
+    if index.get("coarse") is not None or (ivf is not None and 0 < ANN_NPROBE < ivf["centroids"].shape[0]):
+        return [_vector_scores(index, q, shards=shards) for q in queries]
+    if shards is None:
+        ranges = [(None, 0, matrix.shape[0])]
+    else:
+        ranges = [(i, int(index["shards"]["start"][i]), int(index["shards"]["end"][i])) for i in shards]
+    rows = np.concatenate([np.arange(start, end) for _, start, end in ranges]) if ranges else np.empty(0, dtype=np.int64)
+    scores = np.empty((len(queries), len(rows)), dtype=np.float32)
+    if shards is not None and isinstance(matrix, _ShardedMatrix):
+        matrix.load(shards)
+    pos = 0
+    for i, start, end in ranges:
+        whole = matrix.shard(i) if isinstance(matrix, _ShardedMatrix) else None
+        for lo in range(start, end, block):
+            hi = min(lo + block, end)
+            part = whole[lo - start:hi - start] if whole is not None else np.asarray(matrix[lo:hi])
+            scores[:, pos:pos + hi - lo] = queries @ part.T
+            pos += hi - lo
+    return [(rows, s) for s in scores]
+
+
+def _prefetch_searches(queries):
+    """サーバーモード：同時に届いた質問の embedding 化とベクトルスコア計算をまとめて行う
+       戻り値はクエリごとの {"query", "index", "embedding", "rows", "scores", "batch"}（_search_from_vector が使う）
+       BM25 がある場合、embedding が EMBED_TIMEOUT までに得られなければ embedding=None（各質問は語彙検索のみで回答）"""
+    future = _submit(_embed_queries, queries)
+    deadline = time.monotonic() + EMBED_TIMEOUT
+    index = _load_vector_index()
+    # 語彙索引の無い旧形式は縮退できないので embedding を最後まで待つ
+    vecs = _await(future, deadline, "embed") if index.get("bm25") is not None else future.result()
+    if vecs is None:
+        print(f"[WARN] batch embedding timed out after {EMBED_TIMEOUT:g}s ({len(queries)} queries); lexical-only search")
+        return [
+            {"query": q, "index": index, "embedding": None, "rows": None, "scores": None, "batch": len(queries)}
+            for q in queries
+        ]
+    if index["matrix"].shape[0] == 0:
+        scored = [(None, None)] * len(queries)
+    else:
+        # シャード化されている場合は各質問の対象シャードの和集合をまとめて走査（各質問側で自分の分に絞る）
+        shards = None
+        if index.get("shards") is not None:
+            picked = [_select_shards(index, _detect_year_from_query(q)) for q in queries]
+            shards = np.unique(np.concatenate(picked))
+        scored = _vector_scores_batch(index, _normalize_rows(np.stack(vecs)), shards)
+    return [
+        {"query": q, "index": index, "embedding": v, "rows": rows, "scores": scores, "batch": len(queries)}
+        for q, v, (rows, scores) in zip(queries, vecs, scored)
+    ]
+
+
+def _search_from_vector(query, top_k=20, sites=None, recall=None):
+    """ベクトル類似検索：最新情報を優先しつつ、HTMLとPDFをバランスよく扱う
+       シャード化されたインデックスでは対象年の前年以降＋年不明のシャード（sites 指定時はそのサイトのみ）だけを走査し、
+       類似度0.8以上の候補の資料URLが recall 件（資料に載せるURL数。未指定なら SHARD_RECALL_TARGET）未満なら残りの年にも広げる
+       embedding は別スレッドで取得し、その間にインデックスの読み込みと語彙検索（BM25）を進める。
+       EMBED_TIMEOUT までに embedding が得られなければ語彙検索の結果だけで返す（縮退）"""
+    prefetched = _PREFETCHED.get()
+    if prefetched is not None and prefetched["query"] != query:
+        prefetched = None
+    embed_future = None if prefetched else _submit(_embed_query, query)
+    embed_deadline = time.monotonic() + EMBED_TIMEOUT
+
+    with _span("index_load"):
+        index = _load_vector_index()
+    if index.get("chunks") is None and _CACHE_MAP is None:
+        _submit(_load_cache_map)  # 旧形式：本文辞書の読み込みも embedding と並行して始めておく
+    matrix = index["matrix"]
+    urls = index["meta"]["url"]
+    query_year = _detect_year_from_query(query)
+
+    jst = timezone(timedelta(hours=9))
+    now = datetime.now(jst)
+    current_year = now.year
+
+    _debug(f"[SEARCH] query='{query}' (target_year={query_year})")
+    if matrix.shape[0] == 0:
+        return []
+
+    # === 0️⃣ 語彙検索（BM25）は embedding を待たずに先に計算 ===
+    bm25 = index.get("bm25")
+    lex_rows = np.empty(0, dtype=np.int64)
+    if bm25 is not None:
+        with _span("lexical"):
+            lex_rows, _ = _bm25_search(bm25, query, BM25_TOP_K)
+
+    # EMBED_TIMEOUT で打ち切るのは語彙検索で縮退できる時だけ（旧形式は API 呼び出しが終わるまで待つ）
+    with _span("embed"):
+        if prefetched:
+            emb_q = prefetched["embedding"]
+        elif bm25 is not None:
+            emb_q = _await(embed_future, embed_deadline, "embed")
+        else:
+            emb_q = embed_future.result()
+        if emb_q is None and bm25 is None:
+            emb_q = _embed_query(query)
+    if emb_q is None:
+        print(f"[WARN] query embedding not ready within {EMBED_TIMEOUT:g}s; lexical-only search")
+        _count("degraded")
+        return _lexical_only_hits(index, lex_rows, query_year, sites, current_year, top_k)
+
+    # === 1️⃣ スコアを行列×ベクトル1回で算出（IVF があれば近傍クラスタのみ、シャード化されていれば対象シャードのみ） ===
+    picked = _select_shards(index, query_year, sites)
+    with _span("scoring"):
+        q = _normalize_rows(emb_q)
+        if prefetched and prefetched["index"] is index and prefetched["rows"] is not None:
+            rows, raw_scores = prefetched["rows"], prefetched["scores"]
+            if picked is not None:
+                keep = _in_shards(index, rows, picked)
+                rows, raw_scores = rows[keep], raw_scores[keep]
+            _count("batch_size", prefetched["batch"])
+        else:
+            rows, raw_scores = _vector_scores(index, q, shards=picked)
+
+        found = len({urls[r] for r in rows[raw_scores >= 0.80]}) if picked is not None else 0
+        if picked is not None and found >= (recall or SHARD_RECALL_TARGET):
+            _count("shard_pruned")
+        elif picked is not None:
+            wider = _select_shards(index, query_year, sites, widen=True)
+            extra = np.setdiff1d(wider, picked)
+            if extra.size:
+                _debug(f"[SEARCH] widening to {len(wider)} shards ({found} sources above 0.80 in {len(picked)})")
+                more_rows, more_scores = _vector_scores(index, q, shards=extra)
+                rows, raw_scores = np.concatenate([rows, more_rows]), np.concatenate([raw_scores, more_scores])
+                picked = wider
+                _count("shard_widened")
+    _count("scanned", len(rows))
+    if picked is not None:
+        _count("shards_scanned", len(picked))
+
+    # 診断用のスコア一覧はサンプリングされたリクエストだけ（上位20件の抽出もその時だけ行う）
+    if _debug_enabled():
+        print(f"───[ RAW COSINE SCORES (TOP 20 / scanned {len(rows)}) ]───")
+        for i, j in enumerate(_top_indices(raw_scores, 20), start=1):
+            print(f"  {i:02d}. {urls[rows[j]][:80]}  score={raw_scores[j]:.3f}")
+        print("───────────────────────────────────")
+
+    # === 2️⃣ 類似度0.8未満をカット（候補のみ再スコア） ===
+    # BM25 があればキーワード一致は語彙検索側で扱う（旧形式のみ部分一致で加点）
+    with _span("rescoring"):
+        keywords = [] if bm25 else re.findall(r"[一-龠ぁ-んァ-ンa-zA-Z0-9]+", _normalize_text(query))
+        above = np.flatnonzero(raw_scores >= 0.80)
+        cand = rows[above]
+        scores = _rescore(index, cand, raw_scores[above], keywords, current_year)
+        order = np.argsort(-scores, kind="stable")
+        vec_rows, vec_scores = cand[order], scores[order]
+    _count("candidates", len(cand))
+
+    # === 3️⃣ 語彙検索（BM25）と RRF で統合 ===
+    if bm25 is not None:
+        with _span("lexical"):
+            if picked is not None and lex_rows.size:
+                lex_rows = lex_rows[_in_shards(index, lex_rows, picked)]
+            if lex_rows.size:
+                # 語彙一致のみで入る行も、意味的にある程度近いものに限る
+                lex_rows = lex_rows[(matrix[lex_rows] @ q) >= HYBRID_MIN_COSINE]
+            final_rows, final_scores = _rrf_fuse([vec_rows, lex_rows], RRF_K)
+        _count("lexical_candidates", len(lex_rows))
+        _debug(f"[SEARCH] hybrid vector={len(vec_rows)} lexical={len(lex_rows)} fused={len(final_rows)}")
+    else:
+        final_rows, final_scores = vec_rows, vec_scores
+
+    # === 4️⃣ 上位Nを返す ===
+    scored = [(float(sc), _index_row(index, r)) for sc, r in zip(final_scores[:top_k], final_rows[:top_k])]
+    hits = [r for _, r in scored]
+    _count("hits", len(hits))
+
+    if _debug_enabled():
+        print(f"[SEARCH] top={len(hits)} results (最新優先＋0.8cut＋再スコア{'＋BM25融合' if bm25 else ''})")
+        for i, (s, r) in enumerate(scored[:5], start=1):
+            y = _detect_year_from_text(r.get("url", "") or "")
+            print(f"  {i}. {r.get('url')}  year={y}  score={s:.3f}")
+
+    return hits
+
+
+def _lexical_only_hits(index, lex_rows, query_year, sites, current_year, top_k):
+    """embedding が間に合わない時の縮退検索：BM25 の順位と年度・HTML 補正の順位を RRF で統合
+       （ベクトルで候補数を確かめられないので年のシャードでは絞らない。sites 指定時はそのサイトのみ）"""
+    picked = _select_shards(index, query_year, sites, widen=True)
+    if picked is not None and lex_rows.size:
+        lex_rows = lex_rows[_in_shards(index, lex_rows, picked)]
+    boosted = _rescore(index, lex_rows, np.zeros(len(lex_rows)), [], current_year)
+    rows, _ = _rrf_fuse([lex_rows, lex_rows[np.argsort(-boosted, kind="stable")]], RRF_K)
+    hits = [_index_row(index, r) for r in rows[:top_k]]
+    _count("lexical_candidates", len(lex_rows))
+    _count("hits", len(hits))
+    _debug(f"[SEARCH] lexical-only top={len(hits)} results")
+    return hits
+
+
+# ====== シナリオ定型質問の事前生成回答 ======
+def _answer_context_hash(prompt, config):
+    """回答を左右する入力（プロンプト・設定）のハッシュ。7-build_answers 側と同じ定義"""
+    prompt = (prompt or "").replace("\r\n", "\n").strip()
+    raw = json.dumps({"prompt": prompt, "config": config or {}}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _load_answers():
+    """answers/<インデックス版>.json を読み込む（無ければ空）
+       7-build_answers の実行中など、まだファイルが無い版は ANSWERS_RETRY_SEC ごとに再確認する"""
+    global _ANSWERS
+    version = _load_manifest().get("version")
+    if _ANSWERS is not None and _ANSWERS["version"] == version:
+        if _ANSWERS["retry_at"] is None or time.monotonic() < _ANSWERS["retry_at"]:
+            return _ANSWERS
+
+    store = {"version": version, "context_hash": None, "answers": {}, "retry_at": None}
+    if version is not None:
+        key = f"{ANSWERS_PREFIX}{version}.json"
+        try:
+            data = json.loads(_timed(key, _get_bytes, key).decode("utf-8"))
+            store["context_hash"] = data.get("context_hash")
+            store["answers"] = {_normalize_query(k): v for k, v in data.get("answers", {}).items()}
+            print(f"[LOAD] precomputed answers loaded: version={version} total={len(store['answers'])}")
+        except s3.exceptions.NoSuchKey:
+            print(f"[WARN] no precomputed answers for version={version}")
+            store["retry_at"] = time.monotonic() + ANSWERS_RETRY_SEC
+        except Exception as e:
+            # 事前生成回答は高速化のための任意機能。読めなくても通常の RAG で答える
+            print(f"[WARN] failed to load precomputed answers for version={version}: {e}")
+            store["context_hash"], store["answers"] = None, {}
+            store["retry_at"] = time.monotonic() + ANSWERS_RETRY_SEC
+    _ANSWERS = store
+    return _ANSWERS
+
+
+def _lookup_precomputed(message, config, prompt):
+    """シナリオの選択肢と完全一致する質問なら事前生成回答を返す（無ければ None）"""
+    store = _load_answers()
+    hit = store["answers"].get(_normalize_query(message))
+    if hit is None:
+        return None
+    if store["context_hash"] != _answer_context_hash(prompt, config):
+        print("[ANSWERS] prompt/config differs from precomputed run, falling back to live RAG")
+        return None
+    _count("precomputed")
+    _debug(f"[ANSWERS] served precomputed answer: '{message}' (version={store['version']})")
+    return hit["reply"], hit.get("sources", [])
+
+
+# ====== 現在日時をプロンプトに反映 ======
+def _with_current_date(base_prompt: str) -> str:
+    jst = timezone(timedelta(hours=9))
+    now = datetime.now(jst)
+    reiwa = now.year - 2018
+    date_str = f"{now.year}年{now.month}月{now.day}日（令和{reiwa}年）"
+    return (
+        base_prompt.strip()
+        + f"\n\n# 現在日時: {date_str}\n"
+        "「今年」「来年」「昨年」などの表現は、必ずこの日付を基準に判断すること。\n"
+        "古い資料を参照する場合は、その旨を明示して補足すること。"
+    )
+
+
+# ====== 資料の組み立て（トークン予算・重複除去） ======
+def _estimate_tokens(text):
+    """トークン数の概算（4-build_embeddings と同じ：UTF-8 バイト数 / 3。日本語はほぼ1文字1トークン）"""
+    return len(text.encode("utf-8")) // 3 + 1
+
+
+def _truncate_tokens(text, tokens):
+    return text.encode("utf-8")[: max(tokens - 1, 0) * 3].decode("utf-8", errors="ignore")
+
+
+def _merge_runs(hits, contents):
+    """同じURLで chunk_index が連続するヒットを1つの資料にまとめる（2つ目以降の重複する見出し行は省く）
+       戻り値は検索順位順の [{"url", "rank", "rows", "chunk_indexes", "text"}]"""
+    by_url = OrderedDict()
+    for rank, (h, content) in enumerate(zip(hits, contents)):
+        if content:
+            by_url.setdefault(h["url"], {})[int(h["chunk_index"])] = (rank, h["row"], content[:CONTEXT_CHUNK_CHARS])
+
+    blocks = []
+    for url, chunks in by_url.items():
+        run = []
+        for ci in sorted(chunks):
+            if run and ci != run[-1] + 1:
+                blocks.append(_make_block(url, run, chunks))
+                run = []
+            run.append(ci)
+        blocks.append(_make_block(url, run, chunks))
+    blocks.sort(key=lambda b: b["rank"])
+    return blocks
+
+
+def _make_block(url, run, chunks):
+    first = chunks[run[0]][2]
+    heading = first.split("\n", 1)[0]
+    texts = [first]
+    for ci in run[1:]:
+        head, _, rest = chunks[ci][2].partition("\n")
+        texts.append(rest if rest and head == heading else chunks[ci][2])
+    return {
+        "url": url,
+        "rank": min(chunks[ci][0] for ci in run),
+        "rows": [chunks[ci][1] for ci in run],
+        "chunk_indexes": list(run),
+        "text": "\n".join(texts),
+    }
+
+
+def _pack_context(index, hits, contents, max_sources=None):
+    """ヒットした本文をトークン予算内の資料にまとめる
+       1. 同じURLの連続チャンクを連結
+       2. 埋め込みの類似度で MMR 選択（採用済みとほぼ同じ内容＝HTML と PDF の同一告知などは除外）
+          S3 上の行列は検索中に取得済みの行だけを使い、ベクトルの無い資料は検索順位のまま重複判定なしで扱う
+       3. 資料のURL数を max_sources（config.json）までに制限し、CONTEXT_TOKEN_BUDGET に収まるだけ採用
+       戻り値: (資料テキストのリスト, sources, 統計)"""
+    baseline = sum(_estimate_tokens(f"URL: {h['url']}\n{c[:1000]}") for h, c in zip(hits, contents) if c)
+    blocks = _merge_runs(hits, contents)
+    stats = {"baseline": baseline, "tokens": 0, "blocks": 0, "merged": sum(len(b["rows"]) - 1 for b in blocks),
+             "duplicates": 0, "capped": 0, "over_budget": 0}
+    if not blocks:
+        return [], [], stats
+
+    rows = sorted({r for b in blocks for r in b["rows"]})
+    matrix = index["matrix"]
+    if hasattr(matrix, "cached"):
+        # 再スコア・語彙検索の照合で読んだ行は手元にあるので、ここで同期の範囲取得はしない
+        vecs = matrix.cached(rows)
+        if len(vecs) < len(rows):
+            _count("context_vectors_missing", len(rows) - len(vecs))
+    else:
+        vecs = dict(zip(rows, np.asarray(matrix[np.asarray(rows)], dtype=np.float32)))
+    zero = np.zeros(matrix.shape[1], dtype=np.float32)
+    emb = _normalize_rows(np.stack([
+        np.mean([vecs[r] for r in b["rows"] if r in vecs], axis=0) if any(r in vecs for r in b["rows"]) else zero
+        for b in blocks
+    ]))
+    sim = emb @ emb.T
+    relevance = 1.0 - np.arange(len(blocks)) / len(blocks)  # 検索順位（RRF 等でスコアの尺度が揃わないため順位で代用）
+
+    texts, sources, urls = [], [], set()
+    selected, remaining = [], list(range(len(blocks)))
+    while remaining:
+        closest = sim[np.ix_(remaining, selected)].max(axis=1) if selected else np.zeros(len(remaining))
+        pick = int(np.argmax(CONTEXT_MMR_LAMBDA * relevance[remaining] - (1 - CONTEXT_MMR_LAMBDA) * closest))
+        i = remaining.pop(pick)
+        block = blocks[i]
+        if closest[pick] >= CONTEXT_DEDUP_SIM:
+            stats["duplicates"] += 1
+            continue
+        if max_sources and block["url"] not in urls and len(urls) >= max_sources:
+            stats["capped"] += 1
+            continue
+        text = f"URL: {block['url']}\n{block['text']}"
+        cost = _estimate_tokens(text)
+        left = CONTEXT_TOKEN_BUDGET - stats["tokens"]
+        if cost > left:
+            if left < CONTEXT_MIN_TAIL_TOKENS:
+                stats["over_budget"] += 1
+                continue
+            text = _truncate_tokens(text, left)
+            cost = _estimate_tokens(text)
+        selected.append(i)
+        urls.add(block["url"])
+        texts.append(text)
+        sources.extend({"url": block["url"], "chunk_index": ci} for ci in block["chunk_indexes"])
+        stats["tokens"] += cost
+        stats["blocks"] += 1
+    return texts, sources, stats
+
+
+# ====== 回答生成 ======
+def _build_messages(user_message, config, prompt):
+    """検索してプロンプトを組み立てる。戻り値: (messages, sources)"""
+    hits = _search_from_vector(
+        user_message, sites=(config or {}).get("search_sites"), recall=(config or {}).get("max_sources")
+    )
+    with _span("chunk_lookup"):
+        contents = _hit_contents(hits)
+
+    with _span("context_pack"):
+        ctx_blocks, sources, stats = _pack_context(
+            _load_vector_index(), hits, contents, (config or {}).get("max_sources")
+        )
+    ctx = "\n\n".join(ctx_blocks) if ctx_blocks else "(関連本文なし)"
+    _count("sources", len(sources))
+    _count("context_tokens", stats["tokens"])
+    _count("context_tokens_saved", max(stats["baseline"] - stats["tokens"], 0))
+    _count("context_duplicates", stats["duplicates"])
+    _debug(
+        f"[CONTEXT] tokens={stats['tokens']} (before={stats['baseline']}) blocks={stats['blocks']} "
+        f"merged={stats['merged']} duplicates={stats['duplicates']} capped={stats['capped']} over_budget={stats['over_budget']}"
+    )
+
+    system_prompt = _with_current_date(
+        prompt or "あなたは東成瀬村の情報に基づいて答えるアシスタントです。"
+    ) + "\nWebページを最優先に使い、PDFは最終手段としてのみ利用すること。"
+
+    user_prompt = f"質問: {user_message}\n\n以下は東成瀬村の公式サイト等からの資料じゃ。これ以外を根拠にしてはならぬ。\n\n{ctx}"
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+    return messages, sources
+
+
+def generate_reply(user_message, config, prompt):
+    messages, sources = _build_messages(user_message, config, prompt)
+    with _span("llm"):
+        resp = oa.chat.completions.create(
+            model="gpt-4o-mini",
+            temperature=0.2,
+            max_tokens=800,
+            messages=messages,
+            timeout=LLM_TIMEOUT
+        )
+    reply = resp.choices[0].message.content.strip()
+    _debug(f"[GEN] reply_len={len(reply)} sources={len(sources)}")
+    return reply, sources
+
+
+def generate_reply_stream(user_message, config, prompt):
+    """generate_reply のストリーミング版
+       ("sources", [...]) を先に返し、続いて ("delta", 文字列) を生成され次第、最後に ("done", {...})"""
+    messages, sources = _build_messages(user_message, config, prompt)
+    yield "sources", sources
+
+    started = time.perf_counter()
+    stream = oa.chat.completions.create(
+        model="gpt-4o-mini",
+        temperature=0.2,
+        max_tokens=800,
+        messages=messages,
+        stream=True,
+        timeout=LLM_TIMEOUT
+    )
+    parts = []
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            if not parts:
+                _count("llm_ttft_ms", (time.perf_counter() - started) * 1000)
+            parts.append(delta)
+            yield "delta", delta
+    # 送信側の待ち時間も含む（ストリーム全体の所要時間）
+    _count("llm_ms", (time.perf_counter() - started) * 1000)
+
+    reply_len = len("".join(parts).strip())
+    _debug(f"[GEN] reply_len={reply_len} sources={len(sources)} (stream)")
+    yield "done", {"reply_len": reply_len}
+
+
+# ====== SSE（Server-Sent Events） ======
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def stream_events(message, config, prompt, live=False):
+    """SSE 形式の文字列を順に返すジェネレータ
+       event: sources → delta（複数）→ done（options 付き）。途中の例外は event: error で通知
+       レスポンスストリーミング対応の実行環境（Lambda Web Adapter・サーバーモード）ではそのまま逐次送信できる"""
+    options = [{"label": "トップに戻る", "next": "restart"}]
+    try:
+        precomputed = None if live else _lookup_precomputed(message, config, prompt)
+        if precomputed:
+            reply, sources = precomputed
+            yield _sse("sources", sources)
+            yield _sse("delta", {"text": reply})
+        else:
+            for kind, data in generate_reply_stream(message, config, prompt):
+                if kind == "delta":
+                    yield _sse("delta", {"text": data})
+                elif kind == "sources":
+                    yield _sse("sources", data)
+        yield _sse("done", {"options": options})
+    except Exception as e:
+        print("❌ ERROR:", repr(e))
+        traceback.print_exc()
+        yield _sse("error", {"error": "internal_error", "detail": str(e)})
+
+
+# ====== Lambda handler ======
+def lambda_handler(event, context):
+    _check_index_update()
+    with _request_trace("buffered") as trace:
+        return _handle(event, trace)
+
+
+def _handle(event, trace):
+    try:
+        payload = json.loads(event.get("body") or "{}")
+        message = payload.get("message", "").strip()
+        if not message:
+            return {"statusCode": 400, "body": json.dumps({"error": "message required"})}
+
+        config = payload.get("config", {})
+        prompt = payload.get("prompt", "")
+        options = [{"label": "トップに戻る", "next": "restart"}]
+
+        # stream=True：SSE 形式で返す（通常の Lambda では本文はまとめて返る）
+        if payload.get("stream"):
+            trace.mode = "stream"
+            return {
+                "statusCode": 200,
+                "headers": {"Content-Type": "text/event-stream; charset=utf-8", "Cache-Control": "no-cache"},
+                "body": "".join(stream_events(message, config, prompt, live=payload.get("live", False)))
+            }
+
+        # シナリオ定型質問は事前生成回答を返す（live=True は事前生成ジョブからの呼び出し）
+        precomputed = None if payload.get("live") else _lookup_precomputed(message, config, prompt)
+        if precomputed:
+            reply, sources = precomputed
+        else:
+            # 事前生成ジョブは回答を保存する版を index_version で指定してくる
+            if payload.get("index_version") is not None:
+                _require_index_version(payload["index_version"])
+            reply, sources = generate_reply(message, config, prompt)
+        result = {"reply": reply, "sources": sources, "options": options}
+        if payload.get("live"):
+            result["index_version"] = trace.index and trace.index["version"]  # 回答に使ったインデックスの版
+        return {
+            "statusCode": 200,
+            "body": json.dumps(result, ensure_ascii=False)
+        }
+
+    except Exception as e:
+        print("❌ ERROR:", repr(e))
+        traceback.print_exc()
+        return {
+            "statusCode": 500,
+            "body": json.dumps({"error": "internal_error", "detail": str(e)}, ensure_ascii=False)
+        }
+
+
+# ====== サーバーモード（常駐 HTTP サーバー・質問のまとめ処理） ======
+_HTTP_REASONS = {
+    200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+    413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable",
+}
+
+
+class _HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class _QueryBatcher:
+    """同時に届いた質問を BATCH_WINDOW_MS だけ待って束ね、embedding 化とスコア計算（_prefetch_searches）を1回で行う"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.pending = []
+        self.timer = None
+        self.tasks = set()
+
+    async def search(self, query):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((query, future))
+        if len(self.pending) >= BATCH_MAX_QUERIES:
+            self._flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(BATCH_WINDOW_MS / 1000, self._flush)
+        return await future
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, batch):
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self.pool, _prefetch_searches, [query for query, _ in batch]
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+class _ChatServer:
+    """HTTP/1.1（keep-alive）で POST を受け、Lambda と同じ形式の JSON（stream=true なら SSE）を返す
+       - 検索前段（embedding・スコア計算）は _QueryBatcher でまとめて実行
+       - LLM 呼び出しは LLM_CONCURRENCY 件まで。空き待ちが多すぎる／長すぎる場合は 503 を返す"""
+
+    def __init__(self):
+        self.pool = ThreadPoolExecutor(max_workers=SERVER_WORKERS, thread_name_prefix="chat")
+        self.batcher = _QueryBatcher(self.pool)
+        self.llm_slots = asyncio.Semaphore(LLM_CONCURRENCY)
+        self.stats = {"served": 0, "rejected": 0, "llm_running": 0, "llm_waiting": 0}
+
+    async def _call(self, ctx, fn, *args):
+        """同期処理をスレッドで実行（リクエストの計測・先読み結果を持つ ctx の中で）"""
+        return await asyncio.get_running_loop().run_in_executor(self.pool, lambda: ctx.run(fn, *args))
+
+    async def _acquire_llm(self):
+        if self.llm_slots.locked() and self.stats["llm_waiting"] >= LLM_MAX_WAITING:
+            return False
+        self.stats["llm_waiting"] += 1
+        try:
+            with _span("llm_queue"):
+                await asyncio.wait_for(self.llm_slots.acquire(), LLM_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.stats["llm_waiting"] -= 1
+        self.stats["llm_running"] += 1
+        return True
+
+    def _release_llm(self):
+        self.stats["llm_running"] -= 1
+        self.llm_slots.release()
+
+    # --- HTTP ---
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except _HttpError as e:
+                    await self._send_json(writer, e.status, {"error": str(e)}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                if method == "GET" and path in ("/health", "/healthz"):
+                    await self._send_json(writer, 200, self._health(), keep_alive)
+                elif method == "POST":
+                    await self._chat(writer, body, keep_alive)
+                else:
+                    await self._send_json(writer, 405, {"error": "method not allowed"}, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _readline(self, reader):
+        try:
+            return await reader.readline()
+        except ValueError:  # 1行が StreamReader の上限（64KiB）を超えた
+            raise _HttpError(400, "line too long")
+
+    async def _read_request(self, reader):
+        line = await self._readline(reader)
+        if not line:
+            return None
+        parts = line.decode("latin-1").split()
+        if len(parts) != 3:
+            raise _HttpError(400, "bad request line")
+        headers = {}
+        while True:
+            raw = await self._readline(reader)
+            if raw in (b"\r\n", b"\n", b""):
+                break
+            if len(headers) >= MAX_HEADERS:
+                raise _HttpError(400, "too many headers")
+            name, _, value = raw.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if "transfer-encoding" in headers:
+            raise _HttpError(400, "chunked request body not supported")
+        # 本文は Content-Length 分だけ読む（数字以外・負の値は 400、上限超えは読む前に 413）
+        raw_length = headers.get("content-length") or "0"
+        if not (raw_length.isascii() and raw_length.isdigit()):
+            raise _HttpError(400, "invalid content-length")
+        length = int(raw_length)
+        if length > MAX_BODY_BYTES:
+            raise _HttpError(413, "request body too large")
+        body = await reader.readexactly(length) if length else b""
+        return parts[0].upper(), parts[1].split("?", 1)[0], headers, body
+
+    async def _send(self, writer, status, body, content_type, keep_alive, headers=None):
+        head = [
+            f"HTTP/1.1 {status} {_HTTP_REASONS.get(status, '')}",
+            f"Content-Type: {content_type}",
+            f"Content-Length: {len(body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ] + [f"{k}: {v}" for k, v in (headers or {}).items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    async def _send_json(self, writer, status, data, keep_alive, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        await self._send(writer, status, body, "application/json; charset=utf-8", keep_alive, headers)
+
+    async def _send_stream(self, writer, ctx, message, config, prompt, live, keep_alive):
+        """stream_events() の SSE をスレッドで生成し、届いた順に chunked で送る"""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        def produce():
+            try:
+                for event in stream_events(message, config, prompt, live=live):
+                    loop.call_soon_threadsafe(queue.put_nowait, event)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, None)
+
+        producer = loop.run_in_executor(self.pool, lambda: ctx.run(produce))
+        try:
+            head = [
+                "HTTP/1.1 200 OK",
+                "Content-Type: text/event-stream; charset=utf-8",
+                "Cache-Control: no-cache",
+                "Transfer-Encoding: chunked",
+                f"Connection: {'keep-alive' if keep_alive else 'close'}",
+            ]
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+            while (event := await queue.get()) is not None:
+                data = event.encode("utf-8")
+                writer.write(f"{len(data):X}\r\n".encode("latin-1") + data + b"\r\n")
+                await writer.drain()
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            await producer  # 切断されても生成が終わるまで LLM の枠は返さない
+
+    def _health(self):
+        index = _VECTOR_INDEX
+        return dict(self.stats, status="ok" if index is not None else "loading", version=index and index["version"])
+
+    # --- チャット ---
+    async def _chat(self, writer, body, keep_alive):
+        await asyncio.get_running_loop().run_in_executor(self.pool, _check_index_update)
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            await self._send_json(writer, 400, {"error": "invalid json"}, keep_alive)
+            return
+        message = (payload.get("message") or "").strip()
+        if not message:
+            await self._send_json(writer, 400, {"error": "message required"}, keep_alive)
+            return
+        config = payload.get("config", {})
+        prompt = payload.get("prompt", "")
+        live = payload.get("live", False)
+        stream = payload.get("stream", False)
+        options = [{"label": "トップに戻る", "next": "restart"}]
+
+        with _request_trace("server_stream" if stream else "server") as trace:
+            ctx = contextvars.copy_context()
+            try:
+                # シナリオ定型質問は事前生成回答（LLM の枠は使わない）
+                precomputed = None if live else await self._call(ctx, _lookup_precomputed, message, config, prompt)
+                if precomputed:
+                    self.stats["served"] += 1
+                    if stream:
+                        await self._send_stream(writer, ctx, message, config, prompt, False, keep_alive)
+                    else:
+                        reply, sources = precomputed
+                        await self._send_json(writer, 200, {"reply": reply, "sources": sources, "options": options}, keep_alive)
+                    return
+
+                with _span("batch"):
+                    prefetched = await self.batcher.search(message)
+                trace.index = prefetched["index"]
+                ctx.run(_PREFETCHED.set, prefetched)
+
+                if not await self._acquire_llm():
+                    self.stats["rejected"] += 1
+                    _count("rejected")
+                    await self._send_json(writer, 503, {"error": "busy"}, keep_alive, {"Retry-After": "1"})
+                    return
+                try:
+                    if stream:
+                        await self._send_stream(writer, ctx, message, config, prompt, True, keep_alive)
+                    else:
+                        reply, sources = await self._call(ctx, generate_reply, message, config, prompt)
+                        result = {"reply": reply, "sources": sources, "options": options}
+                        if live:
+                            result["index_version"] = prefetched["index"]["version"]
+                        await self._send_json(writer, 200, result, keep_alive)
+                    self.stats["served"] += 1
+                finally:
+                    self._release_llm()
+            except ConnectionError:
+                raise
+            except Exception as e:
+                print("❌ ERROR:", repr(e))
+                traceback.print_exc()
+                await self._send_json(writer, 500, {"error": "internal_error", "detail": str(e)}, keep_alive)
+
+
+def serve(host=SERVER_HOST, port=SERVER_PORT):
+    """常駐 HTTP サーバーとして起動（python 6-chat.py）。インデックスを読み込み終えてから待ち受けを始める"""
+    async def main():
+        server = _ChatServer()
+        await asyncio.get_running_loop().run_in_executor(server.pool, _preload)
+        listener = await asyncio.start_server(server.handle_connection, host, port)
+        print(
+            f"[SERVER] listening on http://{host}:{port} "
+            f"(llm_concurrency={LLM_CONCURRENCY}, batch={BATCH_MAX_QUERIES} queries / {BATCH_WINDOW_MS:g}ms)"
+        )
+        async with listener:
+            await listener.serve_forever()
+
+    asyncio.run(main())
+
+
+# ====== 初期化フェーズでの先読み ======
+def _preload():
+    try:
+        index = _load_vector_index()
+        if index.get("chunks") is None:
+            _load_cache_map()
+        _load_answers()
+    except Exception as e:
+        print(f"[WARN] preload failed: {e}")
+
+
+if PRELOAD_ON_INIT:
+    threading.Thread(target=_preload, name="preload", daemon=True).start()
+
+
+if __name__ == "__main__":
+    serve()
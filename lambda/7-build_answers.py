@@ -0,0 +1,135 @@
+# build_answers.lambda_handler — シナリオ定型質問の回答事前生成Lambda
+import boto3
+import json
+import os
+import hashlib
+import datetime
+import pytz
+from concurrent.futures import ThreadPoolExecutor
+
+s3 = boto3.client("s3")
+lambda_client = boto3.client("lambda")
+
+BUCKET = os.getenv("BUCKET_NAME", "chat-for-vill-reference")
+SCENARIO_KEY = os.getenv("SCENARIO_KEY", "config/scenario.json")
+PROMPT_KEY = os.getenv("PROMPT_KEY", "config/prompt.txt")
+CONFIG_KEY = os.getenv("CONFIG_KEY", "config/config.json")
+VECTOR_MANIFEST_KEY = os.getenv("VECTOR_MANIFEST_KEY", "vector/manifest.json")
+ANSWERS_PREFIX = os.getenv("ANSWERS_PREFIX", "answers/")
+CHAT_LAMBDA_ARN = os.getenv("CHAT_LAMBDA_ARN")
+CONCURRENCY = int(os.getenv("ANSWER_CONCURRENCY", "4"))
+
+# 選択肢のうち質問ではないもの（ナビゲーション用）
+SKIP_LABELS = {"戻る", "トップに戻る"}
+
+
+def _get_text(key):
+    return s3.get_object(Bucket=BUCKET, Key=key)["Body"].read().decode("utf-8")
+
+
+def answer_context_hash(prompt, config):
+    """回答を左右する入力（プロンプト・設定）のハッシュ。6-chat 側と同じ定義"""
+    prompt = (prompt or "").replace("\r\n", "\n").strip()
+    raw = json.dumps({"prompt": prompt, "config": config or {}}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def collect_leaf_labels(scenario):
+    """scenario.json を辿り、next を持たない選択肢（＝そのまま質問として送られるもの）を列挙"""
+    labels = []
+    for node in scenario.values():
+        for opt in node.get("options", []):
+            label = (opt.get("label") or "").strip()
+            if label and "next" not in opt and label not in SKIP_LABELS and label not in labels:
+                labels.append(label)
+    return labels
+
+
+def _ask_chat(label, config, prompt, version):
+    """6-chat を同期呼び出しし、事前生成ストアを使わない通常のRAG回答を得る
+       index_version で回答に使う版を指定し、別の版で生成された回答はエラーにする（保存先の版と食い違わないように）"""
+    event = {"body": json.dumps(
+        {"message": label, "config": config, "prompt": prompt, "live": True, "index_version": version}, ensure_ascii=False
+    )}
+    resp = lambda_client.invoke(
+        FunctionName=CHAT_LAMBDA_ARN,
+        InvocationType="RequestResponse",
+        Payload=json.dumps(event, ensure_ascii=False).encode("utf-8"),
+    )
+    result = json.loads(resp["Payload"].read().decode("utf-8"))
+    if result.get("statusCode") != 200:
+        raise RuntimeError(f"chat returned {result.get('statusCode')}: {result.get('body')}")
+    body = json.loads(result["body"])
+    if str(body.get("index_version")) != version:
+        raise RuntimeError(f"answered from index version {body.get('index_version')}, expected {version}")
+    return {"reply": body["reply"], "sources": body.get("sources", [])}
+
+
+def lambda_handler(event, context):
+    started = datetime.datetime.now(pytz.timezone("Asia/Tokyo"))
+    print(f"🚀 build_answers started at {started.strftime('%Y-%m-%d %H:%M:%S')}")
+
+    if not CHAT_LAMBDA_ARN:
+        print("⚠️ CHAT_LAMBDA_ARN not set, skipping")
+        return {"statusCode": 400, "body": "CHAT_LAMBDA_ARN not set"}
+
+    # 1️⃣ シナリオ・プロンプト・設定・インデックス版を取得
+    scenario = json.loads(_get_text(SCENARIO_KEY))
+    prompt = _get_text(PROMPT_KEY)
+    config = json.loads(_get_text(CONFIG_KEY))
+    manifest = json.loads(_get_text(VECTOR_MANIFEST_KEY))
+    version = str(manifest["version"])
+    if event.get("version") is not None and str(event["version"]) != version:
+        # 5-build_vector から呼ばれた後に別の版が公開された（その版の実行に任せる）
+        print(f"⚠️ Index version changed ({event['version']} -> {version}), skipping")
+        return {"statusCode": 409, "body": f"index version changed: {event['version']} -> {version}"}
+
+    labels = collect_leaf_labels(scenario)
+    print(f"🧭 Leaf questions: {len(labels)} (index version={version})")
+
+    # 2️⃣ 各ラベルを通常のRAGで回答生成
+    answers, failed = {}, []
+
+    def work(label):
+        try:
+            return label, _ask_chat(label, config, prompt, version)
+        except Exception as e:
+            print(f"⚠️ Failed to generate '{label}': {e}")
+            return label, None
+
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as ex:
+        for label, result in ex.map(work, labels):
+            if result is None:
+                failed.append(label)
+            else:
+                answers[label] = result
+
+    # 3️⃣ インデックス版ごとに保存
+    out_key = f"{ANSWERS_PREFIX}{version}.json"
+    data = {
+        "version": version,
+        "context_hash": answer_context_hash(prompt, config),
+        "generated_at": started.isoformat(),
+        "answers": answers,
+    }
+    s3.put_object(
+        Bucket=BUCKET,
+        Key=out_key,
+        Body=json.dumps(data, ensure_ascii=False).encode("utf-8"),
+        ContentType="application/json"
+    )
+
+    elapsed = (datetime.datetime.now(pytz.timezone("Asia/Tokyo")) - started).total_seconds()
+    print(f"💾 Saved {len(answers)} answers to s3://{BUCKET}/{out_key} (failed={len(failed)})")
+    print(f"⏱ Elapsed: {elapsed:.1f}s")
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "message": "answers generated",
+            "version": version,
+            "total": len(answers),
+            "failed": failed,
+            "elapsed_sec": elapsed
+        }, ensure_ascii=False)
+    }
@@ -0,0 +1,21 @@
+# tools 共通：lambda/ 配下の Lambda ソース（ファイル名がハイフン付き）をモジュールとして読み込む
+import os
+import sys
+import importlib.util
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda")
+
+
+def load_lambda(name):
+    """例: load_lambda("6-chat")。ローカル実行用に先読みを止め、APIキー未設定でも import できるようにする"""
+    os.environ.setdefault("PRELOAD_ON_INIT", "0")
+    os.environ.setdefault("OPENAI_API_KEY", "dummy")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "ap-northeast-1")
+    module_name = "lambda_" + name.replace("-", "_")
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(LAMBDA_DIR, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
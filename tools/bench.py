@@ -0,0 +1,287 @@
+# bench.py — インデックス規模ごとの 6-chat の性能（読み込み・検索・回答生成）を測るベンチマーク
+#
+# 合成インデックス（vector/index.jsonl と cache/ の形式そのまま）を作り、S3 / OpenAI をローカルの代替に
+# 差し替えて、規模・形式ごとに別プロセスで計測する（コールドスタートとピークRSSを正しく測るため）。
+#
+# 使い方:
+#   python tools/bench.py --sizes 1000,10000,100000 --out bench.json
+#   python tools/bench.py --sizes 1000,10000 --baseline bench_prev.json   # 前回の結果と比較
+#
+# 形式:
+#   jsonl : vector/index.jsonl + cache/*.jsonl（旧形式の読み込み経路）
+#   npy   : 同じデータを 5-build_vector で変換したバイナリ形式（index.npy / meta.json / chunks.bin ...）
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import contextlib
+import subprocess
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _lambda import load_lambda
+from fakes import LocalS3, FakeOpenAI, fake_embedding
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+CONFIG_DIR = os.path.join(ROOT, "s3", "config")
+BASE_URL = "https://vill.example.lg.jp/"
+CHUNKS_PER_DOC = 4
+METRICS = ["cold_load_ms", "first_search_ms", "search_p50_ms", "search_p99_ms", "reply_p50_ms", "reply_p99_ms", "peak_rss_mb"]
+
+
+def leaf_labels():
+    """scenario.json の定型質問（7-build_answers と同じ抽出）をクエリ負荷として使う"""
+    with open(os.path.join(CONFIG_DIR, "scenario.json"), encoding="utf-8") as f:
+        scenario = json.load(f)
+    return load_lambda("7-build_answers").collect_leaf_labels(scenario)
+
+
+# ====== 合成データ ======
+def generate(bucket, n, dims, labels, seed=0):
+    """n 行の合成インデックスを bucket/vector/index.jsonl と bucket/cache/ に書く
+       約7割の行はいずれかの定型質問の疑似 embedding の近く（コサイン 0.7〜0.95 程度）に置き、
+       検索時に足切り・再スコアリング・本文取得まで通るようにする"""
+    chat = load_lambda("6-chat")
+    rng = np.random.default_rng(seed)
+    centroids = np.stack([fake_embedding(chat._normalize_query(label), dims) for label in labels])
+    centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+    years = [2022, 2023, 2024, 2025, 2026]
+
+    os.makedirs(os.path.join(bucket, "vector"), exist_ok=True)
+    os.makedirs(os.path.join(bucket, "cache"), exist_ok=True)
+    with open(os.path.join(bucket, "vector", "index.jsonl"), "w", encoding="utf-8") as index, \
+            open(os.path.join(bucket, "cache", "2025-01-01.jsonl"), "w", encoding="utf-8") as cache:
+        for start in range(0, n, 10000):
+            size = min(10000, n - start)
+            topic = rng.integers(0, len(labels), size)
+            noise = rng.standard_normal((size, dims)).astype(np.float32)
+            noise /= np.linalg.norm(noise, axis=1, keepdims=True)
+            spread = rng.uniform(0.3, 1.0, size)[:, None].astype(np.float32)
+            on_topic = rng.random(size) < 0.7
+            vecs = np.where(on_topic[:, None], centroids[topic] + noise * spread, noise)
+
+            for k in range(size):
+                i = start + k
+                doc, chunk_index = divmod(i, CHUNKS_PER_DOC)
+                # URL は (url, chunk_index) の辞書順＝生成順になるよう連番を先頭に置く（5-build_vector はそのままマージできる）
+                url = f"{BASE_URL}d{doc:07d}/" + (f"file-{doc}.pdf" if doc % 3 == 0 else f"post-{doc}/")
+                year = years[(doc * 7) % len(years)]
+                label = labels[topic[k]] if on_topic[k] else "お知らせ"
+                preview = f"令和{year - 2018}年度 {label}について（{doc}）"
+                index.write(json.dumps({
+                    "url": url,
+                    "chunk_index": chunk_index,
+                    "preview": preview,
+                    "embedding": np.round(vecs[k], 5).tolist(),
+                }, ensure_ascii=False) + "\n")
+                cache.write(json.dumps({
+                    "url": url,
+                    "chunk_index": chunk_index,
+                    "content": preview + "\n" + f"{label}に関する詳細です。" * 20,
+                }, ensure_ascii=False) + "\n")
+
+
+def build_binary(src, dst, ann_lists):
+    """src の合成データ（jsonl）を 5-build_vector でバイナリ形式に変換して dst に置く"""
+    os.makedirs(os.path.join(dst, "embeddings"), exist_ok=True)
+    os.makedirs(os.path.join(dst, "cache"), exist_ok=True)
+    # 同じ中身なのでハードリンクで済ませる（index.jsonl の1行は embeddings の1行と同じ形式）
+    os.link(os.path.join(src, "vector", "index.jsonl"), os.path.join(dst, "embeddings", "2025-01-01_000000_embed_0000.jsonl"))
+    os.link(os.path.join(src, "cache", "2025-01-01.jsonl"), os.path.join(dst, "cache", "2025-01-01.jsonl"))
+
+    os.environ.update(COMPACT_EMBEDDINGS="0", ANN_LISTS=str(ann_lists), WORK_DIR=os.path.join(dst, ".work"))
+    builder = load_lambda("5-build_vector")
+    builder.s3 = LocalS3(dst)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        builder.lambda_handler({}, None)
+
+
+def prepare(work_dir, n, dims, labels, formats, ann_lists, regen):
+    """規模 n のデータを用意し、形式ごとのバケットディレクトリを返す"""
+    base = os.path.join(work_dir, f"n{n}_d{dims}")
+    if regen:
+        shutil.rmtree(base, ignore_errors=True)
+    jsonl_dir, npy_dir = os.path.join(base, "jsonl"), os.path.join(base, "npy")
+    if not os.path.exists(os.path.join(jsonl_dir, "vector", "index.jsonl")):
+        print(f"🧪 generating {n:,} rows x {dims} dims ...", file=sys.stderr)
+        generate(jsonl_dir, n, dims, labels)
+    if "npy" in formats and not os.path.exists(os.path.join(npy_dir, "vector", "manifest.json")):
+        print(f"🧪 building binary index for {n:,} rows ...", file=sys.stderr)
+        shutil.rmtree(npy_dir, ignore_errors=True)
+        build_binary(jsonl_dir, npy_dir, ann_lists)
+    return {"jsonl": jsonl_dir, "npy": npy_dir}
+
+
+def _dir_bytes(path, sub):
+    total = 0
+    for d, _, names in os.walk(os.path.join(path, sub)):
+        total += sum(os.path.getsize(os.path.join(d, name)) for name in names)
+    return total
+
+
+# ====== 計測（別プロセス） ======
+def _percentiles(samples):
+    return round(float(np.percentile(samples, 50)), 3), round(float(np.percentile(samples, 99)), 3)
+
+
+def worker(args):
+    """1つのバケットについて、コールドスタート → 検索 → 回答生成 を計測し JSON を標準出力に書く"""
+    os.environ.update(
+        S3_BUCKET="bench",
+        LOCAL_VECTOR_DIR=os.path.join(args.bucket, ".local_vector"),
+        QUERY_EMBED_STORE="none",
+        PRELOAD_ON_INIT="0",
+    )
+    shutil.rmtree(os.environ["LOCAL_VECTOR_DIR"], ignore_errors=True)
+    labels = leaf_labels()[: args.queries]
+    with open(os.path.join(CONFIG_DIR, "prompt.txt"), encoding="utf-8") as f:
+        prompt = f.read()
+    with open(os.path.join(CONFIG_DIR, "config.json"), encoding="utf-8") as f:
+        config = json.load(f)
+
+    out = sys.stdout
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        chat = load_lambda("6-chat")
+        import_ms = (time.perf_counter() - started) * 1000
+        chat.s3 = LocalS3(args.bucket, latency=args.s3_latency)
+        chat.oa = FakeOpenAI(dims=args.dims, reply_tokens=50)
+
+        started = time.perf_counter()
+        chat._load_vector_index()
+        cold_load_ms = (time.perf_counter() - started) * 1000
+
+        # 最初の検索（本文ストアの初回取得などの遅延初期化を含む）
+        started = time.perf_counter()
+        chat._search_from_vector(labels[0])
+        first_search_ms = (time.perf_counter() - started) * 1000
+
+        search, hits = [], []
+        for _ in range(args.repeat):
+            for label in labels:
+                started = time.perf_counter()
+                result = chat._search_from_vector(label)
+                search.append((time.perf_counter() - started) * 1000)
+                hits.append(len(result))
+
+        # 回答生成の端から端まで（LLM は即時応答の疑似なので、残りはすべて 6-chat 側の処理時間）
+        reply = []
+        for label in labels:
+            started = time.perf_counter()
+            chat.generate_reply(label, config, prompt)
+            reply.append((time.perf_counter() - started) * 1000)
+
+    search_p50, search_p99 = _percentiles(search)
+    reply_p50, reply_p99 = _percentiles(reply)
+    json.dump({
+        "import_ms": round(import_ms, 3),
+        "cold_load_ms": round(cold_load_ms, 3),
+        "first_search_ms": round(first_search_ms, 3),
+        "search_p50_ms": search_p50,
+        "search_p99_ms": search_p99,
+        "reply_p50_ms": reply_p50,
+        "reply_p99_ms": reply_p99,
+        "avg_hits": round(float(np.mean(hits)), 2),
+        "queries": len(search),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }, out)
+
+
+def run_worker(bucket, args):
+    cmd = [
+        sys.executable, os.path.abspath(__file__), "--worker",
+        "--bucket", bucket, "--dims", str(args.dims), "--queries", str(args.queries),
+        "--repeat", str(args.repeat), "--s3-latency", str(args.s3_latency),
+    ]
+    res = subprocess.run(cmd, capture_output=True, text=True)
+    if res.returncode != 0:
+        raise RuntimeError(f"worker failed for {bucket}:\n{res.stderr}")
+    return json.loads(res.stdout)
+
+
+# ====== 比較 ======
+def compare(results, baseline_path, threshold):
+    """前回の結果と (size, format) ごとに比べ、threshold 倍を超えて悪化した指標を表示する"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(r["size"], r["format"]): r for r in json.load(f)["results"]}
+    regressions = []
+    for r in results:
+        base = baseline.get((r["size"], r["format"]))
+        if not base:
+            continue
+        for metric in METRICS:
+            if not base.get(metric):
+                continue
+            ratio = r[metric] / base[metric]
+            mark = "  ⚠️ REGRESSION" if ratio > threshold else ""
+            print(f"  n={r['size']:>8,} {r['format']:<5} {metric:<16} {base[metric]:>10} → {r[metric]:>10} (x{ratio:.2f}){mark}")
+            if mark:
+                regressions.append({"size": r["size"], "format": r["format"], "metric": metric, "ratio": round(ratio, 3)})
+    return regressions
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark for 6-chat retrieval and answer path")
+    parser.add_argument("--sizes", default="1000,10000", help="行数（カンマ区切り。例: 1000,10000,100000,1000000）")
+    parser.add_argument("--dims", type=int, default=1536)
+    parser.add_argument("--formats", default="jsonl,npy", help="計測する形式（jsonl / npy）")
+    parser.add_argument("--ann-lists", type=int, default=0, help="npy 形式で IVF を作る場合のクラスタ数")
+    parser.add_argument("--queries", type=int, default=1000, help="使う定型質問の最大数")
+    parser.add_argument("--repeat", type=int, default=3, help="検索を繰り返す回数")
+    parser.add_argument("--s3-latency", type=float, default=0.0, help="疑似S3の1リクエストあたりの遅延（秒）")
+    parser.add_argument("--work-dir", default="/tmp/bench", help="合成データの置き場所（規模ごとに再利用）")
+    parser.add_argument("--regen", action="store_true", help="合成データを作り直す")
+    parser.add_argument("--out", default="bench.json", help="結果の出力先（JSON）")
+    parser.add_argument("--baseline", help="比較する前回の結果（JSON）")
+    parser.add_argument("--threshold", type=float, default=1.2, help="この倍率を超えた悪化を回帰とみなす")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--bucket", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+        return
+
+    labels = leaf_labels()
+    formats = [f for f in args.formats.split(",") if f]
+    results = []
+    for n in (int(s) for s in args.sizes.split(",")):
+        buckets = prepare(args.work_dir, n, args.dims, labels, formats, args.ann_lists, args.regen)
+        for fmt in formats:
+            r = run_worker(buckets[fmt], args)
+            r.update(size=n, format=fmt, artifact_bytes=_dir_bytes(buckets[fmt], "vector"))
+            results.append(r)
+            print(f"📊 n={n:>8,} {fmt:<5} cold={r['cold_load_ms']:.0f}ms first={r['first_search_ms']:.0f}ms "
+                  f"search p50/p99={r['search_p50_ms']:.1f}/{r['search_p99_ms']:.1f}ms "
+                  f"reply p50/p99={r['reply_p50_ms']:.1f}/{r['reply_p99_ms']:.1f}ms rss={r['peak_rss_mb']}MB")
+
+    report = {
+        "commit": _git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("worker", "bucket", "baseline", "out")},
+        "results": results,
+    }
+    if args.baseline:
+        report["regressions"] = compare(results, args.baseline, args.threshold)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"💾 results saved to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
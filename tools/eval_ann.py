@@ -0,0 +1,101 @@
+# eval_ann.py — IVF 近似検索の recall / 速度を全件走査（厳密解）と比較するツール
+#
+# 使い方:
+#   aws s3 sync s3://chat-for-vill-reference/vector/ ./vector/
+#   python tools/eval_ann.py --dir ./vector --nprobe 1,2,4,8,16,32
+#   （実クエリで評価する場合）
+#   aws s3 sync s3://chat-for-vill-reference/query_embeddings/ ./qemb/
+#   python tools/eval_ann.py --dir ./vector --queries-dir ./qemb
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _lambda import load_lambda
+
+
+def local_path(directory, key):
+    """manifest のキー（vector/<version>/index.npy）を、vector/ を同期したディレクトリ内のパスに直す"""
+    return os.path.join(directory, key.split("/", 1)[1])
+
+
+def load_index(directory):
+    with open(os.path.join(directory, "manifest.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+    files = manifest["files"]
+    if "ivf" not in files:
+        sys.exit("manifest に ivf がありません（5-build_vector を ANN_LISTS > 0 で実行してください）")
+    matrix = np.load(local_path(directory, files["matrix"]), mmap_mode="r")
+    matrix = np.asarray(matrix, dtype=np.float32)
+    with np.load(local_path(directory, files["ivf"])) as npz:
+        ivf = {name: npz[name] for name in npz.files}
+    return manifest, {"matrix": matrix, "ivf": ivf}
+
+
+def load_queries(args, matrix, chat):
+    if args.queries_dir:
+        vecs = [
+            np.fromfile(os.path.join(args.queries_dir, name), dtype="<f4")
+            for name in sorted(os.listdir(args.queries_dir))
+            if name.endswith(".f32")
+        ]
+        return chat._normalize_rows(np.asarray(vecs[: args.queries], dtype=np.float32))
+    # 実クエリが無い場合：インデックスの行にノイズを加えたものを疑似クエリとする
+    rng = np.random.default_rng(args.seed)
+    rows = rng.choice(matrix.shape[0], size=min(args.queries, matrix.shape[0]), replace=False)
+    noisy = matrix[rows] + rng.standard_normal((len(rows), matrix.shape[1])).astype(np.float32) * args.noise
+    return chat._normalize_rows(noisy)
+
+
+def evaluate(chat, index, queries, k, nprobe):
+    recalls, latencies, scanned = [], [], []
+    for q in queries:
+        exact_rows, exact_scores = chat._vector_scores(index, q, nprobe=0)
+        truth = set(exact_rows[chat._top_indices(exact_scores, k)].tolist())
+
+        started = time.perf_counter()
+        rows, scores = chat._vector_scores(index, q, nprobe=nprobe)
+        found = rows[chat._top_indices(scores, k)]
+        latencies.append((time.perf_counter() - started) * 1000)
+
+        recalls.append(len(truth.intersection(found.tolist())) / max(len(truth), 1))
+        scanned.append(len(rows))
+    return {
+        "nprobe": nprobe,
+        f"recall@{k}": round(float(np.mean(recalls)), 4),
+        "scanned_rows": int(np.mean(scanned)),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--dir", required=True, help="vector/ をダウンロードしたディレクトリ")
+    parser.add_argument("--nprobe", default="1,2,4,8,16,32", help="評価する nprobe（カンマ区切り）")
+    parser.add_argument("--k", type=int, default=20, help="recall を測る上位件数（6-chat の top_k）")
+    parser.add_argument("--queries", type=int, default=200, help="評価クエリ数")
+    parser.add_argument("--queries-dir", help="query_embeddings/*.f32 をダウンロードしたディレクトリ")
+    parser.add_argument("--noise", type=float, default=0.02, help="疑似クエリのノイズ量")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力")
+    args = parser.parse_args()
+
+    chat = load_lambda("6-chat")
+    manifest, index = load_index(args.dir)
+    queries = load_queries(args, index["matrix"], chat)
+    results = [evaluate(chat, index, queries, args.k, int(n)) for n in args.nprobe.split(",")]
+
+    if args.json:
+        print(json.dumps({"version": manifest["version"], "ann": manifest.get("ann"), "results": results}, ensure_ascii=False))
+        return
+    print(f"index v{manifest['version']} rows={manifest['count']} nlist={manifest['ann']['nlist']} queries={len(queries)}")
+    for r in results:
+        print("  " + "  ".join(f"{k}={v}" for k, v in r.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# eval_quant.py — 一次走査用ベクトル（次元切り詰め＋量子化）＋全精度再スコアリングの recall / 速度 / サイズを
+#                  全件走査（厳密解）と比較するツール。COARSE_DIMS / COARSE_DTYPE / RERANK_K を決めるのに使う
+#
+# 使い方:
+#   aws s3 sync s3://chat-for-vill-reference/vector/ ./vector/
+#   python tools/eval_quant.py --dir ./vector --dims 128,256,512,0 --dtypes int8,float16 --rerank-k 50,100,200,400
+#   （実クエリで評価する場合）
+#   aws s3 sync s3://chat-for-vill-reference/query_embeddings/ ./qemb/
+#   python tools/eval_quant.py --dir ./vector --queries-dir ./qemb
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _lambda import load_lambda
+from eval_ann import load_queries, local_path
+
+
+def load_matrix(directory):
+    with open(os.path.join(directory, "manifest.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+    matrix = np.load(local_path(directory, manifest["files"]["matrix"]), mmap_mode="r")
+    return manifest, np.asarray(matrix, dtype=np.float32)
+
+
+def evaluate(chat, matrix, coarse, queries, k, rerank_k):
+    index = {"matrix": matrix, "coarse": coarse, "ivf": None}
+    exact_index = {"matrix": matrix, "coarse": None, "ivf": None}
+    recalls, latencies = [], []
+    for q in queries:
+        exact_rows, exact_scores = chat._vector_scores(exact_index, q)
+        truth = set(exact_rows[chat._top_indices(exact_scores, k)].tolist())
+
+        started = time.perf_counter()
+        rows, scores = chat._vector_scores(index, q, rerank_k=rerank_k)
+        found = rows[chat._top_indices(scores, k)]
+        latencies.append((time.perf_counter() - started) * 1000)
+
+        recalls.append(len(truth.intersection(found.tolist())) / max(len(truth), 1))
+    return {
+        "dims": coarse["dims"],
+        "dtype": str(coarse["vectors"].dtype),
+        "rerank_k": rerank_k,
+        f"recall@{k}": round(float(np.mean(recalls)), 4),
+        "bytes_per_row": coarse["vectors"].shape[1] * coarse["vectors"].dtype.itemsize + (4 if "scale" in coarse else 0),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--dir", required=True, help="vector/ をダウンロードしたディレクトリ")
+    parser.add_argument("--dims", default="128,256,512,0", help="一次走査で残す次元数（カンマ区切り。0 = 全次元）")
+    parser.add_argument("--dtypes", default="int8,float16", help="一次走査ベクトルの型（カンマ区切り）")
+    parser.add_argument("--rerank-k", default="50,100,200,400", help="全精度で再計算する件数（カンマ区切り）")
+    parser.add_argument("--k", type=int, default=20, help="recall を測る上位件数（6-chat の top_k）")
+    parser.add_argument("--queries", type=int, default=200, help="評価クエリ数")
+    parser.add_argument("--queries-dir", help="query_embeddings/*.f32 をダウンロードしたディレクトリ")
+    parser.add_argument("--noise", type=float, default=0.02, help="疑似クエリのノイズ量")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力")
+    args = parser.parse_args()
+
+    chat = load_lambda("6-chat")
+    builder = load_lambda("5-build_vector")
+    manifest, matrix = load_matrix(args.dir)
+    queries = load_queries(args, matrix, chat)
+
+    # 厳密解の走査時間（比較の基準）
+    started = time.perf_counter()
+    for q in queries:
+        chat._top_indices(matrix @ q, args.k)
+    exact_ms = (time.perf_counter() - started) * 1000 / max(len(queries), 1)
+
+    results = []
+    for dims in (int(d) for d in args.dims.split(",")):
+        for dtype in args.dtypes.split(","):
+            coarse = builder._quantize_coarse(matrix, dims, dtype)
+            coarse["dims"] = coarse["vectors"].shape[1]
+            for rerank_k in (int(r) for r in args.rerank_k.split(",")):
+                results.append(evaluate(chat, matrix, coarse, queries, args.k, rerank_k))
+
+    if args.json:
+        print(json.dumps({
+            "version": manifest["version"],
+            "exact": {"dims": matrix.shape[1], "bytes_per_row": matrix.shape[1] * 4, "avg_ms": round(exact_ms, 3)},
+            "results": results,
+        }, ensure_ascii=False))
+        return
+    print(f"index v{manifest['version']} rows={manifest['count']} dims={matrix.shape[1]} queries={len(queries)} "
+          f"exact={exact_ms:.3f}ms/query ({matrix.shape[1] * 4} bytes/row)")
+    for r in results:
+        print("  " + "  ".join(f"{k}={v}" for k, v in r.items()))
+
+
+if __name__ == "__main__":
+    main()
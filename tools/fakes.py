@@ -0,0 +1,240 @@
+# fakes.py — ローカル検証用の S3 / OpenAI 代替（ネットワーク・課金なしで 6-chat を動かす）
+import os
+import time
+import hashlib
+import numpy as np
+
+
+# ====== S3 代替（ローカルディレクトリ = バケット） ======
+class _Body:
+    def __init__(self, data):
+        self._data = data
+
+    def read(self):
+        return self._data
+
+    def iter_lines(self):
+        yield from self._data.splitlines()
+
+
+class _NoSuchKey(Exception):
+    pass
+
+
+class LocalS3:
+    """boto3 の S3 クライアントのうち各 Lambda が使う操作だけを、ディレクトリ上で再現する"""
+
+    class exceptions:
+        NoSuchKey = _NoSuchKey
+
+    def __init__(self, root, latency=0.0):
+        self.root = root
+        self.latency = latency  # 1リクエストあたりの疑似遅延（秒）
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _read(self, key):
+        self._wait()
+        path = self._path(key)
+        if not os.path.exists(path):
+            raise _NoSuchKey(key)
+        with open(path, "rb") as f:
+            return f.read()
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        data = self._read(Key)
+        if Range:
+            start, end = Range.split("=", 1)[1].split("-")
+            data = data[int(start):int(end) + 1]
+        return {"Body": _Body(data), "ContentLength": len(data), "ETag": f'"{hashlib.md5(data).hexdigest()}"'}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        data = self._read(Key)
+        return {"ContentLength": len(data), "ETag": f'"{hashlib.md5(data).hexdigest()}"'}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._wait()
+        data = Body.encode("utf-8") if isinstance(Body, str) else Body
+        if hasattr(data, "read"):
+            data = data.read()
+        path = self._path(Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        return {"ETag": f'"{hashlib.md5(data).hexdigest()}"'}
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        with open(Filename, "rb") as f:
+            self.put_object(Bucket, Key, f.read())
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        data = self._read(Key)
+        with open(Filename, "wb") as f:
+            f.write(data)
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._wait()
+        upload_id = hashlib.md5(f"{Key}{time.time()}".encode()).hexdigest()
+        os.makedirs(self._path(f".multipart/{upload_id}"), exist_ok=True)
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self._wait()
+        with open(self._path(f".multipart/{UploadId}/{PartNumber:05d}"), "wb") as f:
+            f.write(Body)
+        return {"ETag": f'"{hashlib.md5(Body).hexdigest()}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self._wait()
+        part_dir = self._path(f".multipart/{UploadId}")
+        path = self._path(Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as out:
+            for part in MultipartUpload["Parts"]:
+                part_path = os.path.join(part_dir, f"{part['PartNumber']:05d}")
+                with open(part_path, "rb") as f:
+                    out.write(f.read())
+                os.remove(part_path)
+        os.rmdir(part_dir)
+        return {"ETag": '"multipart"'}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        part_dir = self._path(f".multipart/{UploadId}")
+        for name in os.listdir(part_dir):
+            os.remove(os.path.join(part_dir, name))
+        os.rmdir(part_dir)
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        if os.path.exists(self._path(Key)):
+            os.remove(self._path(Key))
+
+    def list_objects_v2(self, Bucket, Prefix="", ContinuationToken=None, MaxKeys=1000, **kwargs):
+        self._wait()
+        keys = []
+        for d, _, names in os.walk(self.root):
+            for name in names:
+                key = os.path.relpath(os.path.join(d, name), self.root).replace(os.sep, "/")
+                if key.startswith(Prefix) and not key.startswith(".multipart/"):
+                    keys.append(key)
+        keys.sort()
+        start = int(ContinuationToken or 0)
+        page = keys[start:start + MaxKeys]
+        resp = {"KeyCount": len(page), "IsTruncated": start + MaxKeys < len(keys)}
+        if page:
+            resp["Contents"] = [{"Key": k, "Size": os.path.getsize(self._path(k))} for k in page]
+        if resp["IsTruncated"]:
+            resp["NextContinuationToken"] = str(start + MaxKeys)
+        return resp
+
+    def get_paginator(self, name):
+        client = self
+
+        class _Paginator:
+            def paginate(self, **kwargs):
+                token = None
+                while True:
+                    resp = client.list_objects_v2(ContinuationToken=token, **kwargs)
+                    yield resp
+                    if not resp["IsTruncated"]:
+                        return
+                    token = resp["NextContinuationToken"]
+
+        return _Paginator()
+
+
+# ====== SQS 代替（メモリ上のキュー） ======
+class LocalSQS:
+    """send_message / send_message_batch を受け付けてメモリに溜める。drain() で Lambda の SQS イベント形式にして渡せる"""
+
+    def __init__(self, fail_ids=()):
+        self.messages = []
+        self.calls = 0
+        self._fail_ids = set(fail_ids)  # 初回だけ失敗させるエントリ Id（再送の確認用）
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        self.calls += 1
+        self.messages.append(MessageBody)
+        return {"MessageId": str(len(self.messages))}
+
+    def send_message_batch(self, QueueUrl, Entries, **kwargs):
+        self.calls += 1
+        if len(Entries) > 10:
+            raise ValueError("TooManyEntriesInBatchRequest")
+        ok, failed = [], []
+        for e in Entries:
+            if e["Id"] in self._fail_ids:
+                self._fail_ids.discard(e["Id"])
+                failed.append({"Id": e["Id"], "SenderFault": False, "Code": "InternalError"})
+                continue
+            self.messages.append(e["MessageBody"])
+            ok.append({"Id": e["Id"], "MessageId": str(len(self.messages))})
+        return {"Successful": ok, "Failed": failed}
+
+    def drain(self, handler, context=None):
+        """溜まったメッセージを1件ずつ SQS イベントとして handler に渡し、結果を返す"""
+        results = []
+        while self.messages:
+            body = self.messages.pop(0)
+            event = {"Records": [{"messageId": hashlib.md5(body.encode()).hexdigest(), "body": body}]}
+            results.append(handler(event, context))
+        return results
+
+
+# ====== OpenAI 代替 ======
+def fake_embedding(text, dims=1536):
+    """テキストから決定的に作る疑似 embedding（同じ文字列 → 同じベクトル）"""
+    seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:8], 16)
+    return np.random.default_rng(seed).standard_normal(dims).astype(np.float32)
+
+
+class _Obj:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeOpenAI:
+    """oa.embeddings.create / oa.chat.completions.create の代替
+       - embed_latency / first_token_latency / token_interval で API の待ち時間を模擬する"""
+
+    def __init__(self, dims=1536, embed_latency=0.0, first_token_latency=0.0, token_interval=0.0, reply_tokens=200):
+        self.dims = dims
+        self.embed_latency = embed_latency
+        self.first_token_latency = first_token_latency
+        self.token_interval = token_interval
+        self.reply_tokens = reply_tokens
+        self.calls = {"embeddings": 0, "chat": 0}
+        self.embeddings = _Obj(create=self._embed)
+        self.chat = _Obj(completions=_Obj(create=self._chat))
+
+    def _embed(self, model, input, **kwargs):
+        self.calls["embeddings"] += 1
+        time.sleep(self.embed_latency)
+        inputs = [input] if isinstance(input, str) else list(input)
+        data = [_Obj(index=i, embedding=fake_embedding(t, self.dims).tolist()) for i, t in enumerate(inputs)]
+        return _Obj(data=data, usage=_Obj(prompt_tokens=sum(len(t) for t in inputs)))
+
+    def _tokens(self, messages):
+        question = messages[-1]["content"].split("\n", 1)[0]
+        return [f"[{i}]" for i in range(self.reply_tokens - 1)] + [question]
+
+    def _chat(self, model, messages, stream=False, **kwargs):
+        self.calls["chat"] += 1
+        tokens = self._tokens(messages)
+        usage = _Obj(prompt_tokens=sum(len(m["content"]) for m in messages), completion_tokens=len(tokens))
+        if not stream:
+            time.sleep(self.first_token_latency + self.token_interval * len(tokens))
+            return _Obj(choices=[_Obj(message=_Obj(content="".join(tokens)))], usage=usage)
+
+        def gen():
+            time.sleep(self.first_token_latency)
+            for tok in tokens:
+                yield _Obj(choices=[_Obj(delta=_Obj(content=tok))])
+                time.sleep(self.token_interval)
+
+        return gen()
@@ -0,0 +1,72 @@
+# ttft.py — 6-chat の応答モード別に「最初の出典 / 最初のトークン / 完了」までの時間を測る
+#
+# 使い方（LLM は疑似。S3 はローカルディレクトリ、または実バケット）:
+#   aws s3 sync s3://chat-for-vill-reference/ ./bucket/ --exclude "embeddings/*"
+#   python tools/ttft.py --s3-dir ./bucket --message "森林環境譲与税の使途について"
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _lambda import load_lambda
+from fakes import LocalS3, FakeOpenAI
+
+
+def measure_buffered(chat, message, prompt):
+    started = time.perf_counter()
+    event = {"body": json.dumps({"message": message, "prompt": prompt, "live": True}, ensure_ascii=False)}
+    resp = chat.lambda_handler(event, None)
+    total = time.perf_counter() - started
+    # 一括応答では出典も本文も最後にまとめて届く
+    return {"mode": "buffered", "status": resp["statusCode"], "sources_ms": total * 1000, "ttft_ms": total * 1000, "total_ms": total * 1000}
+
+
+def measure_stream(chat, message, prompt):
+    started = time.perf_counter()
+    marks = {}
+    for kind, _ in chat.generate_reply_stream(message, {}, prompt):
+        marks.setdefault(kind, time.perf_counter() - started)
+    total = time.perf_counter() - started
+    return {
+        "mode": "stream",
+        "sources_ms": marks.get("sources", total) * 1000,
+        "ttft_ms": marks.get("delta", total) * 1000,
+        "total_ms": total * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="time-to-first-token measurement for 6-chat")
+    parser.add_argument("--s3-dir", help="バケットを同期したローカルディレクトリ（省略時は実 S3）")
+    parser.add_argument("--message", default="森林環境譲与税の使途について")
+    parser.add_argument("--prompt", default="")
+    parser.add_argument("--dims", type=int, default=1536)
+    parser.add_argument("--first-token-latency", type=float, default=0.8, help="疑似LLMの最初のトークンまでの秒数")
+    parser.add_argument("--token-interval", type=float, default=0.02, help="疑似LLMのトークン間隔（秒）")
+    parser.add_argument("--reply-tokens", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    chat = load_lambda("6-chat")
+    if args.s3_dir:
+        chat.s3 = LocalS3(args.s3_dir)
+    chat.oa = FakeOpenAI(
+        dims=args.dims,
+        first_token_latency=args.first_token_latency,
+        token_interval=args.token_interval,
+        reply_tokens=args.reply_tokens,
+    )
+    chat._load_vector_index()  # インデックス読込は計測対象外（ウォーム状態を測る）
+
+    results = []
+    for _ in range(args.repeat):
+        results.append(measure_buffered(chat, args.message, args.prompt))
+        results.append(measure_stream(chat, args.message, args.prompt))
+    for r in results:
+        print(json.dumps({k: round(v, 1) if isinstance(v, float) else v for k, v in r.items()}, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()